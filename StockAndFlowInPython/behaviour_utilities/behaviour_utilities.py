@@ -2,7 +2,6 @@
 Calculating similarity between two dynamic behaviors (time sequences) using DTW (dynamic time warping)
 """
 
-from dtw import dtw
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
@@ -29,6 +28,52 @@ test8 = np.array([0, 15, 30, 45, 60, 75, 90, 105, 120, 135, 150]).reshape(-1, 1)
 test9 = np.array([0, 20, 40, 60, 80, 100, 120, 140, 160, 180, 200]).reshape(-1, 1)
 
 
+def dtw_distance(x, y, window=None, abandon_above=None):
+    """
+    Dynamic time warping distance between two sequences, with the L1 distance between their points: the least total
+    cost of a warping path from the first points to the last, a path going on by one point of x, of y or of both.
+    The cost matrix is filled one anti-diagonal at a time, as all cells of an anti-diagonal only need the two
+    before it; so there is one vectorized step per anti-diagonal instead of one Python call per cell.
+    :param x: a sequence of n points, shaped (n,) or (n, dimensions)
+    :param y: a sequence of m points
+    :param window: if given, the Sakoe-Chiba band: only points at most this far apart in position are matched.
+    It must be at least |n - m|.
+    :param abandon_above: if given, stop as soon as every path costs more than this (e.g. the best distance so far)
+    and return inf
+    :return: the distance
+    """
+    x = np.asarray(x, dtype=float).reshape(len(x), -1)
+    y = np.asarray(y, dtype=float).reshape(len(y), -1)
+    n, m = len(x), len(y)
+    if n == 0 or m == 0:
+        raise ValueError("Behavior Utility: cannot compare empty sequences.")
+    if window is not None and window < abs(n - m):
+        raise ValueError("Behavior Utility: a warping window of {} cannot match sequences of {} and {} points; it must "
+                         "be at least {}.".format(window, n, m, abs(n - m)))
+    cost = np.abs(x[:, np.newaxis, :] - y[np.newaxis, :, :]).sum(axis=2)
+
+    # accumulated costs, with a border row and column: accumulated[i, j] is for x[i - 1] and y[j - 1]
+    accumulated = np.full((n + 1, m + 1), np.inf)
+    accumulated[0, 0] = 0
+    previous_minimum = 0
+    for k in range(2, n + m + 1):  # cells with i + j = k
+        i_low, i_high = max(1, k - m), min(n, k - 1)
+        if window is not None:  # |i - j| <= window, with j = k - i
+            i_low, i_high = max(i_low, (k - window + 1) // 2), min(i_high, (k + window) // 2)
+        i = np.arange(i_low, i_high + 1)
+        j = k - i
+        accumulated[i, j] = cost[i - 1, j - 1] + np.minimum(np.minimum(accumulated[i - 1, j - 1],
+                                                                       accumulated[i - 1, j]),
+                                                            accumulated[i, j - 1])
+        if abandon_above is not None:
+            # a path may step over one anti-diagonal, but not over two in a row; costs are not negative
+            minimum = accumulated[i, j].min() if len(i) > 0 else np.inf
+            if min(minimum, previous_minimum) > abandon_above:
+                return np.inf
+            previous_minimum = minimum
+    return accumulated[n, m]
+
+
 def categorize_behavior(who_compare, compare_with='./StockAndFlowInPython/behaviour_utilities/basic_behaviors.csv'):
     """
     Compare reference mode with known typical behavior patterns.
@@ -59,28 +104,32 @@ def categorize_behavior(who_compare, compare_with='./StockAndFlowInPython/behavi
     comparison_figure = Figure(figsize=(5, 4))
     comparison_plot = comparison_figure.add_subplot(111)
 
-    distances = {}  # distance :basic behavior
+    closest_behavior = None
+    closest_distance = np.inf
     for basic_behavior in basic_behaviors.keys():
         y = basic_behaviors[basic_behavior]
-        dist, cost, acc, path = dtw(x, y, dist=lambda x, y: np.linalg.norm(x-y, ord=1))
-        distances[dist] = basic_behavior
+        # a comparison is abandoned once it cannot be closer than the closest so far
+        dist = dtw_distance(x, y, abandon_above=closest_distance)
+        if dist <= closest_distance:
+            closest_behavior, closest_distance = basic_behavior, dist
         # print(basic_behavior, dist)
         comparison_plot.plot(y)
 
-    closest_behavior = distances[min(distances.keys())]
     print("    Behavior Utility: Classified as: ", closest_behavior)
 
     comparison_plot.plot(x)
     return closest_behavior, comparison_figure
 
 
-def similarity_calc_pattern(who_compare, compare_with):
+def similarity_calc_pattern(who_compare, compare_with, window=None, abandon_above=None):
     # print(who_compare)
     # print(compare_with)
     """
     Compare two behaviors by their patterns
     :param who_compare:
     :param compare_with:
+    :param window: warping window, see dtw_distance()
+    :param abandon_above: distance above which to stop comparing, see dtw_distance()
     :return:
     """
     # stretch x0 to a length close to 100.
@@ -108,7 +157,7 @@ def similarity_calc_pattern(who_compare, compare_with):
     comparison_figure = Figure(figsize=(5, 4))
     comparison_plot = comparison_figure.add_subplot(111)
 
-    dist, cost, acc, path = dtw(series_1, series_2, dist=lambda x, y: np.linalg.norm(x - y, ord=1))
+    dist = dtw_distance(series_1, series_2, window=window, abandon_above=abandon_above)
     # print(basic_behavior, dist)
     comparison_plot.plot(series_1)
     comparison_plot.plot(series_2)
@@ -116,7 +165,20 @@ def similarity_calc_pattern(who_compare, compare_with):
     return dist, comparison_figure
 
 
-def similarity_calc_behavior(who_compare, compare_with, comparison_axes=None):
+def pattern_distance(who_compare, compare_with):
+    """
+    Distance between the patterns of two behaviors given as 1-D sequences, without the figure (e.g. for scoring in
+    worker processes)
+    :param who_compare:
+    :param compare_with:
+    :return: the distance
+    """
+    dist, comparison_figure = similarity_calc_pattern(np.array(who_compare).reshape(-1, 1),
+                                                      np.array(compare_with).reshape(-1, 1))
+    return dist
+
+
+def similarity_calc_behavior(who_compare, compare_with, comparison_axes=None, window=None, abandon_above=None):
     # print(who_compare)
     # print(compare_with)
     """
@@ -124,6 +186,8 @@ def similarity_calc_behavior(who_compare, compare_with, comparison_axes=None):
     :param who_compare:
     :param compare_with:
     :param comparison_axes: the axes to draw on
+    :param window: warping window, see dtw_distance()
+    :param abandon_above: distance above which to stop comparing, see dtw_distance()
     :return:
     """
     # stretch x0 to a length close to 100.
@@ -151,7 +215,7 @@ def similarity_calc_behavior(who_compare, compare_with, comparison_axes=None):
     # comparison_figure = Figure(figsize=(5, 4))
     # comparison_plot = comparison_figure.add_subplot(111)
 
-    dist, cost, acc, path = dtw(x1, x2, dist=lambda x, y: np.linalg.norm(x - y, ord=1))
+    dist = dtw_distance(x1, x2, window=window, abandon_above=abandon_above)
     # print(basic_behavior, dist)
 
     # comparison_plot.plot(x1)
@@ -0,0 +1,185 @@
+"""
+Code generation backend for Graph-SD: turns a compiled Structure into Python source for a specialized function that
+runs many steps in a tight loop, with one local variable per element and the arithmetic inlined.
+"""
+import numpy as np
+from StockAndFlowInPython.graph_sd.graph_engine import STOCK, LINEAR, ADDITION, SUBTRACTION, MULTIPLICATION, DIVISION
+from StockAndFlowInPython.graph_sd.delays import delay_functions
+from StockAndFlowInPython.parsing.XMILE_parsing import Equation
+
+
+inline_operators = {ADDITION: '+', SUBTRACTION: '-', MULTIPLICATION: '*', DIVISION: '/'}
+
+
+class GeneratedCode(object):
+    """
+    Source of a generated step function, the function itself, and what it needs to be called
+    """
+    def __init__(self, source, namespace, constant_names, external_names, delay_names):
+        self.source = source
+        self.constant_names = constant_names
+        self.external_names = external_names
+        self.delay_names = delay_names
+        exec(compile(source, '<graph_sd generated>', 'exec'), namespace)
+        self.function = namespace['run_steps']
+
+
+def generate_code(structure, guard=False):
+    """
+    Generate the step function of a structure. The structure must have been compiled.
+
+    The generated function is
+        run_steps(values, k0, total_steps, dt, stocks, constants, externals, delays, limit=None)
+    It takes total_steps steps starting from step k0 and writes into values, the array of a ResultStore whose rows are
+    structure.stocks + structure.evaluation_order. stocks, constants, externals and delays are the latest stock
+    values, the values of constants, the values of external data at every step (from step 0) and the states of
+    delays, in the order of the names kept in the GeneratedCode. The states of delays must have been created, i.e. k0 > 0 if there are delays.
+
+    With guard, every calculated value is checked against limit (which also catches NaN and inf) and divisors,
+    including those inside equations (but only in the value an IF chooses), against zero. At the first failed check
+    the function returns (step, row, value), value being None for a division by zero; otherwise it returns None.
+    :param structure: a compiled Structure
+    :param guard: whether to generate the checks
+    :return: a GeneratedCode
+    """
+    rows = structure.stocks + structure.evaluation_order
+    local_names = {name: 'v_{}'.format(i) for i, name in enumerate(rows)}
+    namespace = dict()  # objects the generated source refers to but cannot inline
+    constant_names = list()
+    external_names = list()
+    delay_names = list()
+    delay_updates = list()
+
+    def argument_expression(argument):
+        if type(argument) == str:
+            return local_names[argument]
+        elif type(argument) in [int, float]:
+            return repr(float(argument))
+        else:
+            object_name = 'o_{}'.format(len(namespace))
+            namespace[object_name] = argument
+            return object_name
+
+    def function_expression(function):
+        arguments = [argument_expression(argument) for argument in function[1:]]
+        if function[0] in inline_operators and len(arguments) == 2:
+            return '{} {} {}'.format(arguments[0], inline_operators[function[0]], arguments[1])
+        elif function[0] == LINEAR and len(arguments) == 1:
+            return arguments[0]
+        elif isinstance(function[0], Equation):
+            namespace['np'] = np
+            return function[0].expression(arguments)
+        elif function[0] == LINEAR:
+            # linear(x, a=1, b=0)
+            a = arguments[1]
+            b = arguments[2] if len(arguments) > 2 else '0'
+            return '{} * {} + {}'.format(a, arguments[0], b)
+        else:
+            function_name = 'f_{}'.format(len(namespace))
+            namespace[function_name] = function[0]
+            return '{}({})'.format(function_name, ', '.join(arguments))
+
+    header = ['def run_steps(values, k0, total_steps, dt, stocks, constants, externals, delays, limit=None):']
+    loop = ['    for k in range(k0, k0 + total_steps):']
+    footer = list()
+
+    def check(row):
+        if guard:
+            loop.append('        if not -limit <= v_{0} <= limit: return k, {0}, v_{0}'.format(row))
+
+    def check_divisor(function, row):
+        if not guard:
+            return
+        if function[0] == DIVISION and type(function[2]) == str:
+            zero_divisions = ['{} == 0'.format(local_names[function[2]])]
+        elif isinstance(function[0], Equation):
+            zero_divisions = function[0].zero_divisions([argument_expression(argument) for argument in function[1:]])
+        else:
+            zero_divisions = list()
+        for zero_division in zero_divisions:
+            loop.append('        if {}: return k, {}, None'.format(zero_division, row))
+
+    for i, stock in enumerate(structure.stocks):
+        header.append('    {} = float(stocks[{}])  # {}'.format(local_names[stock], i, stock))
+
+    for row, name in enumerate(structure.evaluation_order, len(structure.stocks)):
+        attributes = structure.sfd.nodes[name]
+        local_name = local_names[name]
+        if attributes['external'] is True:
+            loop.append('        {} = externals[{}][k]  # {}'.format(local_name, len(external_names), name))
+            check(row)
+            external_names.append(name)
+        elif attributes['function'] is None:
+            header.append('    {} = float(constants[{}])  # {}'.format(local_name, len(constant_names), name))
+            if guard:
+                header.append('    if not -limit <= {0} <= limit: return k0, {1}, {0}'.format(local_name, row))
+            constant_names.append(name)
+        elif attributes['function'][0] in delay_functions:
+            delay_name = 'd_{}'.format(len(delay_names))
+            header.append('    {} = delays[{}]  # {}'.format(delay_name, len(delay_names), name))
+            loop.append('        {} = {}.output()  # {}'.format(local_name, delay_name, name))
+            check(row)
+            delay_updates.append('        {}.update({})'.format(delay_name,
+                                                               argument_expression(attributes['function'][1])))
+            delay_names.append(name)
+        else:
+            check_divisor(attributes['function'], row)
+            loop.append('        {} = {}  # {}'.format(local_name, function_expression(attributes['function']), name))
+            check(row)
+
+    # delays take the inputs of this dt
+    loop += delay_updates
+
+    # changes in stocks, in the same order of operations as Structure.run_step
+    changes = dict()
+    for flow, stock, direction_factor in structure.flow_stock_directions:
+        changes.setdefault(stock, list()).append('dt * {} * {}'.format(local_names[flow], direction_factor))
+    for stock, terms in changes.items():
+        loop.append('        {0} = {0} + ({1})  # {2}'.format(local_names[stock], ' + '.join(terms), stock))
+        check(rows.index(stock))
+
+    # recording: stocks and constants are one column ahead of the calculated elements
+    for i, name in enumerate(rows):
+        header.append('    r_{} = values[{}]'.format(i, i))
+        if structure.sfd.nodes[name]['element_type'] == STOCK:
+            loop.append('        r_{}[k + 1] = {}'.format(i, local_names[name]))
+        elif name in constant_names:
+            footer.append('    r_{}[k0 + 1:k0 + total_steps + 1] = {}'.format(i, local_names[name]))
+        else:
+            loop.append('        r_{}[k] = {}'.format(i, local_names[name]))
+    if len(loop) == 1:
+        loop.append('        pass')
+
+    source = '\n'.join(header + loop + footer) + '\n'
+    return GeneratedCode(source, namespace, constant_names, external_names, delay_names)
+
+
+def main():
+    """
+    Check that an equation guarding its own division, IF x = 0 THEN 0 ELSE y / x, runs guarded with x = 0 in both
+    backends without a false division by zero, and that a batch run with arrays picks the same values
+    """
+    from StockAndFlowInPython.graph_sd.graph_engine import Structure
+    from StockAndFlowInPython.parsing.XMILE_parsing import text_to_equation
+    structure = Structure()
+    structure.add_stock('stock0', [100])
+    structure.add_aux('x', [0])
+    structure.add_flow('flow0', text_to_equation('IF x = 0 THEN STEP(1 / x, 100) ELSE stock0 / x'),
+                       flow_from='stock0')
+    behaviors = list()
+    for backend in ['interpreter', 'codegen']:
+        status = structure.simulate(simulation_time=5, dt=0.25, backend=backend, guard=True)
+        if status.diverged:
+            raise AssertionError("GeneratedCode: the {} run diverged at step {} in {} ({}).".format(
+                backend, status.step, status.variable, status.reason))
+        behaviors.append(structure.get_behavior('stock0'))
+        structure.clear_a_run()
+    with np.errstate(divide='ignore'):  # with arrays, both values of IF are calculated
+        batch = structure.simulate_batch([[0], [2]], ['x'], simulation_time=5, dt=0.25)
+    if not np.array_equal(behaviors[0], behaviors[1]) or not np.array_equal(behaviors[0], batch.get('stock0')[0]):
+        raise AssertionError("GeneratedCode: the interpreter, generated code and batch runs differ.")
+    print('GeneratedCode: guarded division in IF runs the same in all backends,', batch.get('stock0')[:, -1])
+
+
+if __name__ == '__main__':
+    main()
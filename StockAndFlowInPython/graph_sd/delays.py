@@ -0,0 +1,115 @@
+"""
+Delay and smoothing functions for Graph-SD.
+
+In a structure they are used like the other functions, e.g. [DELAY1, input, delay_time] or
+[DELAY, input, delay_time, initial]. Unlike the others, they have a state: calling the function creates the state at
+the first step of a run (see Structure.calculate()); the state then gives the output of each step and is updated with
+the input once per dt. The output of a step only depends on the state, not on the input of the same step.
+
+Values may be floats, or NumPy arrays with one entry per scenario in batch runs. Delay times and orders are taken
+at the start of a run.
+"""
+import numpy as np
+
+
+class PipelineDelay(object):
+    """
+    Pipeline (fixed) delay: the output is the input of delay_time ago, kept in a ring buffer of delay_time/dt
+    slots, so a step costs the same however long the delay is.
+    """
+    def __init__(self, dt, input, delay_time, initial=None):
+        """
+        :param dt: time step of the run
+        :param input: value of the input at the start of the run
+        :param delay_time: delay time; shorter than dt is taken as dt
+        :param initial: output until the first input comes out; by default the input at the start of the run
+        """
+        delay_time = np.unique(delay_time)
+        if len(delay_time) > 1:
+            raise ValueError("SdEngine: a pipeline delay needs the same delay time in all scenarios.")
+        self.slots = max(1, int(round(float(delay_time[0]) / dt)))
+        self.buffer = [input if initial is None else initial] * self.slots
+        self.head = 0  # slot of the oldest input, which is the output
+
+    def output(self):
+        return self.buffer[self.head]
+
+    def update(self, input):
+        self.buffer[self.head] = input
+        self.head += 1
+        if self.head == self.slots:
+            self.head = 0
+
+
+class MaterialDelay(object):
+    """
+    Material delay of any order: a chain of 'order' internal stocks, each draining into the next with a delay of
+    delay_time/order. The output is the outflow of the last one.
+    """
+    def __init__(self, dt, input, delay_time, order, initial=None):
+        """
+        :param initial: initial output; by default the input at the start of the run
+        """
+        self.dt = dt
+        self.stage_time = delay_time / int(order)
+        # in equilibrium, every stage holds its outflow times its delay
+        self.stages = [(input if initial is None else initial) * self.stage_time] * int(order)
+
+    def output(self):
+        return self.stages[-1] / self.stage_time
+
+    def update(self, input):
+        outflows = [stage / self.stage_time for stage in self.stages]
+        inflows = [input] + outflows[:-1]
+        self.stages = [stage + self.dt * (inflow - outflow)
+                       for stage, inflow, outflow in zip(self.stages, inflows, outflows)]
+
+
+class Smooth(object):
+    """
+    Exponential smoothing of any order: a chain of 'order' first order smooths, each with an averaging time of
+    averaging_time/order. The output is the last one.
+    """
+    def __init__(self, dt, input, averaging_time, order, initial=None):
+        """
+        :param initial: initial output; by default the input at the start of the run
+        """
+        self.dt = dt
+        self.stage_time = averaging_time / int(order)
+        self.stages = [input if initial is None else initial] * int(order)
+
+    def output(self):
+        return self.stages[-1]
+
+    def update(self, input):
+        inputs = [input] + self.stages[:-1]
+        self.stages = [stage + self.dt * (stage_input - stage) / self.stage_time
+                       for stage, stage_input in zip(self.stages, inputs)]
+
+
+# The functions, taking the time step and then the arguments in the structure
+def delay(dt, input, delay_time, initial=None):
+    return PipelineDelay(dt, input, delay_time, initial)
+
+
+def delay1(dt, input, delay_time, initial=None):
+    return MaterialDelay(dt, input, delay_time, 1, initial)
+
+
+def delay3(dt, input, delay_time, initial=None):
+    return MaterialDelay(dt, input, delay_time, 3, initial)
+
+
+def delayn(dt, input, delay_time, order, initial=None):
+    return MaterialDelay(dt, input, delay_time, order, initial)
+
+
+def smth1(dt, input, averaging_time, initial=None):
+    return Smooth(dt, input, averaging_time, 1, initial)
+
+
+def smth3(dt, input, averaging_time, initial=None):
+    return Smooth(dt, input, averaging_time, 3, initial)
+
+
+delay_functions = [delay, delay1, delay3, delayn, smth1, smth3]
@@ -3,6 +3,11 @@ import pandas as pd
 import matplotlib.pyplot as plt
 from matplotlib.patches import FancyArrowPatch, Circle
 import numpy as np
+import copy
+from StockAndFlowInPython.graph_sd.result_store import ResultStore, open_result_store
+from StockAndFlowInPython.graph_sd.integrators import integrators
+from StockAndFlowInPython.graph_sd.delays import delay, delay1, delay3, delayn, smth1, smth3, delay_functions
+from StockAndFlowInPython.graph_sd.monte_carlo import sample_parameters, StreamingMoments, P2Quantiles, MonteCarloResult
 
 
 # define constants
@@ -12,6 +17,9 @@ VARIABLE = 'variable'
 PARAMETER = 'parameter'
 CONNECTOR = 'connector'
 ALIAS = 'alias'
+TIME = 'TIME'  # time of each step
+DT = 'DT'  # time step of the run
+run_variables = [TIME, DT]  # elements added for functions referring to them, see add_run_variables()
 
 
 # Define functions
@@ -42,9 +50,29 @@ DIVISION = division
 ADDITION = addition
 MULTIPLICATION = multiplication
 
+# delay and smoothing functions, which keep a state during a run: see delays.py
+DELAY = delay
+DELAY1 = delay1
+DELAY3 = delay3
+DELAYN = delayn
+SMTH1 = smth1
+SMTH3 = smth3
+
 function_names = [LINEAR, SUBTRACTION, DIVISION, ADDITION, MULTIPLICATION]
 
 
+# Vectorized counterparts, used when values are NumPy arrays (e.g. one value per scenario in a batch run)
+def vectorized_linear(x, a=1, b=0):
+    return a * np.asarray(x, dtype=float) + b
+
+
+vectorized_functions = {LINEAR: vectorized_linear,
+                        ADDITION: np.add,
+                        SUBTRACTION: np.subtract,
+                        DIVISION: np.true_divide,
+                        MULTIPLICATION: np.multiply}
+
+
 # Define equation-text converter
 
 name_operator_mapping = {ADDITION: '+', SUBTRACTION: '-', MULTIPLICATION: '*', DIVISION: '/'}
@@ -61,6 +89,10 @@ def equation_to_text(equation):
             return str(equation[1]) + name_operator_mapping[equation[0]] + str(equation[2])
         elif equation[0] == LINEAR:
             return str(equation[1])
+        elif equation[0] in delay_functions:
+            return '{}({})'.format(equation[0].__name__.upper(), ', '.join(str(argument) for argument in equation[1:]))
+        else:
+            return str(equation[0])  # e.g. a parsed equation, which prints as its text
 
 
 class UidManager(object):
@@ -97,19 +129,204 @@ class NameManager(object):
             return 'parameter_' + str(self.parameter_id)
 
 
-class DataFeeder(object):  # TODO: use multi-process to create a real data buffer
-    def __init__(self, data_source=None):
+class DataFeeder(object):
+    """
+    External data, read once from a CSV file into one NumPy array per variable. Values are looked up by the step of
+    a run, never consumed, so the same data serves any number of runs, batches and forks.
+
+    With a time column, the value at a step is interpolated at the time of the step (start + step * dt), holding
+    the first/last value outside the data. Without one, row k is the value at step k.
+    """
+    def __init__(self, data_source=None, time_column=None):
+        self.time_series = None
+        self.times = None  # time of each row; None when the rows are steps
+        self.columns = dict()  # variable names and their data
+        self.path = None  # the .npy file the data is mapped from, see share()
         if data_source is not None:
-            self.initialise(data_source=data_source)
+            self.initialise(data_source=data_source, time_column=time_column)
 
-    def initialise(self, data_source):
+    def initialise(self, data_source, time_column=None):
+        """
+        :param data_source: a CSV file
+        :param time_column: the column holding the time of each row; by default a column named 'Time' or 'time', if any
+        """
         self.time_series = pd.read_csv(data_source)
-        self.buffers_list = dict()
-        self.buffers_iter = dict()
+        if time_column is None:
+            time_column = next((column for column in ['Time', 'time', 'TIME'] if column in self.time_series), None)
+        self.times = None if time_column is None else self.time_series[time_column].to_numpy(dtype=float)
+        if self.times is not None and np.any(np.diff(self.times) <= 0):
+            raise ValueError("SdEngine: times in column {} of {} must be ascending.".format(time_column, data_source))
+        self.columns = dict()
+        self.path = None
 
     def set_var_source(self, var_name, csv_column):
-        self.buffers_list[var_name] = self.time_series[csv_column].tolist()
-        self.buffers_iter[var_name] = iter(self.time_series[csv_column].tolist())
+        self.columns[var_name] = self.time_series[csv_column].to_numpy(dtype=float)
+
+    def value(self, var_name, step, dt, start=0):
+        """
+        Get the value of a variable at a step of a run
+        """
+        column = self.columns[var_name]
+        if self.times is not None:
+            return float(np.interp(start + step * dt, self.times, column))
+        if step >= len(column):
+            raise ValueError("SdEngine: external data of {} has {} values, none for step {}.".format(
+                var_name, len(column), step))
+        return float(column[step])
+
+    def values(self, var_name, n_steps, dt, start=0):
+        """
+        Get the values of a variable at steps 0 to n_steps - 1 of a run
+        """
+        column = self.columns[var_name]
+        if self.times is not None:
+            return np.interp(start + np.arange(n_steps) * dt, self.times, column)
+        if n_steps > len(column):
+            raise ValueError("SdEngine: external data of {} has {} values, none for step {}.".format(
+                var_name, len(column), len(column)))
+        return column[:n_steps]
+
+    def share(self, path):
+        """
+        Keep the data in a .npy file mapped into memory. A DataFeeder sent to another process (e.g. in a spec, see
+        Structure.to_spec()) then maps the same file instead of getting a copy of the data.
+        """
+        names = list(self.columns)
+        data = np.stack([self.columns[name] for name in names]) if len(names) > 0 else np.empty((0, 0))
+        np.save(path, data)
+        self.path = path
+        self.map_columns(names)
+
+    def map_columns(self, names):
+        data = np.load(self.path, mmap_mode='r')
+        self.columns = {name: data[i] for i, name in enumerate(names)}
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['time_series'] = None  # the data is in the columns
+        if self.path is not None:
+            state['columns'] = list(self.columns)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.path is not None:
+            self.map_columns(state['columns'])
+
+
+class StockFlowIncidence(object):
+    """
+    Signed sparse flow->stock incidence matrix, kept in coordinate form: for each connection j, the flow in column
+    flow_columns[j] drains (signs[j] = -1) or fills (signs[j] = 1) the stock in row stock_rows[j].
+    """
+    def __init__(self, stocks, flows, flow_stock_directions):
+        """
+        :param stocks: names of the stocks, in row order
+        :param flows: names of the flows, in column order
+        :param flow_stock_directions: a list of (flow, stock, -1 or 1)
+        """
+        self.stocks = stocks
+        self.flows = flows
+        self.flow_stock_directions = flow_stock_directions
+        stock_index = {stock: i for i, stock in enumerate(stocks)}
+        flow_index = {flow: j for j, flow in enumerate(flows)}
+        self.stock_rows = np.array([stock_index[stock] for flow, stock, sign in flow_stock_directions], dtype=int)
+        self.flow_columns = np.array([flow_index[flow] for flow, stock, sign in flow_stock_directions], dtype=int)
+        self.signs = np.array([sign for flow, stock, sign in flow_stock_directions], dtype=float)
+
+    def to_dense(self):
+        matrix = np.zeros((len(self.stocks), len(self.flows)))
+        np.add.at(matrix, (self.stock_rows, self.flow_columns), self.signs)
+        return matrix
+
+    def flow_vector(self, values, batch_size=None):
+        """
+        Gather the values of the flows from a dictionary into an array, with a trailing batch axis in batch runs
+        """
+        if batch_size is None:
+            return np.array([values[flow] for flow in self.flows], dtype=float)
+        return np.array([np.broadcast_to(values[flow], (batch_size,)) for flow in self.flows],
+                        dtype=float).reshape(len(self.flows), batch_size)
+
+    def dot(self, flow_vector, dt=1):
+        """
+        Changes in stocks over dt, i.e. dt * (incidence matrix @ flow_vector). Only the connections are multiplied
+        and they are summed in order, so the result is the same as adding up dt * flow * sign stock by stock.
+        """
+        changes = np.zeros((len(self.stocks),) + flow_vector.shape[1:])
+        signs = self.signs.reshape((-1,) + (1,) * (flow_vector.ndim - 1))
+        np.add.at(changes, self.stock_rows, dt * flow_vector[self.flow_columns] * signs)
+        return changes
+
+
+class Checkpoint(object):
+    """
+    A run captured at a step, to fork what-if runs from: see Structure.checkpoint() and Structure.fork()
+    """
+    def __init__(self, history, run_settings, run_steps):
+        """
+        :param history: a ResultStore holding the run up to the step; its latest stock values and the states of
+        delays are the state
+        :param run_settings: dt and integration method of the run
+        :param run_steps: number of steps the run had when captured
+        """
+        self.history = history
+        self.step = history.steps
+        self.run_settings = run_settings
+        self.run_steps = run_steps
+
+
+class AlgebraicLoopError(Exception):
+    """Raised when flows/variables depend on each other in a loop that is not broken by a stock"""
+    pass
+
+
+class SimulationStatus(object):
+    """
+    Outcome of a guarded run: completed, or diverged at a step in a variable
+    """
+    def __init__(self, steps, step=None, variable=None, reason=None):
+        """
+        :param steps: number of steps in the run (the diverged step is not kept)
+        :param step: the step (counted from 0) at which the run diverged
+        :param variable: the element that diverged first, if known
+        :param reason: 'not finite', 'overflow', 'zero division' or another arithmetic error; None if completed
+        """
+        self.steps = steps
+        self.step = step
+        self.variable = variable
+        self.reason = reason
+        self.diverged = reason is not None
+
+    def __str__(self):
+        if self.diverged:
+            return "diverged at step {} / variable {} ({})".format(self.step, self.variable, self.reason)
+        return "completed {} steps".format(self.steps)
+
+
+def structure_from_spec(spec):
+    """
+    Build a structure from its spec (see Structure.to_spec()), e.g. in another process. Elements are put at the
+    origin and get no uid, since layout and identity are not part of a spec.
+    :return: a Structure that can be simulated
+    """
+    structure = Structure()
+    elements, external_data, dimensions, sim_specs = spec
+    structure.dimensions = dict(dimensions)
+    structure.default_start_time, structure.default_dt, structure.default_simulation_time, \
+        structure.default_save_interval = sim_specs
+    for name, element_type, flow_from, flow_to, function, value, external, element_dimensions in elements:
+        structure.sfd.add_node(name, uid=None, element_type=element_type, flow_from=flow_from, flow_to=flow_to,
+                               pos=[0, 0], function=function, value=value, points=None, external=external,
+                               dimensions=element_dimensions)
+    for name, element_type, flow_from, flow_to, function, value, external, element_dimensions in elements:
+        for stock in [flow_from, flow_to]:
+            if element_type == FLOW and stock is not None:
+                structure.sfd.add_edge(name, stock)
+    if external_data is not None:
+        structure.data_feeder = external_data
+    return structure
+
 
 def name_handler(name):
     return name.replace(' ', '_').replace('\n', '_')
@@ -128,8 +345,14 @@ class Structure(object):
             self.name_manager = name_manager
             self.uid_element_name = uid_element_name
 
+        # element names by type, see all_certain_type()
+        self.elements_by_type = dict()
+        self.indexed_sfd = None
+
         self.default_simulation_time = 25
         self.default_dt = 0.25
+        self.default_start_time = 0  # time at the start of a run, only used to label results
+        self.default_save_interval = None  # time between two recorded values; None for every dt
 
         self.set_predefined_structure = {'basic_stock_inflow': self.basic_stock_inflow,
                                          'basic_stock_outflow': self.basic_stock_outflow,
@@ -139,23 +362,73 @@ class Structure(object):
 
         self.data_feeder = DataFeeder()
 
-    def add_element(self, element_name, element_type, flow_from=None, flow_to=None, x=0, y=0, function=None, value=None, points=None, external=False):
+        # compiled by compile(); reset to None whenever the structure is changed
+        self.evaluation_order = None
+        self.flow_stock_directions = None
+        self.stocks = None
+        self.influences = None
+        self.delay_elements = list()
+        self.initial_equations = list()  # stocks whose initial values are given by equations, see initial_value()
+        self.shapes = dict()  # shapes of arrayed elements
+        self.arrayed = False
+
+        # dimensions (subscripts) of arrayed elements: names and the labels along them, see add_dimension()
+        self.dimensions = dict()
+        # flow->stock incidence matrix, rebuilt only when stocks, flows or their connections change
+        self.incidence = None
+
+        # elements edited since the current run was simulated, and the settings of that run; see resimulate()
+        self.edited_elements = set()
+        self.run_settings = None
+
+        # outcome of the last guarded run, see SimulationStatus
+        self.simulation_status = None
+
+        # generated step functions (without and with guard), see code_generator; kept until the structure
+        # signature changes
+        self.generated_code = dict()
+        self.generated_signature = None
+
+        # simulation results of the current run, see ResultStore
+        self.result_store = None
+
+    def add_element(self, element_name, element_type, flow_from=None, flow_to=None, x=0, y=0, function=None, value=None, points=None, external=False, dimensions=None):
         uid = self.uid_manager.get_new_uid()
+        if element_name in self.sfd:  # replacing an element keeps its place in the graph, so index again
+            self.indexed_sfd = None
         # this 'function' is a list, containing the function it self and its parameters
         # this 'value' is also a list, containing historical value throughout this simulation
-        self.sfd.add_node(element_name, uid=uid, element_type=element_type, flow_from=flow_from, flow_to=flow_to, pos=[x, y], function=function, value=value, points=points, external=external)
+        # 'dimensions' are the names of the dimensions an arrayed element has a value along, None for a scalar
+        self.sfd.add_node(element_name, uid=uid, element_type=element_type, flow_from=flow_from, flow_to=flow_to, pos=[x, y], function=function, value=value, points=points, external=external, dimensions=None if dimensions is None else tuple(dimensions))
         print('SdEngine: adding element:', element_name, 'function:', function, 'value:', value)
+        self.add_run_variables(function)
 
         # # automatically confirm dependencies, if a function is used for this variable
         # if function is not None and type(function) is not str:
         #     self.add_function_dependencies(element_name, function)
 
         self.uid_element_name[uid] = element_name
+        self.elements_by_type.setdefault(element_type, dict())[element_name] = None
+        if element_type in [STOCK, FLOW]:
+            self.incidence = None
+        self.invalidate(element_name)
 
         return uid
 
+    def add_run_variables(self, function):
+        """
+        Add the elements giving the time of each step (TIME) and the time step (DT) that a function refers to, if there
+        are none yet. They are read like external data, see external_value().
+        """
+        if type(function) == list:
+            for name in run_variables:
+                if name in function[1:] and name not in self.sfd:
+                    self.add_element(name, element_type=VARIABLE, value=[0], external=True)
+
     def add_causality(self, from_element, to_element, uid=0, angle=None, polarity=None, display=True):  # confirm one causality
         self.sfd.add_edge(from_element, to_element, uid=uid, angle=angle, polarity=polarity, display=display)  # display as a flag for to or not to display
+        self.check_incidence(from_element, to_element)
+        self.invalidate(to_element)
 
     def add_function_dependencies(self, element_name, function):  # confirm bunch of causality found in a function
         for from_variable in function[1:]:
@@ -186,8 +459,22 @@ class Structure(object):
         print('SdEngine: Causality from {} to {}:'.format(from_element, to_element))
         print(self.sfd[from_element][to_element])
 
+    def index_types(self):
+        """
+        Build the index of elements by type from the graph. It is then kept up to date by add_element and
+        delete_element; if the graph is replaced or changed directly, it is built again when next used.
+        """
+        self.elements_by_type = dict()
+        for node, attributes in self.sfd.nodes.data():
+            self.elements_by_type.setdefault(attributes['element_type'], dict())[node] = None  # an ordered set
+        self.indexed_sfd = self.sfd
+
     def all_certain_type(self, element_type):
         # able to handle both single type and multiple types
+        if self.indexed_sfd is not self.sfd or \
+                sum([len(elements) for elements in self.elements_by_type.values()]) != self.sfd.number_of_nodes():
+            self.index_types()
+
         elements = list()
         if type(element_type) != list:
             element_types = [element_type]
@@ -195,14 +482,13 @@ class Structure(object):
             element_types = element_type
 
         for ele_tp in element_types:
-            for node, attributes in self.sfd.nodes.data():
-                if attributes['element_type'] == ele_tp:
-                    elements.append(node)
+            elements += list(self.elements_by_type.get(ele_tp, dict()))
         # print(elements, "Found for", element_types)
         return elements
 
     def set_external(self, element_name):
         self.sfd.nodes[element_name]["external"] = True
+        self.invalidate(element_name)
 
     def get_coordinate(self, name):
         """
@@ -212,124 +498,553 @@ class Structure(object):
         """
         return self.sfd.nodes[name]['pos']
 
-    def calculate(self, name):
+    def compile(self):
+        """
+        Compile the structure into a flat evaluation order.
+        Flows, variables and parameters are sorted topologically by the arguments of their functions, so that each
+        of them is calculated exactly once per dt. Stocks are not in the order: they only provide their latest value.
+        :return: the evaluation order, a list of element names
+        """
+        dependencies = nx.DiGraph()
+        self.influences = nx.DiGraph()  # all dependencies by function arguments, including those on stocks
+        for name, attributes in self.sfd.nodes.data():
+            if attributes['element_type'] not in [FLOW, VARIABLE, PARAMETER]:
+                continue
+            dependencies.add_node(name)
+            if attributes['external'] is True or attributes['function'] is None:
+                continue
+            for argument in attributes['function'][1:]:
+                if type(argument) == str:
+                    self.influences.add_edge(argument, name)
+                    if self.sfd.nodes[argument]['element_type'] != STOCK:
+                        dependencies.add_edge(argument, name)
+
+        try:
+            self.evaluation_order = list(nx.topological_sort(dependencies))
+        except nx.NetworkXUnfeasible:
+            loop = [edge[0] for edge in nx.find_cycle(dependencies)]
+            raise AlgebraicLoopError("SdEngine: algebraic loop without a stock: {}".format(' -> '.join(loop)))
+
+        if self.incidence is None:  # stocks, flows or their connections have changed
+            self.incidence = self.build_incidence()
+        self.flow_stock_directions = self.incidence.flow_stock_directions
+        self.influences.add_edges_from([(flow, stock) for flow, stock, direction_factor in self.flow_stock_directions])
+        self.stocks = self.incidence.stocks
+        self.initial_equations = [stock for stock in self.stocks if self.has_initial_equation(stock)]
+        self.delay_elements = [name for name in self.evaluation_order if self.is_delay(name)]
+        self.shapes = dict()
+        for name in self.stocks + self.evaluation_order:
+            if self.sfd.nodes[name].get('dimensions') is not None:
+                self.shapes[name] = self.element_shape(name)
+        self.arrayed = len(self.shapes) > 0
+        return self.evaluation_order
+
+    def add_dimension(self, name, elements):
+        """
+        Add a dimension that elements can be arrayed along
+        :param name: name of the dimension, e.g. 'Region'
+        :param elements: labels along it, e.g. ['North', 'South'], or their number
+        """
+        if type(elements) == int:
+            elements = [str(i + 1) for i in range(elements)]
+        self.dimensions[name] = list(elements)
+        self.evaluation_order = None
+
+    def element_shape(self, name):
+        """
+        Get the shape of an arrayed element's values. It has an axis for every dimension of the structure, in the
+        order they were added, with size 1 along those the element is not arrayed over; so values of elements
+        arrayed over different dimensions broadcast against each other by dimension.
+        """
+        element_dimensions = self.sfd.nodes[name].get('dimensions')
+        if element_dimensions is None:
+            return ()
+        for dimension in element_dimensions:
+            if dimension not in self.dimensions:
+                raise ValueError("SdEngine: {} is arrayed over an unknown dimension {}.".format(name, dimension))
+        return tuple(len(elements) if dimension in element_dimensions else 1
+                     for dimension, elements in self.dimensions.items())
+
+    def arrayed_value(self, name, value):
+        """
+        Arrange a value of an arrayed element, given along its own dimensions in their order (or as one number for
+        all entries), into its shape, see element_shape()
+        """
+        value = np.asarray(value, dtype=float)
+        if value.ndim == 0:
+            return np.full(self.shapes[name], float(value))
+        element_dimensions = list(self.sfd.nodes[name]['dimensions'])
+        expected = tuple(len(self.dimensions[dimension]) for dimension in element_dimensions)
+        if value.shape != expected:
+            raise ValueError("SdEngine: {} is arrayed over {} of sizes {}, but its value has the shape {}.".format(
+                name, element_dimensions, expected, value.shape))
+        order = [element_dimensions.index(dimension) for dimension in self.dimensions if dimension in element_dimensions]
+        return value.transpose(order).reshape(self.shapes[name])
+
+    def build_incidence(self):
+        """
+        Build the flow->stock incidence matrix from the stock-flow connections
+        :return: a StockFlowIncidence
+        """
+        # for each flow, the stocks it drains (-1) or fills (1)
+        flow_stock_directions = list()
+        for flow in self.all_certain_type(FLOW):
+            for successor in self.sfd.successors(flow):
+                if self.sfd.nodes[successor]['element_type'] == STOCK:  # flow may also affect elements other than stock
+                    if self.sfd.nodes[flow]['flow_from'] == successor:  # if flow influences this stock negatively
+                        flow_stock_directions.append((flow, successor, -1))
+                    elif self.sfd.nodes[flow]['flow_to'] == successor:  # if flow influences this stock positively
+                        flow_stock_directions.append((flow, successor, 1))
+                    else:
+                        print("SdEngine: Strange! {} seems to influence {} but not found in graph's attributes.".format(flow, successor))
+        return StockFlowIncidence(self.all_certain_type(STOCK), self.all_certain_type(FLOW), flow_stock_directions)
+
+    def check_incidence(self, from_element, to_element):
+        """
+        Drop the incidence matrix if a link between these elements is a stock-flow connection
+        """
+        if self.sfd.nodes[from_element]['element_type'] == FLOW and self.sfd.nodes[to_element]['element_type'] == STOCK:
+            self.incidence = None
+
+    def invalidate(self, *edited):
+        """
+        Drop the compiled evaluation order, so that it is compiled again before the next step.
+        :param edited: names of the elements whose equations or connections were changed, see resimulate()
+        """
+        self.evaluation_order = None
+        self.edited_elements.update(edited)
+
+    def get_signature(self):
+        """
+        Get a hashable summary of everything the generated code depends on: elements, their functions and the
+        connections. Values of constants and stocks are left out, as they are read when the code is run.
+        """
+        elements = list()
+        for name, attributes in self.sfd.nodes.data():
+            function = attributes['function']
+            if type(function) == list:
+                function = tuple(function)
+            elements.append((name, attributes['element_type'], attributes['external'], attributes['flow_from'],
+                             attributes['flow_to'], function))
+        return tuple(elements), tuple(self.sfd.edges)
+
+    def generate_code(self, guard=False):
+        """
+        Generate (or get the cached) specialized step function of this structure. Its source can be inspected in
+        generate_code().source.
+        :param guard: whether the function checks values as it goes, see code_generator.generate_code()
+        :return: a GeneratedCode
+        """
+        from StockAndFlowInPython.graph_sd.code_generator import generate_code
+        signature = self.get_signature()
+        if signature != self.generated_signature:
+            self.generated_code = dict()
+            self.generated_signature = signature
+        if guard not in self.generated_code:
+            if self.evaluation_order is None:
+                self.compile()
+            self.generated_code[guard] = generate_code(self, guard)
+        return self.generated_code[guard]
+
+    def run_generated(self, result_store, total_steps, dt, overflow_threshold=None):
+        """
+        Take total_steps steps of a run with the generated step function, continuing from what result_store holds
+        :param overflow_threshold: if given, the run is guarded with this threshold
+        :return: a SimulationStatus if guarded
+        """
+        guard = overflow_threshold is not None
+        if total_steps > 0 and len([name for name in self.delay_elements if name not in result_store.states]) > 0:
+            # the first step creates the states of delays, so it is taken by the interpreter
+            if guard:
+                status = self.run_guarded(result_store, 1, dt, None, overflow_threshold)
+                if status.diverged:
+                    return status
+            else:
+                self.run_step(result_store, dt)
+            total_steps -= 1
+        generated_code = self.generate_code(guard)
+        result_store.reserve(result_store.steps + total_steps)
+        stocks = [result_store.latest(stock) for stock in self.stocks]
+        constants = [self.sfd.nodes[name]['value'][-1] for name in generated_code.constant_names]
+        externals = [self.external_values(name, result_store.steps + total_steps, dt).tolist()
+                     for name in generated_code.external_names]
+        delays = [result_store.states[name] for name in generated_code.delay_names]
+        if guard:
+            states = copy.deepcopy(result_store.states)  # to take the steps again if they fail, see below
+        try:
+            divergence = generated_code.function(result_store.values, result_store.steps, total_steps, dt, stocks,
+                                                 constants, externals, delays, overflow_threshold)
+        except ArithmeticError:
+            if not guard:
+                raise
+            # in a function that is not inlined, so the step and the element are not known: the same steps are taken
+            # again by the interpreter, which stops where it happens
+            result_store.states = states
+            return self.run_guarded(result_store, total_steps, dt, None, overflow_threshold)
+        if divergence is None:
+            result_store.steps += total_steps
+            return SimulationStatus(result_store.steps) if guard else None
+        step, row, value = divergence
+        result_store.steps = step
+        if value is None:
+            reason = 'zero division'
+        else:
+            reason = 'overflow' if np.isfinite(value) else 'not finite'
+        return SimulationStatus(step, step, result_store.names[row], reason)
+
+    def run_guarded(self, result_store, total_steps, dt, integrator, overflow_threshold):
+        """
+        Take total_steps steps of a run, checking every step for NaN/inf, values beyond overflow_threshold and
+        arithmetic errors such as division by zero. The run is stopped at the first step that fails.
+        :return: a SimulationStatus
+        """
+        # elements are checked in the order they are calculated in, so that the first to diverge is reported
+        n_stocks = len(self.stocks)  # rows of stocks, counting every entry of arrayed stocks
+        if len(self.stocks) > 0:
+            n_stocks = result_store.rows[self.stocks[-1]].stop
+        check_order = np.array(list(range(n_stocks, len(result_store.row_names))) + list(range(n_stocks)), dtype=int)
+        last_columns = result_store.has_initial[check_order] - 1
+        check_names = self.evaluation_order + self.stocks  # for runs not recording every value of every element
+        for i in range(total_steps):
+            step = result_store.steps
+            previous = dict(result_store.current)
+            try:
+                self.run_step(result_store, dt, integrator=integrator)
+            except ArithmeticError as error:
+                reason = 'zero division' if isinstance(error, ZeroDivisionError) else type(error).__name__
+                return SimulationStatus(step, step, getattr(error, 'variable', None), reason)
+            if result_store.records_all:
+                latest = result_store.values[check_order, result_store.steps + last_columns]
+            else:
+                latest = [np.ravel(result_store.latest(name)) for name in check_names]
+                sizes = [len(value) for value in latest]
+                latest = np.concatenate(latest)
+            failed = np.flatnonzero(~(np.abs(latest) <= overflow_threshold))  # NaN fails any comparison
+            if len(failed) > 0:
+                value = latest[failed[0]]
+                if result_store.records_all:
+                    name = result_store.row_names[check_order[failed[0]]]
+                else:
+                    name = check_names[np.searchsorted(np.cumsum(sizes), failed[0], side='right')]
+                result_store.steps = step  # don't keep the diverged step
+                result_store.current = previous
+                return SimulationStatus(step, step, name, 'overflow' if np.isfinite(value) else 'not finite')
+        return SimulationStatus(result_store.steps)
+
+    def calculate(self, name, values, vectorized=False, states=None, dt=None, step=None):
         """
-        Core function for simulation, based on recursion
+        Calculate one element, given the values of everything before it in the evaluation order
         :param name: Name of the element to calculate
+        :param values: A dictionary of element names and their values in this dt
+        :param vectorized: if True, values are NumPy arrays and the vectorized functions are used
+        :param states: the states of delays in this run (see ResultStore.states), for calculating delays
+        :param dt: time step of the run, for creating the states of delays and reading external data
+        :param step: the step of the run, for reading external data
         """
         if self.sfd.nodes[name]['external'] is True:
             # if the variable is using external data source
-            return next(self.data_feeder.buffers_iter[name])
-
-        elif type(name) == int or type(name) == float:
-            # if the name is actually a constant:
-            return name
-
-        elif self.sfd.nodes[name]['element_type'] == STOCK:
-            # if the node is a stock
-            return self.sfd.nodes[name]['value'][-1]  # just return its latest value, update afterwards.
+            return self.external_value(name, step, dt)
         elif self.sfd.nodes[name]['function'] is None:
             # if the node does not have a function and not a stock, then it's constant
-            # if this node is a constant, still extend its value list by its last value
-
-            # However, if this variable is participating in more than 1 calculation, its value could be extended twice.
-            # use 'visited' to fix this problem.
-            if name not in self.visited:
-                self.sfd.nodes[name]['value'].append(self.sfd.nodes[name]['value'][-1])
-                self.visited.append(name)
+            if name in self.shapes:
+                return self.arrayed_value(name, self.sfd.nodes[name]['value'][-1])
             return self.sfd.nodes[name]['value'][-1]  # use its latest value
-        else:  # it's not a constant value but a function  #
-            # params = self.sfd.nodes[name]['function'][1:]  # extract all parameters needed by this function
-            params = [param for param in self.sfd.nodes[name]['function'][1:]]  # take params without the operator
-            for j in range(len(params)):  # use recursion to find the values of params, then -
-                params[j] = self.calculate(params[j])  # replace the param's name with its value.
-            new_value = self.sfd.nodes[name]['function'][0](*params)  # calculate the new value for this step
-
-            # However, if this variable is participating in mor than 1 calculation, its value could be extended twice.
-            # use 'visited' to solve this problem.
-            if name not in self.visited:
-                self.sfd.nodes[name]['value'].append(new_value)  # confirm this new value to this node's value list
-                self.visited.append(name)
-            return new_value  # return the new value to where it was called
-
-    def step(self, dt=0.25):
-        """
-        Core function for simulation. Calculating all flows and adjust stocks accordingly based on recursion.
-        """
-        # have a dictionary for flows and their values in this default_dt, to be added to /subtracted from stocks afterward.
-        flows_dt = dict()
-
-        # find all flows in the model
-        for element in self.all_certain_type(FLOW):  # loop through all elements in this SFD,
-            flows_dt[element] = 0  # make a position for it in the dict of flows_dt, initializing it with 0
-
-        # have a list for all visited (calculated) variables (F/V/P) in this model
-        self.visited = list()
-
-        # calculate flows
-        for flow in flows_dt.keys():
-            flows_dt[flow] = dt * self.calculate(flow)
-        # print('All flows default_dt:', flows_dt)
-
-        # calculate all not visited variables and parameters in this model, in order to update their value list
-        # because all flows and stocks must be visited, only V and P are considered.
-        for element in self.all_certain_type([VARIABLE, PARAMETER]):
-            if element not in self.visited:
-                self.calculate(element)
-
-        # calculating changes in stocks
-        # have a dictionary of affected stocks and their changes, for one flow could affect 2 stocks.
-        affected_stocks = dict()
-        for flow in flows_dt.keys():
-            successors = list(self.sfd.successors(flow))  # successors of a flow into a list
-            # print('Successors of {}: '.format(flow), successors)
-            for successor in successors:
-                if self.sfd.nodes[successor]['element_type'] == STOCK:  # flow may also affect elements other than stock
-                    direction_factor = 1  # initialize
-                    if successor not in affected_stocks.keys():  # if this flow hasn't been calculated, create a new key
-                        if self.sfd.nodes[flow]['flow_from'] == successor:  # if flow influences this stock negatively
-                            direction_factor = -1
-                        elif self.sfd.nodes[flow]['flow_to'] == successor:  # if flow influences this stock positively
-                            direction_factor = 1
-                        else:
-                            print("SdEngine: Strange! {} seems to influence {} but not found in graph's attributes.".format(flow, successor))
-                        if successor in affected_stocks.keys():  # this stock may have been added by other flows
-                            affected_stocks[successor] += flows_dt[flow] * direction_factor
-                        else:
-                            affected_stocks[successor] = flows_dt[flow] * direction_factor
-                    else:  # otherwise update this flow's value on top of results of previous calculation (f2 = f1 + f0)
-                        if self.sfd.nodes[flow]['flow_from'] == successor:  # if flow influences this stock negatively
-                            direction_factor = -1
-                        elif self.sfd.nodes[flow]['flow_to'] == successor:  # if flow influences this stock positively
-                            direction_factor = 1
-                        else:
-                            print("SdEngine: Strange! {} seems to influence {} but not found in graph's attributes.".format(flow, successor))
-                        if successor in affected_stocks.keys():  # this stock may have been added by other flows
-                            affected_stocks[successor] += flows_dt[flow] * direction_factor
-                        else:
-                            affected_stocks[successor] = flows_dt[flow] * direction_factor
-
-        # updating affected stocks values
-        for stock in affected_stocks.keys():
-            # calculate the new value for this stock and confirm it to the end of its value list
-            self.sfd.nodes[stock]['value'].append(self.sfd.nodes[stock]['value'][-1] + affected_stocks[stock])
-            # print('Stock ', stock, ': {:.4f}'.format(self.sfd.nodes[stock]['value'][-1]))
-
-        # for those stocks not affected, extend its 'values' by the same value as it is
-        for node in self.sfd.nodes:
-            if self.sfd.nodes[node]['element_type'] == STOCK:
-                if node not in affected_stocks.keys():
-                    self.sfd.nodes[node]['value'].append(self.sfd.nodes[node]['value'][-1])
-                    # print('Stock ', node, ': {:.4f}'.format(self.sfd.nodes[node]['value'][-1]))
+        else:  # it's not a constant value but a function
+            function = self.sfd.nodes[name]['function']
+            # an argument is either the name of an element calculated earlier, or a constant
+            params = [values[param] if type(param) == str else param for param in function[1:]]
+            if function[0] in delay_functions:
+                # a delay gives the output of its state; the state is created in the first step of a run
+                if name not in states:
+                    states[name] = function[0](dt, *params)
+                return states[name].output()
+            if vectorized:
+                return vectorized_functions.get(function[0], function[0])(*params)
+            return function[0](*params)  # calculate the new value for this step
+
+    def external_value(self, name, step, dt):
+        """
+        Get the value of an external element at a step of a run: the time of the step for TIME, the time step for DT,
+        otherwise its data
+        """
+        if name == TIME:
+            return self.default_start_time + step * dt
+        elif name == DT:
+            return dt
+        return self.data_feeder.value(name, step, dt, self.default_start_time)
+
+    def external_values(self, name, n_steps, dt):
+        """
+        Get the values of an external element at steps 0 to n_steps - 1 of a run
+        """
+        if name == TIME:
+            return self.default_start_time + np.arange(n_steps) * dt
+        elif name == DT:
+            return np.full(n_steps, float(dt))
+        return self.data_feeder.values(name, n_steps, dt, self.default_start_time)
+
+    def new_result_store(self, n_steps=0, batch_size=None, overrides=None, path=None, record=None, save_every=1):
+        """
+        Create an empty result store for a run, holding the initial values of stocks and constants
+        :param n_steps: number of steps to allocate for
+        :param batch_size: number of scenarios in a batch run; None for a single run
+        :param overrides: a dictionary of stocks/constants and the (initial) values that replace their own
+        :param path: a .npy file to store the run in; None to keep it in memory
+        :param record: names of the elements to record; None for all
+        :param save_every: number of steps between two recorded values
+        """
+        has_initial = list()
+        initial_values = dict()
+        for name in self.stocks + self.evaluation_order:
+            attributes = self.sfd.nodes[name]
+            if self.has_initial_value(name):
+                has_initial.append(1)
+                if name in self.initial_equations:
+                    continue
+                initial_values[name] = attributes['value'][-1]
+                if name in self.shapes:
+                    initial_values[name] = self.arrayed_value(name, initial_values[name])
+            else:
+                has_initial.append(0)
+        if overrides is not None:
+            initial_values.update(overrides)
+        if len(self.initial_equations) > 0:
+            # stocks starting from equations are calculated from the other initial values
+            known_values = dict(initial_values)
+            for stock in self.initial_equations:
+                initial_values[stock] = self.initial_value(stock, known_values, batch_size is not None or self.arrayed)
+        result_store = ResultStore(self.stocks + self.evaluation_order, has_initial, n_steps=n_steps,
+                                   batch_size=batch_size,
+                                   shapes=[self.shapes.get(name, ()) for name in self.stocks + self.evaluation_order],
+                                   path=path, record=record, save_every=save_every)
+        result_store.set_initial(initial_values)
+        return result_store
+
+    def has_initial_value(self, name):
+        """
+        Whether an element has a value before the first step: stocks and constants do; functions and external data
+        don't
+        """
+        attributes = self.sfd.nodes[name]
+        return attributes['element_type'] == STOCK or (attributes['function'] is None and
+                                                       attributes['external'] is not True)
+
+    def has_initial_equation(self, name):
+        """
+        Whether the initial value of a stock is given by an equation, e.g. [LINEAR, 'Desired_Inventory'], not a number
+        """
+        value = self.sfd.nodes[name]['value']
+        return self.sfd.nodes[name]['element_type'] == STOCK and value is not None and len(value) > 0 and \
+            not isinstance(value[0], (int, float, np.number, np.ndarray))
+
+    def initial_value(self, name, values, vectorized=False):
+        """
+        Calculate the value of an element at the start of a run, calculating first what it depends on. Stocks with
+        initial equations are calculated from them; delays and DT take the default time step.
+        :param values: the values known so far, at least those of constants and of stocks given by numbers; the
+        values calculated are added to it
+        :param vectorized: if True, values are NumPy arrays and the vectorized functions are used
+        """
+        if name in values:
+            return values[name]
+        attributes = self.sfd.nodes[name]
+        function = attributes['value'] if name in self.initial_equations else attributes['function']
+        if attributes['external'] is not True and function is not None:
+            for argument in function[1:]:
+                if type(argument) == str:
+                    self.initial_value(argument, values, vectorized)
+        if name in self.initial_equations:
+            params = [values[param] if type(param) == str else param for param in function[1:]]
+            if vectorized:
+                values[name] = vectorized_functions.get(function[0], function[0])(*params)
+            else:
+                values[name] = function[0](*params)
+        else:
+            values[name] = self.calculate(name, values, vectorized, dict(), self.default_dt, 0)
+        return values[name]
+
+    def step(self, dt=0.25, integrator=None):
+        """
+        Core function for simulation. Calculating all flows and adjust stocks accordingly, following the compiled
+        evaluation order.
+        :param integrator: see run_step()
+        """
+        if self.evaluation_order is None:
+            self.compile()
+        if self.result_store is None or self.result_store.elements != self.stocks + self.evaluation_order:
+            # first step of a run, or the structure has been changed during the run
+            self.result_store = self.new_result_store()
+        self.run_step(self.result_store, dt, integrator=integrator)
+
+    def evaluate(self, values, vectorized=False, states=None, dt=None, step=None):
+        """
+        Calculate all flows, variables and parameters, each exactly once
+        :param values: a dictionary holding the values of stocks, and of anything that should not be calculated
+        :param vectorized: if True, values are NumPy arrays and the vectorized functions are used
+        :param states: see calculate()
+        :param dt: see calculate()
+        :param step: see calculate()
+        :return: values, completed
+        """
+        for name in self.evaluation_order:
+            if name not in values:
+                try:
+                    values[name] = self.calculate(name, values, vectorized, states, dt, step)
+                except ArithmeticError as error:
+                    error.variable = name  # for guarded runs to tell where it happened
+                    raise
+        return values
+
+    def is_delay(self, name):
+        function = self.sfd.nodes[name]['function']
+        return self.sfd.nodes[name]['external'] is not True and type(function) == list and \
+            function[0] in delay_functions
+
+    def update_delays(self, states, values, names=None):
+        """
+        Update the states of delays with their inputs, once per dt
+        :param states: the states of delays in a run
+        :param values: a dictionary holding the values of this dt
+        :param names: the delays to update; by default all
+        """
+        for name in self.delay_elements if names is None else names:
+            input = self.sfd.nodes[name]['function'][1]
+            states[name].update(values[input] if type(input) == str else input)
+
+    def restore_states(self, result_store, dt):
+        """
+        Get the states of delays at the latest step of a run by replaying them with the recorded values
+        :return: a dictionary of delays and their states
+        """
+        states = dict()
+        index = result_store.index
+        for k in range(result_store.steps):
+            # column k holds the values of stocks before step k and the values calculated in step k
+            values = {name: result_store.value_at(name, k) for name in index}
+            for name in self.delay_elements:
+                if name not in states:
+                    function = self.sfd.nodes[name]['function']
+                    states[name] = function[0](dt, *[values[param] if type(param) == str else param
+                                                     for param in function[1:]])
+            self.update_delays(states, values)
+        return states
+
+    def pack_stocks(self, values):
+        """
+        Gather the values of all stocks into one array, e.g. for integrators; arrayed stocks are flattened into it
+        """
+        if not self.arrayed:
+            return np.array([values[stock] for stock in self.stocks], dtype=float)
+        return np.concatenate([np.broadcast_to(values[stock], self.shapes.get(stock, ())).ravel()
+                               for stock in self.stocks]).astype(float)
+
+    def unpack_stocks(self, y):
+        """
+        Get the values of the stocks, in order, from an array made by pack_stocks()
+        """
+        if not self.arrayed:
+            return y
+        stock_values = list()
+        start = 0
+        for stock in self.stocks:
+            shape = self.shapes.get(stock, ())
+            size = int(np.prod(shape))
+            stock_values.append(y[start:start + size].reshape(shape) if shape != () else y[start])
+            start += size
+        return stock_values
+
+    def arrayed_net_flows(self, values):
+        """
+        Get the net flows into each stock, for structures with arrayed elements
+        :return: a dictionary of stocks and their net flows, in their shapes
+        """
+        changes = {stock: np.zeros(self.shapes.get(stock, ())) for stock in self.stocks}
+        for flow, stock, direction_factor in self.flow_stock_directions:
+            changes[stock] = changes[stock] + values[flow] * direction_factor
+        return changes
+
+    def net_flows(self, values, like):
+        """
+        Get the net flows into all stocks, as an array shaped like the array of stock values 'like'
+        """
+        if self.arrayed:
+            return self.pack_stocks(self.arrayed_net_flows(values))
+        batch_size = like.shape[1] if like.ndim > 1 else None
+        return self.incidence.dot(self.incidence.flow_vector(values, batch_size))
+
+    def run_step(self, result_store, dt, overrides=None, vectorized=False, integrator=None):
+        """
+        Take one step of a run, reading stocks from and recording all values to result_store
+        :param result_store: the ResultStore of this run
+        :param dt: time step
+        :param overrides: a dictionary of constants and the values used instead of their own
+        :param vectorized: if True, values are NumPy arrays and the vectorized functions are used
+        :param integrator: an integrator from integrators.py; None for explicit Euler
+        """
+        # stocks only provide their latest values; they are updated afterwards.
+        values = dict()
+        for stock in self.stocks:
+            values[stock] = result_store.latest(stock)
+        if overrides is not None:
+            values.update(overrides)
+
+        # calculate all flows, variables and parameters, each exactly once; arrayed values need the vectorized
+        # functions, like batch runs
+        vectorized = vectorized or self.arrayed
+        self.evaluate(values, vectorized, result_store.states, dt, result_store.steps)
+
+        if integrator is not None:
+            # constants and external data are held over the dt, so external data is read once per step
+            held = dict() if overrides is None else dict(overrides)
+            for name in self.evaluation_order:
+                if self.sfd.nodes[name]['external'] is True:
+                    held[name] = values[name]
+
+            def derivative(y):
+                stage_values = dict(held)
+                stage_values.update(zip(self.stocks, self.unpack_stocks(y)))
+                # delays are held over the dt, as their states are only updated once per dt
+                return self.net_flows(self.evaluate(stage_values, vectorized, result_store.states, dt), y)
+
+            y = self.pack_stocks(values)
+            y = integrator.step(derivative, y, dt, self.net_flows(values, y))
+            self.update_delays(result_store.states, values)
+            values.update(zip(self.stocks, self.unpack_stocks(y)))
+            result_store.write_step(values)
+            return
+
+        if self.arrayed:
+            # arrayed flows are added up stock by stock, each broadcast to the shape of its stock
+            changes = self.arrayed_net_flows(values)
+            self.update_delays(result_store.states, values)
+            for stock in self.stocks:
+                values[stock] = values[stock] + dt * changes[stock]
+            result_store.write_step(values)
+            return
+
+        # calculating changes in stocks, as one product of the incidence matrix and the flows
+        stocks_dt = self.incidence.dot(self.incidence.flow_vector(values, result_store.batch_size), dt)
+
+        # delays take the inputs of this dt
+        self.update_delays(result_store.states, values)
+
+        # updating stocks values; those not affected are extended by the same value as it is
+        for i, stock in enumerate(self.stocks):
+            values[stock] = values[stock] + stocks_dt[i]
+
+        result_store.write_step(values)
 
     def clear_a_run(self):
         """
         Clear values for all nodes
         :return:
         """
+        self.result_store = None
+        self.edited_elements = set()
         for node in self.sfd.nodes:
             if self.sfd.nodes[node]['element_type'] == STOCK:
-                self.sfd.nodes[node]['value'] = [self.sfd.nodes[node]['value'][0]]  # for stock, keep its initial value
+                if not self.has_initial_equation(node):
+                    self.sfd.nodes[node]['value'] = [self.sfd.nodes[node]['value'][0]]  # for stock, keep its initial value
             else:
                 if self.sfd.nodes[node]['function'] is None:  # it's a constant parameter
                     self.sfd.nodes[node]['value'] = [self.sfd.nodes[node]['value'][0]]
@@ -338,22 +1053,24 @@ class Structure(object):
             # print('SdEngine: reset value of', node, 'to', self.sfd.nodes[node]['value'])
 
     # Add elements on a stock-and-flow level (work with model file handlers)
-    def add_stock(self, name=None, equation=None, x=0, y=0):
+    def add_stock(self, name=None, equation=None, x=0, y=0, dimensions=None):
         """
         :param name: name of the stock
         :param equation: initial value
         :param x: x
         :param y: y
+        :param dimensions: names of the dimensions an arrayed stock has a value along; its initial value is then an
+        array along them (or one number for all entries)
         :return: uid of the stock
         """
-        uid = self.add_element(name, element_type=STOCK, x=x, y=y, value=equation)
+        uid = self.add_element(name, element_type=STOCK, x=x, y=y, value=equation, dimensions=dimensions)
         # print('SdEngine: added stock:', name, 'to graph.')
         return uid
 
-    def add_flow(self, name=None, equation=None, x=0, y=0, points=None, flow_from=None, flow_to=None):
+    def add_flow(self, name=None, equation=None, x=0, y=0, points=None, flow_from=None, flow_to=None, dimensions=None):
         # Decide if the 'equation' is a function or a constant number
         # if type(equation) in [int, float] or type(equation[0]) in [int, float]:  # TODO: need to refine: need []?
-        if type(equation[0]) in [int, float]:
+        if type(equation[0]) in [int, float, np.ndarray]:
             # if equation starts with a number
             function = None
             value = equation  # it's a constant
@@ -362,7 +1079,7 @@ class Structure(object):
             value = list()
         if name is None:
             name = self.name_manager.get_new_name(element_type=FLOW)
-        uid = self.add_element(name, element_type=FLOW, flow_from=flow_from, flow_to=flow_to, x=x, y=y, function=function, value=value, points=points)
+        uid = self.add_element(name, element_type=FLOW, flow_from=flow_from, flow_to=flow_to, x=x, y=y, function=function, value=value, points=points, dimensions=dimensions)
 
         self.create_stock_flow_connection(name, flow_from=flow_from, flow_to=flow_to)
         # print('SdEngine: added flow:', name, 'to graph.')
@@ -376,6 +1093,7 @@ class Structure(object):
         :param flow_to: The stock this flow going into
         :return:
         """
+        self.incidence = None
         # If the flow influences a stock, create the causal link
         if flow_from is not None:  # Just set up
             self.sfd.nodes[flow_name]['flow_from'] = flow_from
@@ -397,20 +1115,22 @@ class Structure(object):
         if self.sfd.nodes[flow_name]['flow_to'] == stock_name:
             self.sfd.remove_edge(flow_name, stock_name)
             self.sfd.nodes[flow_name]['flow_to'] = None
+        self.incidence = None
+        self.invalidate(stock_name)
 
-    def add_aux(self, name=None, equation=None, x=0, y=0):
+    def add_aux(self, name=None, equation=None, x=0, y=0, dimensions=None):
         # Decide if this aux is a parameter or variable
         # if type(equation) in [int, float] or type(equation[0]) in [int, float]:  # TODO: need to refine: need []?
-        if type(equation[0]) in [int, float]:  # TODO: need to refine: need []?
-            # if equation starts with a number, it's a parameter
+        if type(equation[0]) in [int, float, np.ndarray]:  # TODO: need to refine: need []?
+            # if equation starts with a number (or an array of them, for an arrayed aux), it's a parameter
             if name is None:
                 name = self.name_manager.get_new_name(element_type=PARAMETER)
-            uid = self.add_element(name, element_type=PARAMETER, x=x, y=y, function=None, value=equation)
+            uid = self.add_element(name, element_type=PARAMETER, x=x, y=y, function=None, value=equation, dimensions=dimensions)
         else:
             # It's a variable, has its own function
             if name is None:
                 name = self.name_manager.get_new_name(element_type=VARIABLE)
-            uid = self.add_element(name, element_type=VARIABLE, x=x, y=y, function=equation, value=list())
+            uid = self.add_element(name, element_type=VARIABLE, x=x, y=y, function=equation, value=list(), dimensions=dimensions)
             # Then it is assumed to take information from other variables, therefore causal links should be created.
             # Already implemented in structure's add_element function, not needed here.
             # for info_source_var in equation[1]:
@@ -422,6 +1142,8 @@ class Structure(object):
     def get_equation(self, name):
         if self.sfd.nodes[name]['element_type'] == STOCK:
             # if the node is a stock
+            if self.has_initial_equation(name):
+                return self.sfd.nodes[name]['value']
             return self.sfd.nodes[name]['value'][0]  # just return its first value (initial).
         elif self.sfd.nodes[name]['function'] is None:
             # if the node does not have a function and not a stock, then it's constant
@@ -446,10 +1168,12 @@ class Structure(object):
         for u, v in self.sfd.in_edges(name):
             print("In_edge found:", u, v)
             to_remove.append((u, v))
+            self.check_incidence(u, v)
         self.sfd.remove_edges_from(to_remove)
+        self.invalidate(name)
         print("SdEngine: Edges removed.")
         # step 2:
-        if type(new_equation[0]) is int or type(new_equation[0]) is float:
+        if type(new_equation[0]) in [int, float, np.ndarray]:
             # If equation starts with a number, it's a constant value
             self.sfd.nodes[name]['function'] = None
             self.sfd.nodes[name]['value'] = new_equation
@@ -458,6 +1182,7 @@ class Structure(object):
             # It's a variable, has its own function
             self.sfd.nodes[name]['function'] = new_equation
             self.sfd.nodes[name]['value'] = list()
+            self.add_run_variables(new_equation)
             print("SdEngine: Equation replaced.")
             # step 3:
             if new_equation is not None and type(new_equation) is not str:
@@ -467,12 +1192,20 @@ class Structure(object):
     # Add elements to a structure in a batch (something like a script)
     # Enable using of multi-dimensional arrays.
     def add_elements_batch(self, elements):
+        """
+        Add many elements at once
+        :param elements: lists of [element type, name, equation, flow_from, flow_to, x, y, points, dimensions];
+        dimensions may be left out. For a connector: [connector, angle, from, to, polarity]; for an alias:
+        [alias, uid, of element, None, None, x, y].
+        """
         for element in elements:
+            dimensions = element[8] if len(element) > 8 else None
             if element[0] == STOCK:
                 self.add_stock(name=element[1],
                                equation=element[2],
                                x=element[5],
-                               y=element[6],)
+                               y=element[6],
+                               dimensions=dimensions)
             elif element[0] == FLOW:
                 self.add_flow(name=element[1],
                               equation=element[2],
@@ -480,17 +1213,24 @@ class Structure(object):
                               flow_to=element[4],
                               x=element[5],
                               y=element[6],
-                              points=element[7])
+                              points=element[7],
+                              dimensions=dimensions)
             elif element[0] == PARAMETER or element[0] == VARIABLE:
                 self.add_aux(name=element[1],
                              equation=element[2],
                              x=element[5],
-                             y=element[6])
+                             y=element[6],
+                             dimensions=dimensions)
             elif element[0] == CONNECTOR:
                 self.add_connector(angle=element[1],
                                    from_element=element[2],
                                    to_element=element[3],
                                    polarity=element[4])
+            elif element[0] == ALIAS:
+                self.add_alias(uid=element[1],
+                               of_element=element[2],
+                               x=element[5],
+                               y=element[6])
 
     def add_alias(self, uid, of_element, x=0, y=0):
         self.add_element(uid, element_type=ALIAS, x=x, y=y, function=of_element)
@@ -502,7 +1242,12 @@ class Structure(object):
         :param name:
         :return:
         """
+        element_type = self.sfd.nodes[name]['element_type']
+        if element_type in [STOCK, FLOW]:
+            self.incidence = None
+        self.elements_by_type.get(element_type, dict()).pop(name, None)
         self.sfd.remove_node(name)
+        self.invalidate()
         print("SdEngine: {} is removed from the graph.".format(name))
 
     def add_connector(self, from_element, to_element, angle=0, polarity=None, display=True):
@@ -511,6 +1256,8 @@ class Structure(object):
 
     def delete_connector(self, from_element, to_element):
         self.sfd.remove_edge(from_element, to_element)
+        self.check_incidence(from_element, to_element)
+        self.invalidate(to_element)
 
     # Set the model to a first order negative feedback loop
     def first_order_negative(self):
@@ -570,26 +1317,506 @@ class Structure(object):
     # Reset a structure
     def reset_a_structure(self):
         self.sfd.clear()
+        self.elements_by_type = dict()
+        self.incidence = None
+        self.invalidate()
 
     # Simulate a structure based on a certain set of parameters
-    def simulate(self, simulation_time=0, dt=0.25):
+    def simulate(self, simulation_time=0, dt=None, backend='interpreter', method='euler', rtol=1e-6, atol=1e-9,
+                 guard=False, overflow_threshold=1e12, out=None, record=None, save_interval=None):
+        """
+        :param simulation_time: time to simulate; 0 for the default simulation time
+        :param dt: time step; None for the default time step
+        :param backend: 'interpreter' to step through the compiled evaluation order, or 'codegen' to run a step
+        function generated for this structure (faster when a structure is simulated many times, e.g. with different
+        parameters)
+        :param method: integration method, 'euler', 'rk2', 'rk4' or 'rk45' (adaptive). Results are reported every dt
+        with any method; the generated step function only does 'euler'.
+        :param rtol: relative tolerance for 'rk45'
+        :param atol: absolute tolerance for 'rk45'
+        :param guard: if True, the run is stopped at the first step where a value is NaN/inf or beyond
+        overflow_threshold, or a division by zero happens
+        :param overflow_threshold: largest absolute value allowed in a guarded run
+        :param out: a .npy file to store a new run in instead of memory, for runs too large for RAM. The run is
+        written every FLUSH_STEPS steps and at the end, with a JSON sidecar of element names and time axis; it can be
+        reopened with open_run().
+        :param record: names of the elements to record; None for all. The others are still calculated at every step,
+        but not kept.
+        :param save_interval: time between two recorded values, a multiple of dt; None for the default save interval
+        (every dt unless set, e.g. by the model file)
+        :return: a SimulationStatus for guarded runs, also kept in simulation_status
+        """
         # print('SdEngine: Simulating...')
+        if dt is None:
+            dt = self.default_dt
         if simulation_time == 0:
             # determine how many steps to run; if not specified, use maximum steps
-            total_steps = int(self.default_simulation_time / self.default_dt)
+            total_steps = int(self.default_simulation_time / dt)
         else:
             total_steps = int(simulation_time/dt)
 
+        integrator = self.start_run(total_steps, dt, method, rtol, atol, out=out, record=record,
+                                    save_every=self.save_every(save_interval, dt))
+        try:
+            return self.take_steps(total_steps, dt, integrator, backend, guard, overflow_threshold)
+        finally:
+            self.result_store.flush()
+
+    def save_every(self, save_interval, dt):
+        """
+        Get the number of steps between two recorded values
+        :param save_interval: time between two recorded values; None for the default save interval
+        """
+        if save_interval is None:
+            save_interval = self.default_save_interval
+        if save_interval is None:
+            return 1
+        steps = save_interval / dt
+        if round(steps) < 1 or abs(steps - round(steps)) > 1e-9 * steps:
+            raise ValueError("SdEngine: save interval {} is not a multiple of dt {}.".format(save_interval, dt))
+        return int(round(steps))
+
+    def take_steps(self, total_steps, dt, integrator, backend='interpreter', guard=False, overflow_threshold=1e12):
+        """
+        Take total_steps steps in the current run, see simulate()
+        """
+        if backend == 'codegen' and self.arrayed:
+            print("SdEngine: generated code does not handle arrayed elements; simulating with the interpreter.")
+        elif backend == 'codegen' and not self.result_store.records_all:
+            print("SdEngine: generated code records all elements at every step; simulating with the interpreter.")
+        elif backend == 'codegen':
+            if integrator is None:
+                self.simulation_status = self.run_generated(self.result_store, total_steps, dt,
+                                                            overflow_threshold if guard else None)
+                return self.simulation_status
+            print("SdEngine: generated code only integrates with 'euler'; simulating {} with the interpreter.".format(
+                self.run_settings['method']))
+
+        if guard:
+            self.simulation_status = self.run_guarded(self.result_store, total_steps, dt, integrator,
+                                                      overflow_threshold)
+            return self.simulation_status
+
         # main iteration
         for i in range(total_steps):
             # stock_behavior.append(structure0.sfd.nodes['stock0']['value'])
             # print('Step: {} '.format(i), end=' ')
-            self.step(dt)
+            self.run_step(self.result_store, dt, integrator=integrator)
+
+    def start_run(self, total_steps, dt, method='euler', rtol=1e-6, atol=1e-9, out=None, record=None,
+                  save_every=1):
+        """
+        Get ready to take total_steps steps: compile the structure and start a new run, or make room to continue
+        the current one
+        :param out: a .npy file to store a new run in, see simulate()
+        :param record: names of the elements to record; None for all
+        :param save_every: number of steps between two recorded values
+        :return: the integrator of the run
+        """
+        # the structure may have been edited in place since the last run, so compile it again (once per run)
+        self.compile()
+        # a run reopened from disk is read-only, so it is not continued
+        if out is not None or self.result_store is None or \
+                self.result_store.elements != self.stocks + self.evaluation_order or \
+                self.result_store.record != record or self.result_store.save_every != save_every or \
+                not self.result_store.values.flags.writeable:
+            self.result_store = self.new_result_store(n_steps=total_steps, path=out, record=record,
+                                                      save_every=save_every)
+            self.edited_elements = set()
+        else:  # continue the current run
+            self.result_store.reserve(self.result_store.steps + total_steps)
+        self.run_settings = {'dt': dt, 'method': method, 'rtol': rtol, 'atol': atol,
+                             'start': self.default_start_time}
+        self.result_store.run_settings = self.run_settings
+        return self.new_integrator(method, rtol, atol)
+
+    def iter_steps(self, simulation_time=0, dt=None, every=1, method='euler', rtol=1e-6, atol=1e-9):
+        """
+        Simulate step by step. Every 'every' steps, and after the last step, the number of steps taken in the run so
+        far and the state (see get_state()) are yielded.
+        The run is paused between two yields and resumed by asking for the next one; it can be stopped early by not
+        asking again or by closing the generator. Either way, the steps taken are in the run as with simulate().
+        :param simulation_time: time to simulate; 0 for the default simulation time
+        :param dt: time step; None for the default time step
+        :param every: number of steps between two yields
+        :param method: integration method, see simulate()
+        """
+        if dt is None:
+            dt = self.default_dt
+        if simulation_time == 0:
+            total_steps = int(self.default_simulation_time / dt)
+        else:
+            total_steps = int(simulation_time/dt)
+
+        integrator = self.start_run(total_steps, dt, method, rtol, atol)
+        for i in range(total_steps):
+            # the structure may be edited while the run is paused; step() compiles it again if so
+            self.step(dt, integrator=integrator)
+            if (i + 1) % every == 0 or i + 1 == total_steps:
+                yield self.result_store.steps, self.get_state()
+
+    def get_state(self):
+        """
+        Get the latest values of all elements in the current run
+        :return: a dictionary of element names and values
+        """
+        if self.result_store is None:
+            return dict()
+        return {name: self.result_store.latest(name) for name in self.result_store.elements}
+
+    def new_integrator(self, method='euler', rtol=1e-6, atol=1e-9):
+        """
+        Create the integrator of a run
+        :param method: 'euler', 'rk2', 'rk4' or 'rk45'
+        :return: an integrator, or None for explicit Euler, which run_step does itself
+        """
+        if method == 'euler':
+            return None
+        if method not in integrators:
+            raise ValueError("SdEngine: unknown integration method {}; use one of {}.".format(
+                method, ['euler'] + list(integrators.keys())))
+        if method == 'rk45':
+            return integrators[method](rtol=rtol, atol=atol)
+        return integrators[method]()
+
+    def simulate_batch(self, param_matrix, parameter_names=None, simulation_time=0, dt=None, method='euler',
+                       record=None, save_interval=None):
+        """
+        Simulate many scenarios of this structure in lock-step. Every value in the run is held as a vector with one
+        entry per scenario, so each step is a handful of NumPy operations regardless of the number of scenarios.
+        :param param_matrix: an (N x n_params) array; row i holds the parameter values of scenario i
+        :param parameter_names: names of the elements the columns are for. Parameters, constant flows and stocks
+        (whose initial values are then replaced) can be used. Defaults to all parameters, in the order of
+        all_certain_type(PARAMETER).
+        :param simulation_time: time to simulate; 0 for the default simulation time
+        :param dt: time step; None for the default time step
+        :param method: integration method, see simulate(). With 'rk45', all scenarios share the internal step size.
+        :param record: names of the elements to record; None for all
+        :param save_interval: time between two recorded values, see simulate()
+        :return: a ResultStore with a batch axis; its get(name) gives an (N x n_values) array
+        """
+        if parameter_names is None:
+            parameter_names = self.all_certain_type(PARAMETER)
+        param_matrix = np.asarray(param_matrix, dtype=float)
+        if param_matrix.ndim == 1:  # a single parameter
+            param_matrix = param_matrix.reshape(-1, 1)
+        if param_matrix.shape[1] != len(parameter_names):
+            raise ValueError("SdEngine: param_matrix has {} columns for {} parameters.".format(param_matrix.shape[1],
+                                                                                            len(parameter_names)))
+
+        if dt is None:
+            dt = self.default_dt
+        if simulation_time == 0:
+            total_steps = int(self.default_simulation_time / dt)
+        else:
+            total_steps = int(simulation_time/dt)
+
+        self.compile()
+        overrides = dict()  # constants replaced in every step
+        initial_overrides = dict()
+        for j, name in enumerate(parameter_names):
+            initial_overrides[name] = param_matrix[:, j]
+            if self.sfd.nodes[name]['element_type'] != STOCK:
+                overrides[name] = param_matrix[:, j]
+
+        result_store = self.new_result_store(n_steps=total_steps, batch_size=param_matrix.shape[0],
+                                             overrides=initial_overrides, record=record,
+                                             save_every=self.save_every(save_interval, dt))
+        integrator = self.new_integrator(method)
+        for i in range(total_steps):
+            self.run_step(result_store, dt, overrides=overrides, vectorized=True, integrator=integrator)
+        return result_store
+
+    def monte_carlo(self, distributions, n_runs, seed=None, simulation_time=0, dt=None, method='euler',
+                    latin_hypercube=False, percentiles=(5, 50, 95), names=None, save_interval=None, chunk_size=200):
+        """
+        Simulate this structure with parameter values sampled from distributions, and summarize the runs.
+        The runs are done chunk_size at a time with simulate_batch(); after each chunk, the mean, variance and
+        percentiles of every element at every step are updated and the chunk is dropped, so memory depends on
+        chunk_size, not on n_runs.
+        :param distributions: a dictionary of parameter names and distributions: ('uniform', low, high),
+        ('normal', mean, standard deviation) or ('triangular', left, mode, right). Parameters, constant flows and
+        stocks can be sampled, as in simulate_batch().
+        :param n_runs: number of runs
+        :param seed: seed of the random numbers, for repeatable results
+        :param simulation_time: time to simulate; 0 for the default simulation time
+        :param dt: time step; None for the default time step
+        :param method: integration method, see simulate()
+        :param latin_hypercube: if True, sample with a Latin hypercube instead of independently
+        :param percentiles: percentiles to estimate (P-square estimates); empty to skip them, which is faster
+        :param names: elements to summarize; by default all. Only these are recorded in the runs.
+        :param save_interval: time between two summarized values, see simulate()
+        :param chunk_size: number of runs simulated at a time
+        :return: a MonteCarloResult
+        """
+        rng = np.random.default_rng(seed)
+        samples = sample_parameters(distributions, n_runs, rng, latin_hypercube)
+        parameter_names = list(distributions.keys())
+
+        moments = quantiles = result_store = rows = None
+        for start in range(0, n_runs, chunk_size):
+            result_store = self.simulate_batch(samples[start:start + chunk_size], parameter_names, simulation_time,
+                                               dt, method, record=names, save_interval=save_interval)
+            if rows is None:
+                if names is None:
+                    names = result_store.names
+                rows = [result_store.index[name] for name in names]
+                moments = StreamingMoments((len(rows), result_store.values.shape[-1]))
+                if len(percentiles) > 0:
+                    quantiles = P2Quantiles(moments.mean.shape, np.asarray(percentiles, dtype=float) / 100)
+            chunk = result_store.values[:, rows, :]
+            moments.update(chunk)
+            if quantiles is not None:
+                quantiles.update(chunk)
+        if result_store is None:
+            raise ValueError("SdEngine: a Monte Carlo needs at least one run.")
+        return MonteCarloResult(result_store, names, samples, moments, quantiles, percentiles)
+
+    def to_xmile(self, path, model_name='model'):
+        """
+        Write this structure to an XMILE (.stmx) file, which read_xmile_model() can load again
+        :param path: the file to write
+        :param model_name: name in the header of the file
+        """
+        from StockAndFlowInPython.parsing.xmile_writer import write_xmile
+        write_xmile(self, path, model_name=model_name)
+
+    # Serialization for simulation elsewhere
+    def to_spec(self):
+        """
+        Get a compact, picklable description of what simulating this structure needs: the elements with their
+        functions and (initial) values, the stock-flow connections and the simulation defaults (start time, dt,
+        simulation time and save interval). Layout, uids and connectors are left out. The DataFeeder is included if
+        there is external data; see DataFeeder.share() to send it without copying.
+        :return: a spec, see structure_from_spec()
+        """
+        elements = list()
+        external_data = None
+        for name, attributes in self.sfd.nodes.data():
+            value = attributes['value']
+            if type(value) == list and attributes['element_type'] != ALIAS and not self.has_initial_equation(name):
+                value = value[-1:]  # stocks and constants only need their latest (initial) value
+            elements.append((name, attributes['element_type'], attributes['flow_from'], attributes['flow_to'],
+                             attributes['function'], value, attributes['external'], attributes.get('dimensions')))
+            if attributes['external'] is True:
+                external_data = self.data_feeder
+        # the defaults of the run, e.g. the start time, at which external data is looked up
+        sim_specs = (self.default_start_time, self.default_dt, self.default_simulation_time,
+                     self.default_save_interval)
+        return elements, external_data, self.dimensions, sim_specs
+
+    def set_result(self, result):
+        """
+        Take a run done elsewhere (see simulation_pool) as the current run
+        :param result: a SimulationResult of this structure
+        """
+        self.result_store = result.result_store
+        self.simulation_status = result.status
+        self.run_settings = result.run_settings
+        self.edited_elements = set()
+
+    def open_run(self, path):
+        """
+        Take a run stored on disk (see simulate(out=...)) as the current run, without simulating it again. Its
+        values are read from the file when asked for. The run is read-only: simulating starts a new run.
+        :param path: the .npy file of the run
+        """
+        result_store = open_result_store(path)
+        if not set(result_store.names).issubset(self.sfd.nodes):
+            raise ValueError("SdEngine: the run in {} is not a run of this structure.".format(path))
+        self.result_store = result_store
+        self.simulation_status = None
+        self.run_settings = result_store.run_settings
+        self.edited_elements = set()
+
+    # Checkpoints and what-if runs
+    def checkpoint(self, step=None):
+        """
+        Capture the current run at a step: the behavior up to it (and so the values of stocks) and the states of
+        delays.
+        :param step: the step to capture; by default the latest
+        :return: a Checkpoint
+        """
+        if self.result_store is None or self.result_store.batch_size is not None:
+            raise ValueError("SdEngine: there is no run to checkpoint.")
+        if not self.result_store.records_all:
+            raise ValueError("SdEngine: a checkpoint needs a run recording all elements at every step.")
+        result_store = self.result_store
+        if step is None:
+            step = result_store.steps
+        if not 0 <= step <= result_store.steps:
+            raise ValueError("SdEngine: step {} is not in the run of {} steps.".format(step, result_store.steps))
+
+        history = result_store.new_like(n_steps=step)
+        history.values[:, :] = result_store.values[:, :step + 1]
+        history.steps = step
+        if step == result_store.steps:
+            history.states = copy.deepcopy(result_store.states)
+        else:  # replayed up to the step
+            history.states = self.restore_states(history, self.run_settings['dt'])
+        return Checkpoint(history, dict(self.run_settings), result_store.steps)
+
+    def fork(self, checkpoint, overrides=None, simulation_time=0):
+        """
+        Run a what-if scenario from a checkpoint, without taking the steps before it again. The current run is not
+        affected, so any number of scenarios can be forked from the same checkpoint.
+        :param checkpoint: a Checkpoint of this structure
+        :param overrides: a dictionary of constants and the values they take from the checkpoint on, and of stocks
+        and their values at the checkpoint
+        :param simulation_time: time to simulate from the checkpoint; 0 to end where the captured run ended
+        :return: a ResultStore of the scenario, with the behavior before the checkpoint included
+        """
+        self.compile()
+        history = checkpoint.history
+        if history.names != self.stocks + self.evaluation_order:
+            raise ValueError("SdEngine: the structure has been changed since the checkpoint.")
+        dt = checkpoint.run_settings['dt']
+        if simulation_time == 0:
+            total_steps = checkpoint.run_steps - checkpoint.step
+        else:
+            total_steps = int(simulation_time/dt)
+
+        result_store = history.new_like(n_steps=checkpoint.step + total_steps)
+        result_store.values[:, :checkpoint.step + 1] = history.values
+        result_store.steps = checkpoint.step
+        result_store.states = copy.deepcopy(history.states)  # so that more scenarios can be forked
+        overrides = dict() if overrides is None else dict(overrides)
+        for name in list(overrides.keys()):
+            if self.sfd.nodes[name]['element_type'] == STOCK:
+                value = overrides.pop(name)
+                if name in self.shapes:
+                    value = self.arrayed_value(name, value).ravel()
+                result_store.values[result_store.rows[name], checkpoint.step] = value
+        for name in overrides:
+            if name in self.shapes:
+                overrides[name] = self.arrayed_value(name, overrides[name])
+
+        integrator = self.new_integrator(checkpoint.run_settings['method'], checkpoint.run_settings['rtol'],
+                                         checkpoint.run_settings['atol'])
+        for i in range(total_steps):
+            self.run_step(result_store, dt, overrides=overrides, integrator=integrator)
+        return result_store
+
+    # Edit and re-simulate
+    def set_value(self, name, value):
+        """
+        Set the value of a constant, or the initial value of a stock, keeping the current run for resimulate()
+        """
+        self.sfd.nodes[name]['value'] = [value]
+        self.edited_elements.add(name)
+
+    def get_downstream(self, names):
+        """
+        Get the downstream cone of some elements: themselves and every element they influence, directly or not,
+        following the compiled function arguments and stock-flow connections
+        """
+        if self.evaluation_order is None:
+            self.compile()
+        cone = set(names)
+        for name in names:
+            if name in self.influences:
+                cone.update(nx.descendants(self.influences, name))
+        return cone
+
+    def resimulate(self):
+        """
+        Bring the current run up to date with the elements edited since it was simulated (by replace_equation(),
+        set_value() etc.), over the same time steps. Only the downstream cone of the edited elements is calculated
+        again; everything outside it keeps its recorded values.
+        Changes that add or remove elements, turn a constant into a function or the other way round, make an element
+        external, a run not integrated with Euler, arrayed elements or stocks with initial equations lead to a full
+        run instead, as does a read-only run (see open_run()), which is then run again in a new result store.
+        :return: names of the elements calculated again
+        """
+        edited = [name for name in self.edited_elements if name in self.sfd]
+        self.edited_elements = set()
+        if self.result_store is None:
+            return list()
+        result_store = self.result_store
+        dt = self.run_settings['dt']
+
+        self.compile()
+        cone = self.get_downstream(edited)
+        externals = [name for name in cone if self.sfd.nodes[name]['external'] is True]
+        same_elements = set(result_store.names) == set(self.stocks + self.evaluation_order)
+        if same_elements:
+            # e.g. a constant that became a function has no column for its initial value in the recorded run
+            index = result_store.index
+            same_elements = all(result_store.has_initial[index[name]] == int(self.has_initial_value(name))
+                                for name in result_store.names)
+        if not same_elements or len(externals) > 0 or \
+                self.run_settings['method'] != 'euler' or self.arrayed or not result_store.records_all or \
+                not result_store.values.flags.writeable or len(self.initial_equations) > 0:
+            print("SdEngine: Simulating the whole structure again.")
+            record = None if result_store.record is None else [name for name in result_store.record
+                                                               if name in self.sfd.nodes]
+            self.result_store = self.new_result_store(n_steps=result_store.steps, record=record,
+                                                      save_every=result_store.save_every)
+            self.result_store.run_settings = self.run_settings
+            integrator = self.new_integrator(self.run_settings['method'], self.run_settings['rtol'],
+                                             self.run_settings['atol'])
+            for i in range(result_store.steps):
+                self.run_step(self.result_store, dt, integrator=integrator)
+            return list(self.result_store.elements)
+
+        order = [name for name in self.evaluation_order if name in cone]
+        stocks = [stock for stock in self.stocks if stock in cone]
+        flow_stock_directions = [direction for direction in self.flow_stock_directions if direction[1] in cone]
+        # values outside the cone that are needed, read from the recorded run
+        inputs = list()
+        for name in order:
+            if self.sfd.nodes[name]['function'] is not None:
+                inputs += [argument for argument in self.sfd.nodes[name]['function'][1:]
+                           if type(argument) == str and argument not in cone]
+        inputs += [flow for flow, stock, direction_factor in flow_stock_directions if flow not in cone]
+        inputs = set(inputs)
+
+        index = result_store.index
+        values_array = result_store.values
+        for name in stocks + order:
+            if result_store.has_initial[index[name]] == 1:
+                values_array[index[name], 0] = self.sfd.nodes[name]['value'][-1]
+        # delays in the cone are run again from the start
+        delays = [name for name in self.delay_elements if name in cone]
+        states = dict()
+        for k in range(result_store.steps):
+            # column k holds the values of stocks before step k and the values calculated in step k
+            values = {name: values_array[index[name], k] for name in inputs}
+            for stock in stocks:
+                values[stock] = values_array[index[stock], k]
+            for name in order:
+                values[name] = self.calculate(name, values, states=states, dt=dt, step=k)
+                values_array[index[name], k + result_store.has_initial[index[name]]] = values[name]
+            self.update_delays(states, values, delays)
+            # same order of operations as run_step
+            stocks_dt = dict()
+            for stock in stocks:
+                stocks_dt[stock] = 0
+            for flow, stock, direction_factor in flow_stock_directions:
+                stocks_dt[stock] += dt * values[flow] * direction_factor
+            for stock in stocks:
+                values_array[index[stock], k + 1] = values[stock] + stocks_dt[stock]
+        result_store.states.update(states)
+        return stocks + order
 
     # Return a behavior
     def get_behavior(self, name):
-        # print(self.structures[structure_name].sfd.nodes[name]['value'])
-        return self.sfd.nodes[name]['value']
+        """
+        Get the behavior of an element in the current run, as a view into the result array (no copy).
+        Before a run, or for elements that are not simulated (e.g. aliases), the element's value is returned.
+        """
+        if self.result_store is None or name not in self.result_store.index:
+            return self.sfd.nodes[name]['value']
+        return self.result_store.get(name)
+
+    def get_behavior_list(self, name):
+        """
+        Get the behavior of an element as a list of floats, for code that expects the former value lists.
+        """
+        behavior = self.get_behavior(name)
+        if behavior is None:
+            return None
+        return [float(value) for value in behavior]
 
     # Draw results
     def display_results(self, names=None, rtn=False):
@@ -608,10 +1835,10 @@ class Structure(object):
         y_axis_minimum = 0
         y_axis_maximum = 0
         for name in names:
-            if self.sfd.nodes[name]['external'] is True:
-                values = self.data_feeder.buffers_list[name]
-            elif self.sfd.nodes[name]['value'] is not None:  # otherwise, dont's plot
-                values = self.sfd.nodes[name]['value']
+            if self.sfd.nodes[name]['external'] is True and name not in run_variables:
+                values = self.data_feeder.columns[name]
+            elif self.get_behavior(name) is not None:  # otherwise, dont's plot
+                values = self.get_behavior(name)
             else:
                 continue  # no value found for this variable
             # print("SdEngine: getting min/max for", name)
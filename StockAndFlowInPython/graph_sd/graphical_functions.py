@@ -0,0 +1,67 @@
+"""
+Graphical functions (lookup tables) for Graph-SD.
+
+In a structure a graphical function is used like the other functions: [graphical_function, argument, ...]. Its
+input is the argument, or, if it has an input function, that function of the arguments. The output is looked up in
+the table with np.interp / np.searchsorted, so a batch of scenarios is looked up in one call.
+"""
+import numpy as np
+
+
+CONTINUOUS = 'continuous'
+EXTRAPOLATE = 'extrapolate'
+DISCRETE = 'discrete'
+
+
+class GraphicalFunction(object):
+    """
+    A lookup table of points (x, y), with the XMILE ways of reading it:
+    'continuous': linear interpolation, keeping the first/last y outside the table;
+    'extrapolate': linear interpolation, extending the first/last segment outside the table;
+    'discrete': the y of the last point whose x is not above the input (the first y below the table).
+    """
+    def __init__(self, xpts, ypts, gf_type=CONTINUOUS, input_function=None):
+        """
+        :param xpts: x of the points, ascending
+        :param ypts: y of the points
+        :param gf_type: 'continuous', 'extrapolate' or 'discrete'
+        :param input_function: a function of the arguments giving the input; None to take the only argument
+        """
+        self.xpts = np.asarray(xpts, dtype=float)
+        self.ypts = np.asarray(ypts, dtype=float)
+        if self.xpts.ndim != 1 or self.xpts.shape != self.ypts.shape or len(self.xpts) == 0:
+            raise ValueError("SdEngine: a graphical function needs as many x as y points, got {} and {}.".format(
+                len(self.xpts), len(self.ypts)))
+        if np.any(np.diff(self.xpts) < 0):
+            raise ValueError("SdEngine: x points of a graphical function must be ascending.")
+        if gf_type not in [CONTINUOUS, EXTRAPOLATE, DISCRETE]:
+            raise ValueError("SdEngine: unknown type of graphical function {}.".format(gf_type))
+        self.gf_type = gf_type
+        self.input_function = input_function
+        if len(self.xpts) > 1 and self.xpts[-1] > self.xpts[0]:
+            self.first_slope = (self.ypts[1] - self.ypts[0]) / (self.xpts[1] - self.xpts[0])
+            self.last_slope = (self.ypts[-1] - self.ypts[-2]) / (self.xpts[-1] - self.xpts[-2])
+        else:
+            self.first_slope = self.last_slope = 0.0
+
+    def __call__(self, *arguments):
+        x = arguments[0] if self.input_function is None else self.input_function(*arguments)
+        return self.lookup(x)
+
+    def lookup(self, x):
+        """
+        :param x: a number, or an array of them (e.g. one per scenario)
+        :return: y, a float or an array shaped like x
+        """
+        if self.gf_type == DISCRETE:
+            i = np.clip(np.searchsorted(self.xpts, x, side='right') - 1, 0, len(self.xpts) - 1)
+            y = self.ypts[i]
+        else:
+            y = np.interp(x, self.xpts, self.ypts)
+            if self.gf_type == EXTRAPOLATE:
+                y = np.where(x < self.xpts[0], self.ypts[0] + (x - self.xpts[0]) * self.first_slope, y)
+                y = np.where(x > self.xpts[-1], self.ypts[-1] + (x - self.xpts[-1]) * self.last_slope, y)
+        return float(y) if np.ndim(y) == 0 else y
+
+    def __repr__(self):
+        return 'GRAPH({} points, {})'.format(len(self.xpts), self.gf_type)
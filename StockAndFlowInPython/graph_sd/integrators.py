@@ -0,0 +1,93 @@
+"""
+Integrators for Graph-SD: higher-order and adaptive methods to advance stocks over one dt.
+
+Stocks are handled as one array y (one row per stock, with a batch axis in batch runs); derivative(y) returns the net
+flows into the stocks when they have the values y. Explicit Euler is not here, as Structure.run_step does it directly.
+"""
+import numpy as np
+
+
+class RK2(object):
+    """
+    Heun's method (explicit trapezoidal rule), 2 evaluations per dt
+    """
+    def step(self, derivative, y, dt, k1):
+        """
+        Advance y over dt
+        :param derivative: function of y, giving the net flows into the stocks
+        :param y: values of the stocks at the start of dt
+        :param dt: time step
+        :param k1: derivative(y), already calculated for the recorded values of this step
+        :return: values of the stocks at the end of dt
+        """
+        k2 = derivative(y + dt * k1)
+        return y + dt / 2 * (k1 + k2)
+
+
+class RK4(object):
+    """
+    Classic 4th order Runge-Kutta, 4 evaluations per dt
+    """
+    def step(self, derivative, y, dt, k1):
+        k2 = derivative(y + dt / 2 * k1)
+        k3 = derivative(y + dt / 2 * k2)
+        k4 = derivative(y + dt * k3)
+        return y + dt / 6 * (k1 + 2 * k2 + 2 * k3 + k4)
+
+
+class RK45(object):
+    """
+    Dormand-Prince 5(4) with error control. Each dt is covered by as many internal steps as the tolerances need, so
+    results are still reported on the grid of dt. The internal step size is carried on from one dt to the next.
+    """
+    c = [0, 1 / 5, 3 / 10, 4 / 5, 8 / 9, 1, 1]
+    a = [[],
+         [1 / 5],
+         [3 / 40, 9 / 40],
+         [44 / 45, -56 / 15, 32 / 9],
+         [19372 / 6561, -25360 / 2187, 64448 / 6561, -212 / 729],
+         [9017 / 3168, -355 / 33, 46732 / 5247, 49 / 176, -5103 / 18656],
+         [35 / 384, 0, 500 / 1113, 125 / 192, -2187 / 6784, 11 / 84]]
+    b = [35 / 384, 0, 500 / 1113, 125 / 192, -2187 / 6784, 11 / 84, 0]  # 5th order, same as the last row of a
+    b_star = [5179 / 57600, 0, 7571 / 16695, 393 / 640, -92097 / 339200, 187 / 2100, 1 / 40]  # 4th order
+
+    def __init__(self, rtol=1e-6, atol=1e-9):
+        """
+        :param rtol: relative tolerance of the local error
+        :param atol: absolute tolerance of the local error
+        """
+        self.rtol = rtol
+        self.atol = atol
+        self.h = None  # internal step size, proposed by the last accepted step
+        self.evaluations = 0
+
+    def step(self, derivative, y, dt, k1):
+        h = dt if self.h is None else self.h
+        min_h = dt * 1e-6
+        t = 0
+        while t < dt:
+            h_used = min(h, dt - t)
+            k = [k1]
+            for i in range(1, 7):
+                k.append(derivative(y + h_used * sum(a_ij * k_j for a_ij, k_j in zip(self.a[i], k))))
+            self.evaluations += 6
+            y_new = y + h_used * sum(b_i * k_i for b_i, k_i in zip(self.b, k))
+            error = h_used * sum((b_i - b_star_i) * k_i for b_i, b_star_i, k_i in zip(self.b, self.b_star, k))
+            scale = self.atol + self.rtol * np.maximum(np.abs(y), np.abs(y_new))
+            error_norm = np.max(np.abs(error) / scale) if np.size(error) > 0 else 0.0
+
+            if error_norm <= 1 or h_used <= min_h:
+                # accepted; at the smallest step size it is accepted anyway, so that a run always finishes
+                t += h_used
+                y = y_new
+                k1 = k[6]  # first same as last
+                factor = 5 if error_norm == 0 else min(5, 0.9 * error_norm ** -0.2)
+            else:
+                factor = max(0.2, 0.9 * error_norm ** -0.2) if np.isfinite(error_norm) else 0.2
+            if h_used == h or factor < 1:  # don't let a step shortened to reach the grid shrink the next one
+                h = max(h_used * factor, min_h)
+        self.h = h
+        return y
+
+
+integrators = {'rk2': RK2, 'rk4': RK4, 'rk45': RK45}
@@ -0,0 +1,203 @@
+"""
+Monte Carlo for Graph-SD: sampling parameter values, and summary statistics of many runs kept up to date run by run,
+so that memory does not grow with the number of runs. See Structure.monte_carlo().
+"""
+from statistics import NormalDist
+import numpy as np
+
+
+UNIFORM = 'uniform'
+NORMAL = 'normal'
+TRIANGULAR = 'triangular'
+
+
+def inverse_cdf(distribution, u):
+    """
+    Turn probabilities into values of a distribution
+    :param distribution: ('uniform', low, high), ('normal', mean, standard deviation) or
+    ('triangular', left, mode, right)
+    :param u: an array of probabilities in [0, 1)
+    :return: an array of values
+    """
+    kind, parameters = distribution[0], [float(parameter) for parameter in distribution[1:]]
+    if kind == UNIFORM:
+        low, high = parameters
+        return low + u * (high - low)
+    elif kind == NORMAL:
+        normal = NormalDist(*parameters)
+        return np.array([normal.inv_cdf(p) for p in np.clip(u, 1e-16, 1 - 1e-16)])
+    elif kind == TRIANGULAR:
+        left, mode, right = parameters
+        width = right - left
+        lower = u < (mode - left) / width if width > 0 else np.ones(len(u), dtype=bool)
+        return np.where(lower,
+                        left + np.sqrt(u * width * (mode - left)),
+                        right - np.sqrt((1 - u) * width * (right - mode)))
+    raise ValueError("SdEngine: unknown distribution {}; use one of {}.".format(kind, [UNIFORM, NORMAL, TRIANGULAR]))
+
+
+def sample_parameters(distributions, n_runs, rng, latin_hypercube=False):
+    """
+    Sample parameter values for n_runs runs
+    :param distributions: a dictionary of parameter names and distributions, see inverse_cdf()
+    :param rng: a numpy.random.Generator
+    :param latin_hypercube: if True, the range of probabilities of each parameter is cut into n_runs equal strata
+    and every stratum is sampled once, in a random order
+    :return: an (n_runs x n_parameters) array, columns in the order of distributions
+    """
+    samples = np.empty((n_runs, len(distributions)))
+    for j, distribution in enumerate(distributions.values()):
+        if latin_hypercube:
+            u = (rng.permutation(n_runs) + rng.random(n_runs)) / n_runs
+        else:
+            u = rng.random(n_runs)
+        samples[:, j] = inverse_cdf(distribution, u)
+    return samples
+
+
+class StreamingMoments(object):
+    """
+    Mean and variance of every cell of an array over runs, updated a chunk of runs at a time (Welford's algorithm,
+    in the form of Chan et al. for merging chunks)
+    """
+    def __init__(self, shape):
+        self.count = 0
+        self.mean = np.zeros(shape)
+        self.m2 = np.zeros(shape)  # sum of squared differences from the mean
+
+    def update(self, chunk):
+        """
+        :param chunk: an array of runs, shaped (n_runs,) + shape
+        """
+        n = len(chunk)
+        if n == 0:
+            return
+        chunk_mean = chunk.mean(axis=0)
+        chunk_m2 = ((chunk - chunk_mean) ** 2).sum(axis=0)
+        total = self.count + n
+        delta = chunk_mean - self.mean
+        self.mean = self.mean + delta * (n / total)
+        self.m2 = self.m2 + chunk_m2 + delta ** 2 * (self.count * n / total)
+        self.count = total
+
+    def variance(self, ddof=1):
+        if self.count <= ddof:
+            return np.full(self.mean.shape, np.nan)
+        return self.m2 / (self.count - ddof)
+
+
+class P2Quantiles(object):
+    """
+    Estimates of quantiles of every cell of an array over runs, with the P-square algorithm (Jain & Chlamtac, 1985):
+    each quantile of each cell is followed by 5 markers, whatever the number of runs.
+    """
+    def __init__(self, shape, quantiles):
+        """
+        :param shape: shape of the array
+        :param quantiles: quantiles to estimate, in [0, 1]
+        """
+        self.quantiles = np.asarray(quantiles, dtype=float)
+        self.shape = (len(self.quantiles),) + tuple(shape)
+        p = self.quantiles.reshape((-1,) + (1,) * len(shape))
+        self.increments = [0, p / 2, p, (1 + p) / 2, 1]
+        self.first = list()  # the first observations, until there are 5 to place the markers
+        self.heights = None  # for each marker, an array shaped (n_quantiles,) + shape
+        self.positions = None
+        self.desired = None
+
+    def update(self, chunk):
+        """
+        :param chunk: an array of runs, shaped (n_runs,) + shape
+        """
+        for x in chunk:
+            if self.heights is None:
+                self.first.append(np.array(x, dtype=float))
+                if len(self.first) == 5:
+                    self.start()
+            else:
+                self.add(x)
+
+    def start(self):
+        first = np.sort(np.stack(self.first), axis=0)
+        self.heights = [np.broadcast_to(height, self.shape).copy() for height in first]
+        self.positions = [np.full(self.shape, i + 1.0) for i in range(5)]
+        self.desired = [np.broadcast_to(1 + 4 * increment, self.shape).copy() for increment in self.increments]
+
+    def add(self, x):
+        q, n = self.heights, self.positions
+        np.minimum(q[0], x, out=q[0])
+        np.maximum(q[4], x, out=q[4])
+        for i in range(1, 5):  # markers above x move up one position
+            n[i] += x < q[i] if i < 4 else 1
+        for i in range(1, 4):
+            self.desired[i] += self.increments[i]
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for i in range(1, 4):
+                d = self.desired[i] - n[i]
+                up = (d >= 1) & (n[i + 1] - n[i] > 1)
+                down = (d <= -1) & (n[i - 1] - n[i] < -1)
+                move = np.flatnonzero(up | down)
+                if len(move) == 0:
+                    continue
+                qi, qa, qb = q[i].flat[move], q[i + 1].flat[move], q[i - 1].flat[move]
+                ni, na, nb = n[i].flat[move], n[i + 1].flat[move], n[i - 1].flat[move]
+                sign = np.where(up.flat[move], 1.0, -1.0)
+                # piecewise-parabolic prediction, or linear if it leaves the neighbouring markers
+                parabolic = qi + sign / (na - nb) * ((ni - nb + sign) * (qa - qi) / (na - ni) +
+                                                     (na - ni - sign) * (qi - qb) / (ni - nb))
+                linear = qi + np.where(sign > 0, (qa - qi) / (na - ni), (qb - qi) / (ni - nb))
+                q[i].flat[move] = np.where((qb < parabolic) & (parabolic < qa), parabolic, linear)
+                n[i].flat[move] = ni + sign
+
+    def estimates(self):
+        """
+        :return: an array shaped (n_quantiles,) + shape
+        """
+        if self.heights is None:  # fewer than 5 runs: the quantiles of what there is
+            if len(self.first) == 0:
+                return np.full(self.shape, np.nan)
+            return np.quantile(np.stack(self.first), self.quantiles, axis=0)
+        return self.heights[2].copy()
+
+
+class MonteCarloResult(object):
+    """
+    Summary of the runs of a Monte Carlo: per element and per step, the mean, variance and percentiles of its
+    values over the runs
+    """
+    def __init__(self, result_store, names, samples, moments, quantiles, percentiles):
+        """
+        :param result_store: a ResultStore of the runs, giving the names and number of values of the elements
+        :param names: the elements summarized, in row order of the statistics
+        :param samples: the sampled parameter values, one row per run
+        :param moments: a StreamingMoments
+        :param quantiles: a P2Quantiles, or None
+        :param percentiles: the percentiles estimated
+        """
+        self.names = names
+        self.index = {name: i for i, name in enumerate(names)}
+        self.lengths = {name: result_store.length(name) for name in names}
+        self.samples = samples
+        self.n_runs = moments.count
+        self.moments = moments
+        self.percentiles = list(percentiles)
+        self.percentile_values = quantiles.estimates() if quantiles is not None else None
+
+    def mean(self, name):
+        return self.moments.mean[self.index[name], :self.lengths[name]]
+
+    def variance(self, name):
+        return self.moments.variance()[self.index[name], :self.lengths[name]]
+
+    def std(self, name):
+        return np.sqrt(self.variance(name))
+
+    def percentile(self, name, percentile):
+        """
+        :param percentile: one of the percentiles asked for, e.g. 95
+        """
+        if percentile not in self.percentiles:
+            raise ValueError("SdEngine: percentile {} was not estimated; estimated are {}.".format(percentile,
+                                                                                                  self.percentiles))
+        return self.percentile_values[self.percentiles.index(percentile), self.index[name], :self.lengths[name]]
@@ -0,0 +1,254 @@
+"""
+Result store for Graph-SD: simulation results held in one contiguous float64 array instead of per-node lists
+"""
+import json
+import os
+import numpy as np
+
+
+FLUSH_STEPS = 1000  # steps between two flushes of a run stored on disk
+
+
+class ResultStore(object):
+    """
+    Values of all recorded elements of a structure, one row per element and one column per step.
+
+    Stocks and constants have a value before the first step, so at step k they have k+1 values (column 0 holds the
+    initial value). Flows and variables calculated by a function are only known once a step is taken, so they have
+    k values. This is the same as the value lists the engine used to keep in the graph.
+
+    For batch runs, a leading batch axis is added: values then has the shape (batch_size, n_elements, n_steps+1).
+
+    Arrayed elements take one row per entry, in the order of their flattened array; their behaviors and values are
+    given back in the shape of the array.
+
+    A run may record only some of its elements (record), and only every save_every steps: column c then holds
+    the values at step c * save_every. The latest values of all elements are still at hand (see latest()), so the run
+    can go on; unrecorded values are dropped after each step.
+
+    With a path, the values are kept in a .npy file mapped into memory instead of in RAM, with a JSON sidecar
+    describing the run (see sidecar_path()), so that a run can be reopened later with open_result_store().
+    """
+    def __init__(self, names, has_initial, n_steps=0, batch_size=None, shapes=None, path=None, record=None,
+                 save_every=1):
+        """
+        :param names: names of the elements of the run, in row order
+        :param has_initial: for each name, whether it has a value before the first step
+        :param n_steps: number of steps to allocate for
+        :param batch_size: number of scenarios run side by side; None for a single run
+        :param shapes: for each name, the shape of its values; () for a scalar, which is the default for all
+        :param path: a .npy file to store the values in; None to keep them in memory
+        :param record: names of the elements to record; None for all
+        :param save_every: number of steps between two recorded columns
+        """
+        self.elements = list(names)
+        self.element_has_initial = list(has_initial)
+        self.element_shapes = [()] * len(self.elements) if shapes is None else [tuple(shape) for shape in shapes]
+        if batch_size is not None and any(shape != () for shape in self.element_shapes):
+            raise ValueError("SdEngine: arrayed elements cannot be run in a batch.")
+        if record is not None:
+            unknown = [name for name in record if name not in self.elements]
+            if len(unknown) > 0:
+                raise ValueError("SdEngine: cannot record {}, not in the run.".format(unknown))
+        if int(save_every) < 1:
+            raise ValueError("SdEngine: save_every must be at least 1 step, got {}.".format(save_every))
+        self.record = None if record is None else list(record)
+        self.save_every = int(save_every)
+        recorded = [i for i, name in enumerate(self.elements) if record is None or name in record]
+        self.records_all = len(recorded) == len(self.elements) and self.save_every == 1
+        self.current = dict()  # latest values of all elements, kept when not every value is recorded
+
+        # the rows of the array are for the recorded elements
+        self.names = [self.elements[i] for i in recorded]
+        has_initial = [self.element_has_initial[i] for i in recorded]
+        self.shapes = {self.elements[i]: self.element_shapes[i] for i in recorded if self.element_shapes[i] != ()}
+        sizes = [int(np.prod(self.shapes.get(name, ()))) for name in self.names]
+        starts = np.cumsum([0] + sizes)
+        self.index = {name: int(starts[i]) for i, name in enumerate(self.names)}  # first row of each element
+        self.rows = {name: slice(int(starts[i]), int(starts[i + 1])) for i, name in enumerate(self.names)}
+        self.row_names = [name for name, size in zip(self.names, sizes) for j in range(size)]
+        self.has_initial = np.repeat(np.array(has_initial, dtype=int), sizes)  # for each row
+        self.initial_rows = np.flatnonzero(self.has_initial == 1)
+        self.initial_names = [name for name in self.names if self.has_initial[self.index[name]] == 1]
+        self.other_rows = np.flatnonzero(self.has_initial == 0)
+        self.other_names = [name for name in self.names if self.has_initial[self.index[name]] == 0]
+        self.batch_size = batch_size
+        self.path = path
+        self.run_settings = dict()  # how the run is made, e.g. its dt; written to the sidecar of a stored run
+        self.values = self.allocate(n_steps)
+        self.steps = 0
+        self.states = dict()  # states of delays at the latest step, see delays.py
+        if path is not None:
+            self.flush()
+
+    def new_like(self, n_steps=0):
+        """
+        Create an empty result store for the same elements
+        """
+        return ResultStore(self.elements, self.element_has_initial, n_steps=n_steps, batch_size=self.batch_size,
+                           shapes=self.element_shapes, record=self.record, save_every=self.save_every)
+
+    def shape(self, n_steps):
+        if self.batch_size is None:
+            return len(self.row_names), n_steps // self.save_every + 1
+        return self.batch_size, len(self.row_names), n_steps // self.save_every + 1
+
+    def to_columns(self, values, names):
+        """
+        Arrange the values of some elements for assignment to values[..., rows, k]
+        """
+        if len(self.shapes) > 0:
+            # arrayed elements are spread over their rows; scalars given for them apply to all entries
+            return np.concatenate([np.broadcast_to(values[name], self.shapes.get(name, ())).ravel()
+                                   for name in names]) if len(names) > 0 else []
+        if self.batch_size is None or len(names) == 0:
+            return [values[name] for name in names]
+        # constants are still scalars in a batch run, so broadcast them to the batch size
+        return np.stack([np.broadcast_to(values[name], (self.batch_size,)) for name in names], axis=-1)
+
+    def reserve(self, n_steps):
+        """
+        Make sure there is room for n_steps steps, keeping what has been recorded
+        """
+        if n_steps // self.save_every + 1 > self.values.shape[-1]:
+            if self.path is None:
+                values = self.allocate(n_steps)
+                values[..., :self.values.shape[-1]] = self.values
+                self.values = values
+                return
+            # a stored run gets a larger file, written next to the current one and then put in its place
+            values = np.lib.format.open_memmap(self.path + '.tmp', mode='w+', dtype=np.float64,
+                                               shape=self.shape(n_steps))
+            values[...] = np.nan
+            values[..., :self.values.shape[-1]] = self.values
+            values.flush()
+            del values
+            self.values = None
+            os.replace(self.path + '.tmp', self.path)
+            self.values = np.load(self.path, mmap_mode='r+')
+
+    def allocate(self, n_steps):
+        """
+        Create the array of values for n_steps steps, filled with NaN
+        """
+        if self.path is None:
+            return np.full(self.shape(n_steps), np.nan)
+        values = np.lib.format.open_memmap(self.path, mode='w+', dtype=np.float64, shape=self.shape(n_steps))
+        values[...] = np.nan
+        return values
+
+    def flush(self):
+        """
+        Write what is recorded of a stored run to its file and sidecar
+        """
+        if self.path is None:
+            return
+        self.values.flush()
+        sidecar = {'names': self.names,
+                   'has_initial': [int(self.has_initial[self.index[name]]) for name in self.names],
+                   'shapes': [list(self.shapes.get(name, ())) for name in self.names],
+                   'batch_size': self.batch_size,
+                   'steps': self.steps,
+                   'save_every': self.save_every,
+                   'time': {'start': self.run_settings.get('start', 0), 'dt': self.run_settings.get('dt'),
+                            'save_interval': None if self.run_settings.get('dt') is None else
+                            self.run_settings.get('dt') * self.save_every},
+                   'run_settings': self.run_settings}
+        with open(sidecar_path(self.path), 'w') as f:
+            json.dump(sidecar, f)
+
+    def trim(self):
+        """
+        Drop the room reserved for steps not taken, e.g. before sending the results to another process
+        """
+        self.values = self.values[..., :self.steps // self.save_every + 1].copy()
+        return self
+
+    def set_initial(self, values):
+        """
+        Record the values before the first step
+        :param values: a dictionary of element names and their values
+        """
+        self.values[..., self.initial_rows, 0] = self.to_columns(values, self.initial_names)
+        if not self.records_all:
+            self.current.update(values)
+
+    def write_step(self, values):
+        """
+        Record one step.
+        :param values: a dictionary of element names and their values; for stocks and constants it is their value
+        after this step, for the others the value calculated in this step
+        """
+        k = self.steps
+        if (k + 1) // self.save_every >= self.values.shape[-1]:
+            self.reserve(2 * (k + 1))  # amortize when stepping without a known horizon
+        if not self.records_all:
+            self.current.update(values)
+        # column c holds values after step c * save_every - 1, and those calculated in step c * save_every
+        if (k + 1) % self.save_every == 0:
+            self.values[..., self.initial_rows, (k + 1) // self.save_every] = self.to_columns(values,
+                                                                                           self.initial_names)
+        if k % self.save_every == 0:
+            self.values[..., self.other_rows, k // self.save_every] = self.to_columns(values, self.other_names)
+        self.steps += 1
+        if self.path is not None and self.steps % FLUSH_STEPS == 0:
+            self.flush()
+
+    def latest(self, name):
+        """
+        Get the latest value of an element (a vector over the batch in batch runs)
+        """
+        if name in self.current:
+            return self.current[name]
+        return self.value_at(name, self.length(name) - 1)
+
+    def length(self, name):
+        """
+        Get the number of values recorded for an element
+        """
+        if self.has_initial[self.index[name]] == 1:
+            return self.steps // self.save_every + 1
+        return (self.steps + self.save_every - 1) // self.save_every
+
+    def value_at(self, name, column):
+        """
+        Get the value of an element recorded in a column
+        """
+        i = self.index[name]
+        if name in self.shapes:
+            return self.values[self.rows[name], column].reshape(self.shapes[name])
+        return self.values[..., i, column]
+
+    def get(self, name):
+        """
+        Get the recorded behavior of an element, as a view into the result array (no copy; for a stored run, the
+        values are read from the file when used).
+        In batch runs this is a (batch_size, n_values) array, one row per scenario; for an arrayed element it is
+        shaped (array shape) + (n_values,).
+        """
+        if name in self.shapes:
+            return self.values[self.rows[name], :self.length(name)].reshape(self.shapes[name] + (-1,))
+        return self.values[..., self.index[name], :self.length(name)]
+
+
+def sidecar_path(path):
+    """
+    Get the path of the JSON sidecar of a run stored in path: the same name, ending in .json
+    """
+    return os.path.splitext(path)[0] + '.json'
+
+
+def open_result_store(path):
+    """
+    Open a run stored on disk (see ResultStore), read-only. The values are mapped into memory, not read.
+    :param path: the .npy file of the run
+    :return: a ResultStore
+    """
+    with open(sidecar_path(path)) as f:
+        sidecar = json.load(f)
+    result_store = ResultStore(sidecar['names'], sidecar['has_initial'], batch_size=sidecar['batch_size'],
+                               shapes=sidecar['shapes'], save_every=sidecar['save_every'])
+    result_store.values = np.load(path, mmap_mode='r')
+    result_store.steps = sidecar['steps']
+    result_store.run_settings = sidecar['run_settings']
+    return result_store
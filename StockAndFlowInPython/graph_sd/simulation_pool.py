@@ -0,0 +1,115 @@
+"""
+Simulation pool for Graph-SD: simulates and scores many structures in worker processes.
+Structures are sent as specs (see Structure.to_spec()); only the results and distances come back.
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+from StockAndFlowInPython.graph_sd.graph_engine import structure_from_spec
+
+
+class SimulationResult(object):
+    """
+    What a worker sends back: the outcome of the guarded run, the recorded behaviors and the distance to references
+    """
+    def __init__(self, status, result_store, run_settings, distance=None):
+        self.status = status
+        self.result_store = result_store
+        self.run_settings = run_settings
+        self.distance = distance
+
+
+def simulate_spec(spec, simulation_time=0, dt=None, references=None, distance_function=None):
+    """
+    Simulate a structure from its spec and score it; this is what runs in a worker process.
+    :param spec: a spec from Structure.to_spec()
+    :param simulation_time: time to simulate; 0 for the default simulation time of the structure
+    :param dt: time step; None for the default time step of the structure, e.g. the one in its model file
+    :param references: a list of (element name, reference behavior) to score the structure against
+    :param distance_function: a function(behavior, reference) returning their distance; it must be defined at the
+    top level of a module, so that it can be sent to a worker
+    :return: a SimulationResult; its distance is the sum over the references, None if not scored or diverged
+    """
+    structure = structure_from_spec(spec)
+    if dt is None:
+        dt = structure.default_dt
+    status = structure.simulate(simulation_time=simulation_time, dt=dt, backend='codegen', guard=True)
+    distance = None
+    if references is not None and distance_function is not None and not status.diverged:
+        distance = 0
+        for name, reference in references:
+            distance += distance_function(structure.get_behavior(name), reference)
+    return SimulationResult(status, structure.result_store.trim(), structure.run_settings, distance)
+
+
+class SimulationPool(object):
+    """
+    A pool of worker processes simulating structures side by side
+    """
+    def __init__(self, workers=None):
+        """
+        :param workers: number of worker processes; by default one per CPU
+        """
+        self.workers = workers if workers is not None else os.cpu_count()
+        self.executor = None  # the processes are started when first needed
+
+    def simulate(self, structures, simulation_time=0, dt=None, references=None, distance_function=None):
+        """
+        Simulate structures in parallel, each with the guard on (see Structure.simulate())
+        :param structures: a list of Structures
+        :param simulation_time: see simulate_spec()
+        :param dt: time step; None for the default time step of each structure
+        :param references: for each structure, a list of (element name, reference behavior), or None
+        :param distance_function: see simulate_spec()
+        :return: a list of SimulationResults, in the order of structures
+        """
+        if references is None:
+            references = [None] * len(structures)
+        if self.workers <= 1 or len(structures) <= 1:
+            return [simulate_spec(structure.to_spec(), simulation_time, dt, structure_references, distance_function)
+                    for structure, structure_references in zip(structures, references)]
+
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=self.workers)
+        futures = [self.executor.submit(simulate_spec, structure.to_spec(), simulation_time, dt, structure_references,
+                                        distance_function)
+                   for structure, structure_references in zip(structures, references)]
+        return [future.result() for future in futures]
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+
+def main():
+    """
+    Check that a structure with external data gives the same run locally and through the pool, with a start time
+    that is not 0 (external data is looked up at the time of each step) and the default dt of the structure
+    """
+    import numpy as np
+    from StockAndFlowInPython.graph_sd.graph_engine import Structure, DataFeeder
+    from StockAndFlowInPython.parsing.XMILE_parsing import text_to_equation
+    structure = Structure()
+    structure.add_stock('stock0', [100])
+    structure.add_aux('reference', [0])
+    structure.set_external('reference')
+    structure.add_flow('flow0', text_to_equation('(stock0 - reference) / 5'), flow_from='stock0')
+    structure.data_feeder = DataFeeder(os.path.join(os.path.dirname(__file__), '..', 'case', 'linear_decrease.csv'))
+    structure.data_feeder.set_var_source('reference', 'stock0')
+    structure.default_start_time = 2
+    structure.default_simulation_time = 10
+    structure.default_dt = 0.5
+
+    structure.simulate()
+    local = structure.get_behavior('stock0')
+    pool = SimulationPool(workers=2)
+    results = pool.simulate([structure, structure])
+    pool.shutdown()
+    for result in results:
+        if not np.array_equal(local, result.result_store.get('stock0')):
+            raise AssertionError("SimulationPool: the run in a worker differs from the local run.")
+    print('SimulationPool: local and pool runs are the same,', local[:3])
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,13 @@
 """Parsing Utility for XMILE file"""
-from StockAndFlowInPython.graph_sd.graph_engine import LINEAR, SUBTRACTION, DIVISION, ADDITION, MULTIPLICATION
+import re
+import numpy as np
+from StockAndFlowInPython.graph_sd.graph_engine import LINEAR, SUBTRACTION, DIVISION, ADDITION, MULTIPLICATION, \
+    DELAY, DELAY1, DELAY3, DELAYN, SMTH1, SMTH3, TIME, run_variables, name_handler, delay_functions
+from StockAndFlowInPython.graph_sd.graphical_functions import GraphicalFunction, CONTINUOUS
 
 
 name_operator_mapping = {ADDITION: '+', SUBTRACTION: '-', MULTIPLICATION: '*', DIVISION: '/'}
+text_operator_mapping = {text: operator for operator, text in name_operator_mapping.items()}
 
 
 def text_to_digit(text):
@@ -13,34 +18,6 @@ def text_to_digit(text):
         return text
 
 
-def parsing_addition(equation):
-    factors = equation.split('+')
-    for i in range(len(factors)):
-        factors[i] = text_to_digit(factors[i])
-    return factors
-
-
-def parsing_multiplication(equation):
-    factors = equation.split('*')
-    for i in range(len(factors)):
-        factors[i] = text_to_digit(factors[i])
-    return factors
-
-
-def parsing_division(equation):
-    factors = equation.split('/')
-    for i in range(len(factors)):
-        factors[i] = text_to_digit(factors[i])
-    return factors
-
-
-def parsing_subtract(equation):
-    factors = equation.split('-')
-    for i in range(len(factors)):
-        factors[i] = text_to_digit(factors[i])
-    return factors
-
-
 def is_number(text):
     outcome = True
     for i in range(len(text)):  # filter out conditions like '0-0', '1-4', etc.
@@ -58,34 +35,474 @@ def is_number(text):
     return outcome
 
 
+class EquationSyntaxError(ValueError):
+    """Raised when an equation's text cannot be parsed"""
+    pass
+
+
+# Equation parsing: text -> tokens -> AST -> a Python function, compiled once per equation text.
+# AST nodes are tuples:
+#   ('number', value), ('name', name), ('unary', operator, operand), ('binary', operator, left, right),
+#   ('call', function name, [arguments]); IF c THEN a ELSE b is ('call', 'IF', [c, a, b])
+
+token_pattern = re.compile(r'\s*(?:(\d+\.?\d*(?:[eE][-+]?\d+)?|\.\d+(?:[eE][-+]?\d+)?)|([A-Za-z_][A-Za-z0-9_]*)|"([^"]*)"|(<=|>=|<>|\S))')
+
+binary_precedence = {'=': 1, '<>': 1, '<': 1, '>': 1, '<=': 1, '>=': 1, '+': 2, '-': 2, '*': 3, '/': 3, '^': 4}
+right_associative = ['^']
+unary_precedence = 4  # -x^2 is -(x^2), but 2*-x is 2*(-x)
+python_operators = {'=': '==', '<>': '!='}  # comparisons written differently in Python
+
+# builtin functions, by their upper-case XMILE names; NumPy functions so that equations also work in batch runs
+equation_functions = {'MIN': 'np.minimum', 'MAX': 'np.maximum', 'ABS': 'np.abs', 'EXP': 'np.exp', 'LN': 'np.log',
+                      'SQRT': 'np.sqrt', 'SUM': 'np.sum', 'MEAN': 'np.mean'}
+# with one argument, these reduce an arrayed element to a number
+reducers = {'MIN': 'np.min', 'MAX': 'np.max'}
+# functions of the time of each step, which make an equation refer to TIME
+time_function_names = ['STEP']
+# delay and smoothing functions keep a state, so they can only be a whole equation, e.g. DELAY1(Orders, 3); the
+# loader takes those used inside an equation out of it, see split_delays()
+delay_function_names = {'DELAY': DELAY, 'DELAY1': DELAY1, 'DELAY3': DELAY3, 'DELAYN': DELAYN, 'SMTH1': SMTH1,
+                         'SMTH3': SMTH3}
+
+
+def tokenize(equation_text):
+    """
+    Split an equation into tokens
+    :return: a list of (kind, value), kind being 'number', 'name' or 'operator'
+    """
+    tokens = list()
+    for number, name, quoted_name, symbol in token_pattern.findall(equation_text.strip()):
+        if number:
+            tokens.append(('number', float(number)))
+        elif name:
+            tokens.append(('name', name.upper() if name.upper() in run_variables else name))
+        elif quoted_name:
+            tokens.append(('name', name_handler(quoted_name)))
+        else:
+            tokens.append(('operator', symbol))
+    return tokens
+
+
+class EquationParser(object):
+    """
+    Precedence climbing parser for equations like (Goal-Temperature)/Adjustment_Time
+    """
+    def __init__(self, equation_text):
+        self.text = equation_text
+        self.tokens = tokenize(equation_text)
+        self.position = 0
+
+    def peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return None, None
+
+    def take(self, expected=None):
+        token = self.peek()
+        if token[0] is None or (expected is not None and token != ('operator', expected)):
+            raise EquationSyntaxError("Expecting {} in equation '{}'".format(
+                "'{}'".format(expected) if expected is not None else 'more', self.text))
+        self.position += 1
+        return token
+
+    def parse(self):
+        """
+        :return: the AST of the whole equation
+        """
+        tree = self.parse_expression(1)
+        if self.position < len(self.tokens):
+            raise EquationSyntaxError("Unexpected '{}' in equation '{}'".format(self.peek()[1], self.text))
+        return tree
+
+    def parse_expression(self, min_precedence):
+        left = self.parse_primary()
+        while True:
+            kind, operator = self.peek()
+            if kind != 'operator' or operator not in binary_precedence or \
+                    binary_precedence[operator] < min_precedence:
+                return left
+            self.position += 1
+            precedence = binary_precedence[operator]
+            right = self.parse_expression(precedence if operator in right_associative else precedence + 1)
+            left = ('binary', operator, left, right)
+
+    def parse_primary(self):
+        kind, value = self.take()
+        if kind == 'number':
+            return 'number', value
+        elif kind == 'name':
+            if value.upper() == 'IF':
+                return self.parse_if()
+            if self.peek() == ('operator', '('):
+                return self.parse_call(value)
+            if self.peek() == ('operator', '['):
+                self.parse_subscripts()
+            return 'name', value
+        elif value == '(':
+            tree = self.parse_expression(1)
+            self.take(')')
+            return tree
+        elif value in ['-', '+']:
+            return 'unary', value, self.parse_expression(unary_precedence)
+        raise EquationSyntaxError("Unexpected '{}' in equation '{}'".format(value, self.text))
+
+    def parse_if(self):
+        """
+        Parse the rest of IF condition THEN value ELSE value
+        """
+        arguments = [self.parse_expression(1)]
+        for keyword in ['THEN', 'ELSE']:
+            kind, value = self.take()
+            if kind != 'name' or value.upper() != keyword:
+                raise EquationSyntaxError("Expecting {} in equation '{}'".format(keyword, self.text))
+            arguments.append(self.parse_expression(1))
+        return 'call', 'IF', arguments
+
+    def parse_subscripts(self):
+        """
+        Parse the subscripts of an arrayed element, e.g. the [*] in SUM(Sales[*]). Equations apply to whole arrays,
+        so only * is supported.
+        """
+        self.take('[')
+        while True:
+            if self.take() != ('operator', '*'):
+                raise EquationSyntaxError("Only [*] subscripts are supported in equation '{}'".format(self.text))
+            if self.peek() != ('operator', ','):
+                break
+            self.position += 1
+        self.take(']')
+
+    def parse_call(self, function_name):
+        if function_name.upper() not in equation_functions and function_name.upper() not in delay_function_names \
+                and function_name.upper() not in time_function_names:
+            raise EquationSyntaxError("Unknown function '{}' in equation '{}'".format(function_name, self.text))
+        self.take('(')
+        arguments = [self.parse_expression(1)]
+        while self.peek() == ('operator', ','):
+            self.position += 1
+            arguments.append(self.parse_expression(1))
+        self.take(')')
+        return 'call', function_name.upper(), arguments
+
+
+def tree_names(tree, names=None):
+    """
+    Get the names an AST refers to, in the order they first appear
+    """
+    if names is None:
+        names = list()
+    if tree[0] == 'name' and tree[1] not in names:
+        names.append(tree[1])
+    elif tree[0] == 'unary':
+        tree_names(tree[2], names)
+    elif tree[0] == 'binary':
+        tree_names(tree[2], names)
+        tree_names(tree[3], names)
+    elif tree[0] == 'call':
+        for argument in tree[2]:
+            tree_names(argument, names)
+        if tree[1] in time_function_names and TIME not in names:
+            names.append(TIME)
+    return names
+
+
+def tree_to_source(tree, argument_sources):
+    """
+    Turn an AST into a Python expression
+    :param argument_sources: a dictionary of names and the Python expressions standing for them
+    """
+    if tree[0] == 'number':
+        return repr(tree[1])
+    elif tree[0] == 'name':
+        return argument_sources[tree[1]]
+    elif tree[0] == 'unary':
+        return '({}{})'.format(tree[1], tree_to_source(tree[2], argument_sources))
+    elif tree[0] == 'binary':
+        left = tree_to_source(tree[2], argument_sources)
+        right = tree_to_source(tree[3], argument_sources)
+        if tree[1] == '^':
+            return 'np.power({}, {})'.format(left, right)
+        return '({} {} {})'.format(left, python_operators.get(tree[1], tree[1]), right)
+    elif tree[1] in delay_function_names:
+        raise EquationSyntaxError("{} can only be used as a whole equation".format(tree[1]))
+    elif tree[1] == 'IF':
+        return conditional_source(*[tree_to_source(argument, argument_sources) for argument in tree[2]])
+    elif tree[1] == 'STEP':  # STEP(height, start time)
+        return conditional_source(step_condition_source(tree, argument_sources),
+                                  tree_to_source(tree[2][0], argument_sources), '0.0')
+    elif tree[1] in reducers and len(tree[2]) == 1:
+        return '{}({})'.format(reducers[tree[1]], tree_to_source(tree[2][0], argument_sources))
+    else:
+        return '{}({})'.format(equation_functions[tree[1]],
+                               ', '.join(tree_to_source(argument, argument_sources) for argument in tree[2]))
+
+
+def step_condition_source(tree, argument_sources):
+    """
+    Get the condition of STEP(height, start time) as a Python expression: the time has reached the start time
+    """
+    return '({} >= {})'.format(argument_sources[TIME], tree_to_source(tree[2][1], argument_sources))
+
+
+def conditional_source(condition, then_source, else_source):
+    """
+    Get a Python expression choosing between two values. For a number condition only the value chosen is
+    calculated, like Python's 'a if c else b', so that e.g. IF x = 0 THEN 0 ELSE y/x never divides by zero; for an
+    arrayed one both are calculated (NumPy divisions by zero give inf instead of raising) and np.where() picks.
+    """
+    return '(({1} if {0} else {2}) if np.ndim({0}) == 0 else np.where({0}, {1}, {2}))'.format(
+        condition, then_source, else_source)
+
+
+def tree_zero_divisions(tree, argument_sources, taken=None, checks=None):
+    """
+    Get Python expressions that are true when calculating an AST with numbers would divide by zero, inner divisions
+    first, e.g. for checking them before the equation is calculated. Divisors that are numbers are left out, and a
+    division in a value of IF or STEP only counts when that value is chosen.
+    :param argument_sources: see tree_to_source()
+    :param taken: the Python expression that is true when the part of the AST is calculated; None for always
+    """
+    if checks is None:
+        checks = list()
+
+    def when(condition):
+        return condition if taken is None else '({} and {})'.format(taken, condition)
+
+    if tree[0] == 'unary':
+        tree_zero_divisions(tree[2], argument_sources, taken, checks)
+    elif tree[0] == 'binary':
+        tree_zero_divisions(tree[2], argument_sources, taken, checks)
+        tree_zero_divisions(tree[3], argument_sources, taken, checks)
+        if tree[1] == '/' and tree[3][0] != 'number':
+            checks.append(when('{} == 0'.format(tree_to_source(tree[3], argument_sources))))
+    elif tree[0] == 'call' and tree[1] == 'IF':
+        condition, then_tree, else_tree = tree[2]
+        tree_zero_divisions(condition, argument_sources, taken, checks)
+        condition = tree_to_source(condition, argument_sources)
+        tree_zero_divisions(then_tree, argument_sources, when(condition), checks)
+        tree_zero_divisions(else_tree, argument_sources, when('not {}'.format(condition)), checks)
+    elif tree[0] == 'call' and tree[1] == 'STEP':
+        tree_zero_divisions(tree[2][1], argument_sources, taken, checks)
+        tree_zero_divisions(tree[2][0], argument_sources, when(step_condition_source(tree, argument_sources)), checks)
+    elif tree[0] == 'call':
+        for argument in tree[2]:
+            tree_zero_divisions(argument, argument_sources, taken, checks)
+    return checks
+
+
+def tree_to_text(tree):
+    """
+    Turn an AST back into an equation text, e.g. to write an equation changed by split_delays()
+    """
+    if tree[0] == 'number':
+        return str(int(tree[1])) if tree[1] == int(tree[1]) else repr(tree[1])
+    elif tree[0] == 'name':
+        return tree[1]
+    elif tree[0] == 'unary':
+        return '{}{}'.format(tree[1], operand_to_text(tree[2]))
+    elif tree[0] == 'binary':
+        return '{}{}{}'.format(operand_to_text(tree[2]), tree[1], operand_to_text(tree[3]))
+    elif tree[1] == 'IF':
+        return 'IF {} THEN {} ELSE {}'.format(*[tree_to_text(argument) for argument in tree[2]])
+    return '{}({})'.format(tree[1], ', '.join(tree_to_text(argument) for argument in tree[2]))
+
+
+def operand_to_text(tree):
+    """
+    Turn the AST of an operand back into text, in brackets unless it is a single number, name or function
+    """
+    if tree[0] == 'binary' or (tree[0] == 'call' and tree[1] == 'IF'):
+        return '({})'.format(tree_to_text(tree))
+    return tree_to_text(tree)
+
+
+def split_delays(equation_text, name):
+    """
+    Take the delay and smoothing functions used inside an equation out of it, each into an element of its own, e.g.
+    Orders+0*DELAY(Demand, 3) of Shipments becomes Orders+(0*Shipments_DELAY), with an element Shipments_DELAY of
+    DELAY(Demand, 3); further ones are numbered, Shipments_DELAY_2 etc.
+    :param name: the element the equation belongs to; the new elements are named after it
+    :return: the equation text, and a list of (name, equation text) of the new elements
+    """
+    tree = EquationParser(equation_text).parse()
+    if tree[0] == 'call' and tree[1] in delay_function_names:  # a whole equation needs no element of its own
+        return equation_text, list()
+    split = list()
+
+    def replace_delays(tree):
+        if tree[0] == 'call' and tree[1] in delay_function_names:
+            split.append(('{}_{}{}'.format(name, tree[1], '_{}'.format(len(split) + 1) if len(split) > 0 else ''),
+                          tree_to_text(tree)))
+            return 'name', split[-1][0]
+        elif tree[0] == 'unary':
+            return tree[:2] + (replace_delays(tree[2]),)
+        elif tree[0] == 'binary':
+            return tree[:2] + (replace_delays(tree[2]), replace_delays(tree[3]))
+        elif tree[0] == 'call':
+            return tree[:2] + ([replace_delays(argument) for argument in tree[2]],)
+        return tree
+
+    tree = replace_delays(tree)
+    if len(split) == 0:
+        return equation_text, split
+    return tree_to_text(tree), split
+
+
+class Equation(object):
+    """
+    An equation parsed and compiled into a Python function. In a structure it is used like the other functions:
+    [equation, argument, argument, ...], the arguments being the names the equation refers to, in order.
+    """
+    def __init__(self, text):
+        self.text = text.strip()
+        self.tree = EquationParser(self.text).parse()
+        self.arguments = tree_names(self.tree)
+        self.source = 'lambda {}: {}'.format(
+            ', '.join('a_{}'.format(i) for i in range(len(self.arguments))),
+            self.expression(['a_{}'.format(i) for i in range(len(self.arguments))]))
+        self.function = eval(compile(self.source, '<equation {}>'.format(self.text), 'eval'), {'np': np})
+
+    def __call__(self, *arguments):
+        return self.function(*arguments)
+
+    def expression(self, argument_sources):
+        """
+        Get the equation as a Python expression (referring to NumPy as np), e.g. for inlining it in generated code
+        :param argument_sources: the Python expressions standing for the arguments, in order
+        """
+        return tree_to_source(self.tree, dict(zip(self.arguments, argument_sources)))
+
+    def zero_divisions(self, argument_sources):
+        """
+        Get the Python expressions that are true when the equation would divide by zero, see tree_zero_divisions()
+        :param argument_sources: the Python expressions standing for the arguments, in order
+        """
+        return tree_zero_divisions(self.tree, dict(zip(self.arguments, argument_sources)))
+
+    def __reduce__(self):  # copies and pickles (e.g. to worker processes) share the compiled equation
+        return compile_equation, (self.text,)
+
+    def __eq__(self, other):
+        return isinstance(other, Equation) and other.text == self.text
+
+    def __hash__(self):
+        return hash(self.text)
+
+    def __repr__(self):
+        return self.text
+
+
+compiled_equations = dict()
+
+
+def compile_equation(equation_text):
+    """
+    Get the compiled Equation of a text, compiling it only the first time
+    """
+    equation_text = equation_text.strip()
+    if equation_text not in compiled_equations:
+        compiled_equations[equation_text] = Equation(equation_text)
+    return compiled_equations[equation_text]
+
+
+def tree_to_argument(tree):
+    """
+    Get a simple argument (a number or a name) from an AST, or None if it is not that simple
+    """
+    if tree[0] == 'number':
+        return tree[1]
+    elif tree[0] == 'name':
+        return tree[1]
+    elif tree[0] == 'unary' and tree[2][0] == 'number':
+        return -tree[2][1] if tree[1] == '-' else tree[2][1]
+    return None
+
+
 def text_to_equation(equation_text):
     '''
     This equation could be
-    1) a constant number
-    2) a variable's name
-    3) another equation
+    1) a constant number, giving [number]
+    2) a variable's name, giving [LINEAR, name]
+    3) one operation between two names or numbers, giving [ADDITION, x, y] etc.
+    4) a delay or smoothing function of names or numbers, giving [DELAY1, x, delay_time] etc.
+    5) any other equation, giving [Equation, name, name, ...]; with STEP, one of the names is TIME
     '''
-    if is_number(equation_text):
-        return [float(equation_text)]
+    tree = EquationParser(equation_text).parse()
+    if tree[0] == 'call' and tree[1] in delay_function_names:
+        arguments = [tree_to_argument(argument) for argument in tree[2]]
+        if None in arguments:
+            raise EquationSyntaxError("Arguments of {} can only be names or numbers in equation '{}'".format(
+                tree[1], equation_text))
+        return [delay_function_names[tree[1]]] + arguments
 
-    elif '+' in equation_text:
-        factors = parsing_addition(equation_text)
-        return [ADDITION] + factors
+    if len(tree_names(tree)) == 0:
+        # no names: it's a constant number, e.g. '5' or '-0.05'
+        return [float(Equation(equation_text)())]
 
-    elif '*' in equation_text:
-        factors = parsing_multiplication(equation_text)
-        return [MULTIPLICATION] + factors
+    argument = tree_to_argument(tree)
+    if argument is not None:
+        return [LINEAR, argument]
 
-    elif '/' in equation_text:
-        factors = parsing_division(equation_text)
-        return [DIVISION] + factors
+    if tree[0] == 'binary' and tree[1] in text_operator_mapping:
+        left = tree_to_argument(tree[2])
+        right = tree_to_argument(tree[3])
+        if left is not None and right is not None:
+            return [text_operator_mapping[tree[1]], left, right]
 
-    elif '-' in equation_text:
-        factors = parsing_subtract(equation_text)
-        return [SUBTRACTION] + factors
+    equation = compile_equation(equation_text)
+    return [equation] + equation.arguments
 
-    else:
-        return equation_text
+
+def xmile_tag(element):
+    """
+    Get the tag of an XMILE element (xml.etree.ElementTree) without its namespace, e.g. 'stock'
+    """
+    return element.tag.rsplit('}', 1)[-1]
+
+
+def xmile_find_all(element, tag):
+    """
+    Get all descendants of an element with a tag, in document order
+    """
+    return [descendant for descendant in element.iter() if descendant is not element and xmile_tag(descendant) == tag]
+
+
+def xmile_find(element, tag):
+    """
+    Get the first descendant of an element with a tag, or None
+    """
+    for descendant in element.iter():
+        if descendant is not element and xmile_tag(descendant) == tag:
+            return descendant
+    return None
+
+
+def xmile_points(element):
+    separator = element.get('sep', ',')
+    return [float(point) for point in element.text.split(separator)]
+
+
+def xmile_to_graphical_function(gf, equation_text):
+    '''
+    Build the equation of an element defined by a graphical function in XMILE
+    :param gf: the <gf> element
+    :param equation_text: the element's <eqn>, giving the input of the graphical function
+    :return: [GraphicalFunction, argument, ...]
+    '''
+    ypts = xmile_points(xmile_find(gf, 'ypts'))
+    if xmile_find(gf, 'xpts') is not None:
+        xpts = xmile_points(xmile_find(gf, 'xpts'))
+    else:  # evenly spread over the x scale
+        xscale = xmile_find(gf, 'xscale')
+        xpts = np.linspace(float(xscale.get('min')), float(xscale.get('max')), len(ypts))
+    gf_type = gf.get('type', CONTINUOUS)
+
+    equation = text_to_equation(equation_text)
+    if len(equation) == 1 or (len(equation) == 2 and equation[0] == LINEAR):
+        # the input is a number or an element
+        return [GraphicalFunction(xpts, ypts, gf_type), equation[-1]]
+    input_equation = compile_equation(equation_text)
+    return [GraphicalFunction(xpts, ypts, gf_type, input_function=input_equation)] + input_equation.arguments
 
 
 def equation_to_text(equation):
@@ -99,3 +516,11 @@ def equation_to_text(equation):
             return str(equation[1]) + name_operator_mapping[equation[0]] + str(equation[2])
         elif equation[0] == LINEAR:
             return str(equation[1])
+        elif isinstance(equation[0], Equation):
+            return equation[0].text
+        elif isinstance(equation[0], GraphicalFunction):  # the equation of its input, as in the <eqn> of XMILE
+            if equation[0].input_function is None:
+                return str(equation[1])
+            return equation[0].input_function.text
+        elif equation[0] in delay_functions:
+            return '{}({})'.format(equation[0].__name__.upper(), ', '.join(str(argument) for argument in equation[1:]))
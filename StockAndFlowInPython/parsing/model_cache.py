@@ -0,0 +1,125 @@
+"""
+Cache of parsed models: the Structure built from an XMILE file, pickled under a key made of the file's content hash
+and the parser version, so that a model file is parsed again only when it (or the parser) has changed.
+"""
+import hashlib
+import os
+import pickle
+from StockAndFlowInPython.graph_sd.graph_engine import Structure
+
+
+PARSER_VERSION = 4  # increase whenever SessionHandler.read_xmile_model() changes what it builds
+DEFAULT_CACHE_DIRECTORY = os.path.join(os.path.expanduser('~'), '.cache', 'sfd_canvas', 'models')
+
+
+def cache_key(filename):
+    """
+    Get the key of a model file: the SHA-256 of its content, with the parser version
+    """
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return '{}-v{}'.format(digest.hexdigest(), PARSER_VERSION)
+
+
+def cache_path(key, cache_directory=None):
+    if cache_directory is None:
+        cache_directory = DEFAULT_CACHE_DIRECTORY
+    return os.path.join(cache_directory, key + '.pickle')
+
+
+def structure_state(structure):
+    """
+    Get what a parsed structure is made of, in a picklable dict: its graph (elements with their equations and
+    positions), uid and name managers, dimensions and simulation defaults. Results of runs are left out.
+    """
+    return {'sfd': structure.sfd,
+            'uid_manager': structure.uid_manager,
+            'name_manager': structure.name_manager,
+            'uid_element_name': structure.uid_element_name,
+            'dimensions': structure.dimensions,
+            'default_simulation_time': structure.default_simulation_time,
+            'default_dt': structure.default_dt,
+            'default_start_time': structure.default_start_time,
+            'default_save_interval': structure.default_save_interval}
+
+
+def structure_from_state(state):
+    """
+    Build a structure again from structure_state()
+    """
+    structure = Structure(sfd=state['sfd'], uid_manager=state['uid_manager'], name_manager=state['name_manager'],
+                          uid_element_name=state['uid_element_name'])
+    restore_settings(structure, state)
+    return structure
+
+
+def restore_structure(structure, state):
+    """
+    Put structure_state() into an existing structure, e.g. the one a SessionHandler was given, so that everyone
+    holding it sees the model. What was compiled for its previous elements is dropped.
+    """
+    structure.sfd = state['sfd']
+    structure.uid_manager = state['uid_manager']
+    structure.name_manager = state['name_manager']
+    structure.uid_element_name = state['uid_element_name']
+    structure.elements_by_type = dict()
+    structure.indexed_sfd = None
+    structure.incidence = None
+    structure.generated_code = dict()
+    structure.generated_signature = None
+    structure.invalidate()
+    restore_settings(structure, state)
+
+
+def restore_settings(structure, state):
+    """
+    Put the dimensions and simulation defaults of structure_state() into a structure
+    """
+    structure.dimensions = state['dimensions']
+    structure.default_simulation_time = state['default_simulation_time']
+    structure.default_dt = state['default_dt']
+    structure.default_start_time = state['default_start_time']
+    structure.default_save_interval = state['default_save_interval']
+
+
+def save_structure(structure, key, cache_directory=None):
+    """
+    Put a structure just parsed into the cache, see structure_state()
+    """
+    path = cache_path(key, cache_directory)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # written next to its place and then moved there, so that a reader (or another process) never sees half a file
+    temporary_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(temporary_path, 'wb') as f:
+        pickle.dump(structure_state(structure), f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temporary_path, path)
+
+
+def load_structure(key, cache_directory=None):
+    """
+    Get a structure from the cache
+    :return: a new Structure, or None if the key is not in the cache or its entry cannot be read
+    """
+    state = load_state(key, cache_directory)
+    if state is None:
+        return None
+    return structure_from_state(state)
+
+
+def load_state(key, cache_directory=None):
+    """
+    Get the structure_state() of a structure from the cache
+    :return: the state, or None if the key is not in the cache or its entry cannot be read
+    """
+    path = cache_path(key, cache_directory)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'rb') as f:
+            state = pickle.load(f)
+    except Exception as e:  # e.g. written by other versions of the libraries; it will be parsed again
+        print('Model cache: cannot read {}, {}'.format(path, e))
+        return None
+    return state
@@ -0,0 +1,250 @@
+"""
+Writing a Structure to an XMILE (.stmx) file, see Structure.to_xmile(). Each element is built as a small ElementTree
+element and written out at once, so the file is produced in one pass over the structure.
+"""
+from xml.etree import ElementTree
+import numpy as np
+from StockAndFlowInPython.graph_sd.graph_engine import STOCK, FLOW, PARAMETER, VARIABLE, ALIAS, LINEAR, run_variables
+from StockAndFlowInPython.graph_sd.graphical_functions import GraphicalFunction
+from StockAndFlowInPython.parsing.XMILE_parsing import Equation, equation_to_text
+
+
+XMILE_NAMESPACE = 'http://docs.oasis-open.org/xmile/ns/XMILE/v1.0'
+ISEE_NAMESPACE = 'http://iseesystems.com/XMILE'
+
+
+def number_text(number):
+    return repr(float(number))
+
+
+def argument_text(argument):
+    """
+    Get the text of an argument of a function: a name, a number, or a [name, angle] of equations read by older
+    versions of the loader
+    """
+    if type(argument) == list:
+        argument = argument[0]
+    if type(argument) == str:
+        return argument
+    return number_text(argument)
+
+
+def function_text(function):
+    """
+    Get the XMILE equation of a function, e.g. [DIVISION, 'gap0', 'at0'] -> 'gap0/at0'. For a graphical function it
+    is the equation of its input.
+    """
+    if isinstance(function[0], GraphicalFunction):
+        if function[0].input_function is None:
+            return argument_text(function[1])
+        return function[0].input_function.text
+    if function[0] == LINEAR and len(function) > 2:  # linear(x, a=1, b=0)
+        b = argument_text(function[3]) if len(function) > 3 else '0'
+        return '{}*{}+{}'.format(argument_text(function[2]), argument_text(function[1]), b)
+    if isinstance(function[0], Equation):
+        return function[0].text
+    return equation_to_text([function[0]] + [argument_text(argument) for argument in function[1:]])
+
+
+def function_arguments(function):
+    """
+    Get the names a function takes information from, with the angle of its connector if the equation has one
+    """
+    arguments = list()
+    for argument in function[1:]:
+        if type(argument) == list and type(argument[0]) == str:
+            arguments.append((argument[0], argument[1]))
+        elif type(argument) == str:
+            arguments.append((argument, None))
+    return arguments
+
+
+def add_text(parent, tag, text):
+    child = ElementTree.SubElement(parent, tag)
+    child.text = text
+    return child
+
+
+def variable_element(structure, name, attributes, inflows, outflows):
+    """
+    Build the definition of an element in <variables>
+    """
+    element_type = attributes['element_type']
+    tag = 'aux' if element_type in [PARAMETER, VARIABLE] else element_type
+    element = ElementTree.Element(tag, name=name)
+    function = attributes['function']
+    value = attributes['value'][0] if attributes['value'] is not None and len(attributes['value']) > 0 else 0
+    if element_type == STOCK:  # its value is the initial value, given as a number or an equation
+        function = None if isinstance(value, (int, float, np.number, np.ndarray)) else attributes['value']
+    dimensions = attributes.get('dimensions')
+
+    if function is not None:
+        add_text(element, 'eqn', function_text(function))
+    elif type(value) == np.ndarray and dimensions is not None:
+        # one <element> per entry, in the order of the dimensions
+        labels = [structure.dimensions[dimension] for dimension in dimensions]
+        entries = np.asarray(value).reshape([len(labels_along) for labels_along in labels])
+        for position in np.ndindex(entries.shape):
+            entry = ElementTree.SubElement(element, 'element', subscript=', '.join(
+                labels[axis][i] for axis, i in enumerate(position)))
+            add_text(entry, 'eqn', number_text(entries[position]))
+    else:
+        add_text(element, 'eqn', number_text(np.asarray(value).ravel()[0]))
+
+    if function is not None and isinstance(function[0], GraphicalFunction):
+        gf = ElementTree.SubElement(element, 'gf', type=function[0].gf_type)
+        add_text(gf, 'xpts', ','.join(number_text(x) for x in function[0].xpts))
+        add_text(gf, 'ypts', ','.join(number_text(y) for y in function[0].ypts))
+    if dimensions is not None:
+        dimensions_element = ElementTree.SubElement(element, 'dimensions')
+        for dimension in dimensions:
+            ElementTree.SubElement(dimensions_element, 'dim', name=dimension)
+    for flow in inflows.get(name, list()):
+        add_text(element, 'inflow', flow)
+    for flow in outflows.get(name, list()):
+        add_text(element, 'outflow', flow)
+    return element
+
+
+def view_element(name, attributes):
+    """
+    Build the view of an element, with its position
+    """
+    element_type = attributes['element_type']
+    x, y = attributes['pos']
+    if element_type == ALIAS:
+        element = ElementTree.Element('alias', uid=str(name), x=str(x), y=str(y))
+        add_text(element, 'of', attributes['function'])
+        return element
+    tag = 'aux' if element_type in [PARAMETER, VARIABLE] else element_type
+    element = ElementTree.Element(tag, x=str(x), y=str(y), name=name)
+    if element_type == FLOW and attributes['points'] is not None:
+        points = ElementTree.SubElement(element, 'pts')
+        for point in attributes['points']:
+            ElementTree.SubElement(points, 'pt', x=str(point[0]), y=str(point[1]))
+    return element
+
+
+def connector_element(uid, angle, from_element, to_element):
+    element = ElementTree.Element('connector', uid=str(uid), angle=str(0 if angle is None else angle))
+    add_text(element, 'from', from_element)
+    add_text(element, 'to', to_element)
+    return element
+
+
+def write_xmile(structure, path, model_name='model'):
+    """
+    Write a structure to an XMILE file: its simulation specs, dimensions, the definitions of its elements, and a
+    view with their positions and the connectors between them
+    :param structure: a Structure
+    :param path: the .stmx file to write
+    :param model_name: name in the header of the file
+    """
+    nodes = structure.sfd.nodes
+    inflows = dict()  # stock -> flows into it
+    outflows = dict()
+    for name in structure.all_certain_type(FLOW):
+        if nodes[name]['flow_to'] is not None:
+            inflows.setdefault(nodes[name]['flow_to'], list()).append(name)
+        if nodes[name]['flow_from'] is not None:
+            outflows.setdefault(nodes[name]['flow_from'], list()).append(name)
+
+    def write(f, element):
+        f.write(ElementTree.tostring(element, encoding='unicode'))
+        f.write('\n')
+
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('<?xml version="1.0" encoding="utf-8"?>\n')
+        f.write('<xmile version="1.0" xmlns="{}" xmlns:isee="{}">\n'.format(XMILE_NAMESPACE, ISEE_NAMESPACE))
+        header = ElementTree.Element('header')
+        ElementTree.SubElement(header, 'smile', version='1.0', namespace='std, isee')
+        add_text(header, 'name', model_name)
+        add_text(header, 'vendor', 'SFD_Canvas')
+        add_text(header, 'product', 'Graph-SD').set('version', '1.0')
+        write(f, header)
+
+        sim_specs = ElementTree.Element('sim_specs', method='Euler')
+        add_text(sim_specs, 'start', number_text(structure.default_start_time))
+        add_text(sim_specs, 'stop', number_text(structure.default_start_time + structure.default_simulation_time))
+        add_text(sim_specs, 'dt', number_text(structure.default_dt))
+        if structure.default_save_interval is not None:
+            add_text(sim_specs, 'save_per', number_text(structure.default_save_interval))
+        write(f, sim_specs)
+
+        if len(structure.dimensions) > 0:
+            dimensions = ElementTree.Element('dimensions')
+            for dimension, labels in structure.dimensions.items():
+                dim = ElementTree.SubElement(dimensions, 'dim', name=dimension)
+                for label in labels:
+                    ElementTree.SubElement(dim, 'elem', name=label)
+            write(f, dimensions)
+
+        # TIME and DT are built into XMILE, so they are left out
+        f.write('<model>\n<variables>\n')
+        for name, attributes in nodes.items():
+            if attributes['element_type'] != ALIAS and name not in run_variables:
+                write(f, variable_element(structure, name, attributes, inflows, outflows))
+        f.write('</variables>\n<views>\n<view type="stock_flow">\n')
+        for name, attributes in nodes.items():
+            if name not in run_variables:
+                write(f, view_element(name, attributes))
+
+        # a connector for every name an element's function uses, and for every displayed link
+        uid = 0
+        for name, attributes in nodes.items():
+            # an element shown through an alias is connected from the alias, below
+            connected = set(nodes[from_element]['function'] for from_element in structure.sfd.predecessors(name)
+                            if nodes[from_element]['element_type'] == ALIAS)
+            if attributes['element_type'] != ALIAS and attributes['function'] is not None:
+                for from_element, angle in function_arguments(attributes['function']):
+                    if from_element in connected or from_element not in nodes or from_element in run_variables:
+                        continue
+                    if angle is None and structure.sfd.has_edge(from_element, name):
+                        angle = structure.sfd.edges[from_element, name].get('angle')
+                    uid += 1
+                    write(f, connector_element(uid, angle, from_element, name))
+                    connected.add(from_element)
+            for from_element, to_element, link in structure.sfd.in_edges(name, data=True):
+                if link.get('display', True) and from_element not in connected and from_element not in run_variables:
+                    uid += 1
+                    write(f, connector_element(uid, link.get('angle'), from_element, to_element))
+                    connected.add(from_element)
+        f.write('</view>\n</views>\n</model>\n</xmile>\n')
+
+
+def main():
+    """
+    Check that the sample models come back from write_xmile() with the same connections and the same runs
+    """
+    import glob
+    import os
+    import tempfile
+    from StockAndFlowInPython.session_handler import SessionHandler
+    sample_models = os.path.join(os.path.dirname(__file__), '..', 'sample_models')
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'round_trip.stmx')
+        for filename in sorted(glob.glob(os.path.join(sample_models, '*.stmx'))):
+            structures = list()
+            for model in [filename, path]:
+                session_handler = SessionHandler()
+                session_handler.read_xmile_model(model, cache=False)
+                structures.append(session_handler.model_structure)
+                if model == filename:
+                    write_xmile(session_handler.model_structure, path)
+            read, written = structures
+            if set(read.sfd.edges) != set(written.sfd.edges):
+                raise AssertionError("XMILE writer: connections of {} differ after writing it, {} only before and {} only after."
+                                     .format(filename, sorted(set(read.sfd.edges) - set(written.sfd.edges)),
+                                             sorted(set(written.sfd.edges) - set(read.sfd.edges))))
+            for structure in structures:
+                structure.simulate()
+            for name in read.stocks:
+                if not np.allclose(read.get_behavior(name), written.get_behavior(name)):
+                    raise AssertionError("XMILE writer: {} of {} behaves differently after writing it.".format(
+                        name, filename))
+            print('XMILE writer: {} written and read back with the same {} connections and runs'.format(
+                os.path.basename(filename), read.sfd.number_of_edges()))
+
+
+if __name__ == '__main__':
+    main()
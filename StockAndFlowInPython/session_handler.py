@@ -1,4 +1,11 @@
 import xml.dom.minidom
+from xml.etree import ElementTree
+import contextlib
+import glob
+import io
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 # import math
 import time
 import random
@@ -8,11 +15,16 @@ import random
 # from tkinter import filedialog
 # from tkinter import *
 # from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
-from StockAndFlowInPython.graph_sd.graph_engine import Structure, function_names
-from StockAndFlowInPython.parsing.XMILE_parsing import text_to_equation
+from StockAndFlowInPython.graph_sd.graph_engine import Structure, function_names, name_handler, STOCK, FLOW, \
+    VARIABLE, ALIAS, CONNECTOR, run_variables
+from StockAndFlowInPython.parsing.XMILE_parsing import text_to_equation, xmile_to_graphical_function, xmile_tag, \
+    xmile_find, xmile_find_all, split_delays
+from StockAndFlowInPython.parsing.model_cache import cache_key, load_state, restore_structure, save_structure, \
+    structure_state, structure_from_state
 # from StockAndFlowInPython.sfd_canvas.sfd_canvas_tkinter import SFDCanvas
 
 SLEEP_TIME = 0
+AUX = 'aux'  # tag of auxiliaries in XMILE
 
 
 class SessionHandler(object):
@@ -69,25 +81,24 @@ class SessionHandler(object):
     #     self.draw_graph_network()
     #     self.variables_in_model = list(self.model_structure.sfd.nodes)
 
-    def simulation_handler(self, simulation_time, time_step=0.25):
+    def simulation_handler(self, simulation_time, time_step=None, backend='interpreter', guard=False):
         self.model_structure.clear_a_run()
-        self.model_structure.simulate(simulation_time=simulation_time,
-                                      dt=time_step)
+        return self.model_structure.simulate(simulation_time=simulation_time,
+                                             dt=time_step,
+                                             backend=backend,
+                                             guard=guard)
 
     def add_angle_to_eqn(self, name, eqn):
-        if eqn[0] in function_names:
+        if not isinstance(eqn[0], np.ndarray) and eqn[0] in function_names:
             for factor in eqn[1:]:
-                if type(factor[0]) == str:
+                if type(factor) == list and type(factor[0]) == str:  # a [name, angle]
                     factor[1] = self.get_angle(to_element=name, from_element=factor[0])
             return eqn
         else:
             return eqn
 
     def get_angle(self, from_element, to_element):
-        for connection_view_array in self.connection_views_array:
-            if connection_view_array[3] == to_element:
-                if connection_view_array[2] == from_element:
-                    return connection_view_array[1]
+        return self.connector_angles.get((from_element, to_element))
 
     def get_into_stock(self, flow_name):
         """
@@ -95,10 +106,7 @@ class SessionHandler(object):
         :param flow_name:
         :return:
         """
-        for stock_view_array in self.stock_views_array:
-            if stock_view_array[2] == flow_name:
-                return stock_view_array[0]
-        return None
+        return self.flow_into_stock.get(flow_name)
 
     def get_outfrom_stock(self, flow_name):
         """
@@ -106,161 +114,225 @@ class SessionHandler(object):
         :param flow_name:
         :return:
         """
-        for stock_view_array in self.stock_views_array:
-            if stock_view_array[3] == flow_name:
-                return stock_view_array[0]
-        return None
+        return self.flow_outfrom_stock.get(flow_name)
 
-    def read_xmile_model(self, filename):
-        DOMTree = xml.dom.minidom.parse(filename)
-        self.model = DOMTree.documentElement
+    def read_xmile_model(self, filename, cache=True, cache_directory=None):
+        """
+        Load a model from an XMILE file. The file is read once, element by element: definitions of variables are
+        indexed by name, and views and connectors collected, as they are met; the structure is then built from them
+        in one go.
+
+        Into an empty structure, the model is taken from the cache of parsed models if the same file content was
+        parsed before by this version of the parser (see model_cache.py); the cached model is then put into the
+        structure, which stays the same object. Otherwise the file is parsed, and the outcome cached.
+        :param cache: whether to use the cache
+        :param cache_directory: where the cache is; None for model_cache.DEFAULT_CACHE_DIRECTORY
+        """
+        key = None
+        if cache and self.model_structure.sfd.number_of_nodes() == 0:
+            key = cache_key(filename)
+            state = load_state(key, cache_directory)
+            if state is not None:
+                restore_structure(self.model_structure, state)
+                self.model = None
+                self.connector_angles = dict()
+                self.flow_into_stock = dict()
+                self.flow_outfrom_stock = dict()
+                print('loaded {} from the model cache'.format(filename))
+                return
+        self.parse_xmile_model(filename)
+        if key is not None:
+            save_structure(self.model_structure, key, cache_directory)
+
+    def parse_xmile_model(self, filename):
+        """
+        Parse an XMILE file into the structure, see read_xmile_model()
+        """
+        definitions = {STOCK: dict(), FLOW: dict(), AUX: dict()}  # name -> <stock>/<flow>/<aux> of <variables>
+        views = {STOCK: list(), FLOW: list(), AUX: list(), ALIAS: list()}  # in the order of the (first) view
+        self.connector_angles = dict()  # (from, to) -> angle
+        self.flow_into_stock = dict()  # flow -> the stock it flows into
+        self.flow_outfrom_stock = dict()  # flow -> the stock it flows out from
+        sim_specs = None
+        dimensions = list()
+
+        path = list()  # tags from the root down to the current element
+        n_views = 0
+        for event, element in ElementTree.iterparse(filename, events=('start', 'end')):
+            tag = xmile_tag(element)
+            if event == 'start':
+                if len(path) == 0:
+                    self.model = element
+                path.append(tag)
+                if tag == 'view':
+                    n_views += 1
+                continue
+            path.pop()
+            parent = path[-1] if len(path) > 0 else None
+            if parent == 'variables' and tag in definitions:
+                name = name_handler(element.get('name'))
+                definitions[tag][name] = element
+                if tag == STOCK:
+                    for inflow in xmile_find_all(element, 'inflow'):
+                        self.flow_into_stock.setdefault(name_handler(inflow.text), name)
+                    for outflow in xmile_find_all(element, 'outflow'):
+                        self.flow_outfrom_stock.setdefault(name_handler(outflow.text), name)
+            elif parent == 'view' and n_views == 1:  # the first view holds the diagram
+                if tag in [STOCK, FLOW, AUX] and element.get('name') is not None:
+                    views[tag].append(element)
+                elif tag == ALIAS and element.get('x') is not None:
+                    views[ALIAS].append(element)
+                elif tag == 'connector' and element.get('uid') is not None:
+                    self.connector_angles.setdefault((self.read_connector_end(element, 'from'),
+                                                      self.read_connector_end(element, 'to')),
+                                                     float(element.get('angle')))
+                    element.clear()
+            elif path == ['xmile'] and tag == 'sim_specs':
+                sim_specs = element
+            elif path == ['xmile'] and tag == 'dimensions':
+                dimensions.append(element)
+
+        # dimensions of arrayed variables
+        for element in dimensions:
+            self.read_dimensions(element)
+
+        # start, stop, dt and save interval
+        if sim_specs is not None:
+            self.read_sim_specs(sim_specs)
+
+        elements = list()
+        split_links = list()  # (from, to) of the dependencies of delays taken out of equations
+        for element_type in [STOCK, FLOW, AUX]:
+            for view in views[element_type]:
+                name = name_handler(view.get('name'))
+                eqn = None
+                gf = None
+                dimensions = None
+                definition = definitions[element_type].get(name)
+                if definition is not None:
+                    eqn = xmile_find(definition, 'eqn').text
+                    if element_type != STOCK:
+                        gf = xmile_find(definition, 'gf')
+                    dimensions = self.get_dimensions(definition)
+                    if dimensions is not None:
+                        eqn = self.read_arrayed_equation(definition, dimensions)
+                if element_type != STOCK and gf is None and type(eqn) == str:
+                    # delays used inside the equation become auxiliaries of their own, shown below the element
+                    eqn, split = split_delays(eqn, name)
+                    for i, (delay_name, delay_eqn) in enumerate(split, 1):
+                        delay_function = text_to_equation(delay_eqn)
+                        elements.append([VARIABLE, delay_name, delay_function, None, None,
+                                         float(view.get('x')), float(view.get('y')) + 30 * i, list(), dimensions])
+                        split_links += [(argument, delay_name) for argument in delay_function[1:]
+                                        if type(argument) == str and argument not in run_variables]
+                        split_links.append((delay_name, name))
+                equation = self.add_angle_to_eqn(name=name, eqn=self.read_equation(eqn, gf))
+                points = [(point.get('x'), point.get('y')) for point in xmile_find_all(view, 'pt')]
+                elements.append([VARIABLE if element_type == AUX else element_type, name, equation,
+                                 self.get_outfrom_stock(name), self.get_into_stock(name),
+                                 float(view.get('x')), float(view.get('y')), points, dimensions])
+        for view in views[ALIAS]:
+            elements.append([ALIAS, view.get('uid'), name_handler(xmile_find(view, 'of').text), None, None,
+                             float(view.get('x')), float(view.get('y'))])
+        # connectors between elements of the diagram, keeping their angles (e.g. for Structure.to_xmile()), and
+        # to and from the delays taken out of equations, which the file has no connectors for
+        names = set(element[1] for element in elements)
+        for (from_element, to_element), angle in self.connector_angles.items():
+            if from_element in names and to_element in names:
+                elements.append([CONNECTOR, angle, from_element, to_element, None])
+        for from_element, to_element in split_links:
+            if from_element in names:
+                elements.append([CONNECTOR, 0, from_element, to_element, None])
+        self.model_structure.add_elements_batch(elements)
+
+        print('loaded {}: {} stocks, {} flows, {} auxiliaries, {} aliases, {} connectors'.format(
+            filename, len(views[STOCK]), len(views[FLOW]), len(views[AUX]), len(views[ALIAS]),
+            len(self.model_structure.sfd.edges)))
+
+    def read_connector_end(self, connector, end):
+        """
+        Get what a connector comes from or goes to: an element's name, or the uid of an alias
+        :param end: 'from' or 'to'
+        """
+        end_element = xmile_find(connector, end)
+        alias = xmile_find(end_element, ALIAS)
+        if alias is not None:
+            return alias.get('uid')
+        return name_handler(end_element.text)
 
-        # fetch all variables in the file
-        # since there is only one "variables" in the file, the outcome
-        # is a list containing only one element of "variables"
-
-        allvariables = self.model.getElementsByTagName("variables")
-
-        # fetch all stocks/flows/aux/connectors in all variables (the only element in the list)
-
-        self.stock_definitions = allvariables[0].getElementsByTagName("stock")
-        self.flow_definitions = allvariables[0].getElementsByTagName("flow")
-        self.aux_definitions = allvariables[0].getElementsByTagName("aux")
-
-        # fetch all views in the file ---> down to the view
-
-        self.all_views = self.model.getElementsByTagName("views")
-        self.views = self.all_views[0].getElementsByTagName("view")
-
-        # fetch views for all connectors and draw
-        self.connectorviews = []
-        for connectorview in self.views[0].getElementsByTagName("connector"):
-            if connectorview.hasAttribute("uid"):
-                self.connectorviews.append(connectorview)
-
-        self.connection_views_array = list()
-        for connectorview in self.connectorviews:
-            uid = connectorview.getAttribute("uid")
-            angle = float(connectorview.getAttribute("angle"))
-            try:
-                from_element = connectorview.getElementsByTagName("from")[0].getElementsByTagName("alias")[
-                    0].getAttribute('uid')
-            except:
-                from_element = connectorview.getElementsByTagName("from")[0].childNodes[0].data
-                from_element = name_handler(from_element)
-
-            try:
-                to_element = connectorview.getElementsByTagName("to")[0].getElementsByTagName("alias")[0].getAttribute(
-                    'uid')
-            except:
-                to_element = connectorview.getElementsByTagName("to")[0].childNodes[0].data
-                to_element = name_handler(to_element)
-
-            # print("From and to", from_element, to_element)
-            print('formatting connector', uid, angle, 'from:', from_element, 'to:', to_element)
-            # self.model_structure.add_connector(uid=uid, angle=angle, from_element=from_element, to_element=to_element)
-            self.connection_views_array.append([uid, angle, from_element, to_element])
-
-        # fetch views for all stocks and draw
-        self.stockviews = []
-        for stockview in self.views[0].getElementsByTagName("stock"):
-            if stockview.hasAttribute("name"):
-                self.stockviews.append(stockview)
-
-        self.stock_views_array = list()
-        for stockview in self.stockviews:
-            name = stockview.getAttribute("name")
-            name = name_handler(name)
-            # print("Adding this stock:", name)
-            inflow = None
-            outflow = None
-            eqn = None
-            for stock_definition in self.stock_definitions:  # Loop to find a particular stock
-                if name_handler(stock_definition.getAttribute("name")) == name:
-                    eqn = stock_definition.getElementsByTagName("eqn")[0].firstChild.data
-                    try:
-                        inflow = stock_definition.getElementsByTagName("inflow")[0].firstChild.data
-                    except:
-                        pass
-                    try:
-                        outflow = stock_definition.getElementsByTagName("outflow")[0].firstChild.data
-                    except:
-                        pass
-
-            x = float(stockview.getAttribute("x"))
-            y = float(stockview.getAttribute("y"))
-            print('adding stock', name)
-            self.model_structure.add_stock(name=name,
-                                           equation=self.add_angle_to_eqn(name=name, eqn=text_to_equation(eqn)),
-                                           x=x,
-                                           y=y)
-            self.stock_views_array.append([name, eqn, inflow, outflow, x, y])
-
-        # fetch views for all flows and draw
-        self.flowviews = []
-        for flowview in self.views[0].getElementsByTagName("flow"):
-            if flowview.hasAttribute("name"):
-                self.flowviews.append(flowview)
-
-        for flowview in self.flowviews:
-            name = flowview.getAttribute("name")
-            name = name_handler(name)
-            eqn = None
-            # print("Adding this flow:", name)
-            for flow_definition in self.flow_definitions:  # loop to find a particular flow
-                if name_handler(flow_definition.getAttribute("name")) == name:
-                    eqn = flow_definition.getElementsByTagName("eqn")[0].firstChild.data
-            points = list()
-            for point in flowview.getElementsByTagName("pt"):
-                points.append((point.getAttribute("x"), point.getAttribute("y")))
-            x = float(flowview.getAttribute("x"))
-            y = float(flowview.getAttribute("y"))
-            print('adding flow', name)
-            self.model_structure.add_flow(name=name,
-                                          equation=self.add_angle_to_eqn(name=name, eqn=text_to_equation(eqn)),
-                                          x=x, y=y,
-                                          flow_from=self.get_outfrom_stock(name),
-                                          flow_to=self.get_into_stock(name),
-                                          points=points)
-
-        # fetch views for all auxiliaries and draw
-        self.auxviews = []
-        for auxview in self.views[0].getElementsByTagName("aux"):
-            if auxview.hasAttribute("name"):
-                #print(auxview.getAttribute("name"), "heeeeeeeee")
-                self.auxviews.append(auxview)
-
-        for auxview in self.auxviews:
-            name = auxview.getAttribute("name")
-            name = name_handler(name)
-            # print("Adding this aux:", name)
-            eqn = None
-            for aux_definition in self.aux_definitions:  # Loop to find a particular aux
-                if name_handler(aux_definition.getAttribute("name")) == name:
-                    eqn = aux_definition.getElementsByTagName("eqn")[0].firstChild.data
-            x = float(auxview.getAttribute("x"))
-            y = float(auxview.getAttribute("y"))
-            print('adding aux', name)
-            self.model_structure.add_aux(name=name, equation=self.add_angle_to_eqn(name=name, eqn=text_to_equation(eqn)), x=x, y=y)
-
-        # fetch views for all aliases and draw
-        self.aliasviews = []
-        for aliasview in self.views[0].getElementsByTagName("alias"):
-            # distinguish definition of alias from refering to it (cannot use 'color': sometimes there isn't)
-            if aliasview.hasAttribute("x"):
-                self.aliasviews.append(aliasview)
-
-        for aliasview in self.aliasviews:
-            uid = aliasview.getAttribute("uid")
-            x = float(aliasview.getAttribute("x"))
-            y = float(aliasview.getAttribute("y"))
-            of = aliasview.getElementsByTagName("of")[0].firstChild.data
-            of = name_handler(of)
-            print('adding alias', of)
-            self.model_structure.add_alias(uid=uid, of_element=of, x=x, y=y)
-
-        print('\nnodes: ', self.model_structure.sfd.nodes)
-        print('edges: ', self.model_structure.sfd.edges)
+    def read_sim_specs(self, sim_specs):
+        """
+        Take the simulation specs of the model file (<sim_specs>) as the defaults of the structure
+        """
+        specs = dict()
+        for tag in ["start", "stop", "dt", "save_per"]:
+            node = xmile_find(sim_specs, tag)
+            if node is not None and node.text is not None:
+                specs[tag] = float(node.text)
+                if node.get("reciprocal") == "true":  # e.g. <dt reciprocal="true">4</dt> is 1/4
+                    specs[tag] = 1 / specs[tag]
+        if "dt" in specs:
+            self.model_structure.default_dt = specs["dt"]
+        if "start" in specs:
+            self.model_structure.default_start_time = specs["start"]
+        if "stop" in specs:
+            self.model_structure.default_simulation_time = specs["stop"] - specs.get("start", 0)
+        if "save_per" in specs:
+            self.model_structure.default_save_interval = specs["save_per"]
+        print("simulation specs", specs)
+
+    def read_dimensions(self, dimensions):
+        """
+        Add the dimensions defined in the model file (<dimensions> of the file, not of a variable) to the structure
+        """
+        for dim in xmile_find_all(dimensions, "dim"):
+            elems = xmile_find_all(dim, "elem")
+            if len(elems) > 0:
+                elements = [elem.get("name") for elem in elems]
+            else:
+                elements = int(dim.get("size"))
+            self.model_structure.add_dimension(name_handler(dim.get("name")), elements)
+
+    def get_dimensions(self, definition):
+        """
+        Get the names of the dimensions a variable is arrayed over, or None if it is not arrayed
+        """
+        dimensions = xmile_find(definition, "dimensions")
+        if dimensions is None:
+            return None
+        return [name_handler(dim.get("name")) for dim in xmile_find_all(dimensions, "dim")]
+
+    def read_arrayed_equation(self, definition, dimensions):
+        """
+        Read the equation of an arrayed variable: one equation for all entries, or a number for each <element>
+        :return: the equation text, or an array of numbers along the dimensions
+        """
+        elements = xmile_find_all(definition, "element")
+        if len(elements) == 0:
+            return xmile_find(definition, "eqn").text
+        values = np.zeros([len(self.model_structure.dimensions[dimension]) for dimension in dimensions])
+        for element in elements:
+            labels = [label.strip() for label in element.get("subscript").split(',')]
+            position = tuple(self.model_structure.dimensions[dimension].index(label)
+                             for dimension, label in zip(dimensions, labels))
+            eqn = xmile_find(element, "eqn").text
+            equation = text_to_equation(eqn)
+            if len(equation) != 1:
+                raise ValueError("SdEngine: only numbers are supported as equations of single elements of {}, "
+                                 "not {}.".format(name_handler(definition.get("name")), eqn))
+            values[position] = equation[0]
+        return values
+
+    def read_equation(self, eqn, gf=None):
+        """
+        Read an equation from XMILE; with a graphical function, the equation is its input. An array of numbers is
+        the value of an arrayed constant.
+        """
+        if type(eqn) == np.ndarray:
+            return [eqn]
+        if gf is None:
+            return text_to_equation(eqn)
+        return xmile_to_graphical_function(gf, eqn)
 
     def clear_a_run(self):
         """
@@ -578,6 +650,72 @@ class SessionHandler(object):
         self.refresh()
 
 
+class ModelLoadReport(object):
+    """
+    How loading one model file went, see load_models()
+    """
+    def __init__(self, filename, seconds, error=None):
+        """
+        :param seconds: time taken to load the file
+        :param error: why it could not be loaded, e.g. "EquationSyntaxError: Unknown function 'STEP' ..."; None if
+        it was loaded
+        """
+        self.filename = filename
+        self.seconds = seconds
+        self.error = error
+
+    def __repr__(self):
+        if self.error is not None:
+            return '{}: failed after {:.3f} s, {}'.format(self.filename, self.seconds, self.error)
+        return '{}: loaded in {:.3f} s'.format(self.filename, self.seconds)
+
+
+def load_model_file(filename, cache=True, cache_directory=None):
+    """
+    Load one model file quietly; this is what runs in a worker process of load_models().
+    :return: the structure_state() of the model (or None if it failed), the time taken, and the error if any
+    """
+    start = time.time()
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):  # the engine reports every element it adds
+            session_handler = SessionHandler()
+            session_handler.read_xmile_model(filename, cache=cache, cache_directory=cache_directory)
+        return structure_state(session_handler.model_structure), time.time() - start, None
+    except Exception as e:  # any construct the loader does not support
+        return None, time.time() - start, '{}: {}'.format(type(e).__name__, e)
+
+
+def load_models(directory, workers=None, cache=True, cache_directory=None):
+    """
+    Load all model files (.stmx) in a directory and its subdirectories, parsing them side by side in worker
+    processes. A file that cannot be loaded is reported and skipped.
+    :param directory: the directory of the models
+    :param workers: number of worker processes; by default one per CPU
+    :param cache: whether to use the cache of parsed models, see read_xmile_model()
+    :return: a dictionary of Structures by file path (relative to directory), and a dictionary of ModelLoadReports
+    by file path for all files
+    """
+    filenames = sorted(glob.glob(os.path.join(directory, '**', '*.stmx'), recursive=True))
+    workers = workers if workers is not None else os.cpu_count()
+    if workers <= 1 or len(filenames) <= 1:
+        outcomes = [load_model_file(filename, cache, cache_directory) for filename in filenames]
+    else:
+        with ProcessPoolExecutor(max_workers=min(workers, len(filenames))) as executor:
+            futures = [executor.submit(load_model_file, filename, cache, cache_directory) for filename in filenames]
+            outcomes = [future.result() for future in futures]
+
+    structures = dict()
+    reports = dict()
+    for filename, (state, seconds, error) in zip(filenames, outcomes):
+        name = os.path.relpath(filename, directory)
+        reports[name] = ModelLoadReport(name, seconds, error)
+        print(reports[name])
+        if state is not None:
+            structures[name] = structure_from_state(state)
+    print('loaded {} of {} models from {}'.format(len(structures), len(filenames), directory))
+    return structures, reports
+
+
 # class SFDWindow(object):
 #     def __init__(self):
 #         self.top = Toplevel()
@@ -830,6 +830,8 @@ class InteractiveSFD(QWidget, Ui_widget_interactive_sfd):
         self.pushButton_add_graph.clicked.connect(self.on_pushbutton_add_graph_clicked)
         self.pushButton_del_element.clicked.connect(self.on_pushbutton_delete_clicked)
         self.pushButton_start.clicked.connect(self.on_pushbutton_start_clicked)
+        self.pushButton_pause.clicked.connect(self.on_pushbutton_pause_clicked)
+        self.pushButton_reset.clicked.connect(self.on_pushbutton_reset_clicked)
         self.pushButton_apply.clicked.connect(self.on_pushbutton_apply_clicked)
 
         self.model_canvas = ModelCanvas(self)
@@ -841,6 +843,12 @@ class InteractiveSFD(QWidget, Ui_widget_interactive_sfd):
 
         self.model_structure = Structure()
 
+        # step-based simulation: a run from Structure.iter_steps(), advanced by a timer so that it can be paused
+        self.simulation = None
+        self.simulation_steps_per_tick = 4
+        self.simulation_timer = QTimer(self)
+        self.simulation_timer.timeout.connect(self.on_simulation_timer_timeout)
+
     # Exclusively check buttons
     def on_pushbutton_add_stock_clicked(self):
         self.model_canvas.working_mode = 'stock'
@@ -961,11 +969,32 @@ class InteractiveSFD(QWidget, Ui_widget_interactive_sfd):
             print(equation)
             self.model_structure.replace_equation(name=self.model_canvas.item_label_under_editing,
                                                   new_equation=equation)
+            # if there is a run, only what the edit affects is simulated again
+            self.model_structure.resimulate()
 
     # Simulation control
     def on_pushbutton_start_clicked(self):
+        if self.simulation is None:  # start a new run; otherwise resume the paused one
+            self.model_structure.clear_a_run()
+            self.simulation = self.model_structure.iter_steps(every=self.simulation_steps_per_tick)
+        self.simulation_timer.start(0)
+
+    def on_pushbutton_pause_clicked(self):
+        self.simulation_timer.stop()
+
+    def on_pushbutton_reset_clicked(self):
+        self.simulation_timer.stop()
+        if self.simulation is not None:
+            self.simulation.close()
+            self.simulation = None
         self.model_structure.clear_a_run()
-        self.model_structure.simulate()  # TODO: need to change to 'step-based' simulation
+
+    def on_simulation_timer_timeout(self):
+        try:
+            next(self.simulation)
+        except StopIteration:
+            self.simulation_timer.stop()
+            self.simulation = None
 
     @staticmethod
     def name_handler(name):
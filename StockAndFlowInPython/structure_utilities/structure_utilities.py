@@ -792,13 +792,14 @@ def optimize_parameters(base_structure, reference_modes, reference_mode_bindings
                     # plt.figure(optimization_figures[-1].number)
 
                 print("Simulating...")
-                new_base.simulation_handler(25)
+                # only parameter values change between epochs, so the generated step function is reused
+                new_base.simulation_handler(25, backend='codegen')
 
                 distance_new = 0
 
                 for reference_mode_name, reference_mode_property in reference_modes.items():
                     bound_element_uid = reference_mode_bindings[reference_mode_name]
-                    who_compare = new_base.model_structure.get_element_by_uid(bound_element_uid)['value']
+                    who_compare = new_base.model_structure.get_behavior(new_base.model_structure.get_element_name_by_uid(bound_element_uid))
                     compare_with = reference_mode_property[1]
                     distance_new += similarity_calc_behavior(who_compare=np.array(who_compare).reshape(-1, 1),
                                                              compare_with=np.array(compare_with).reshape(-1, 1),
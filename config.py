@@ -6,6 +6,11 @@ REFERENCE_MODE_PATH = './StockAndFlowInPython/case/water_sink.csv'
 
 ITERATION_TIMES = 1
 
+# number of new candidate structures made in each iteration; they are simulated side by side in a process pool
+CANDIDATES_PER_ITERATION = 1
+# worker processes for simulating candidate structures; None for one per CPU
+SIMULATION_WORKERS = None
+
 ACTIVITY_DEMOMINATOR = 2
 
 INITIAL_LIKELIHOOD = 50
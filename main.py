@@ -9,14 +9,17 @@ from PyQt5.QtGui import *
 from PyQt5.QtWidgets import *
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg
 from config import ITERATION_TIMES, ACTIVITY_DEMOMINATOR, INITIAL_LIKELIHOOD, INITIAL_ACTIVITY, REFERENCE_MODE_PATH, \
-    COOL_DOWN_TIMES, COOL_DOWN_SWITCH, GENERIC_STRUCTURE_LIKELIHOOD_UPDATE_TIMES, PURGE_SWITCH, PURGE_THRESHOLD
+    COOL_DOWN_TIMES, COOL_DOWN_SWITCH, GENERIC_STRUCTURE_LIKELIHOOD_UPDATE_TIMES, PURGE_SWITCH, PURGE_THRESHOLD, \
+    CANDIDATES_PER_ITERATION, SIMULATION_WORKERS
 
 from StockAndFlowInPython.session_handler import SessionHandler
 from StockAndFlowInPython.structure_utilities.structure_utilities import new_expand_structure, create_causal_link, \
     apply_a_concept_cld, optimize_parameters, import_flow
-from StockAndFlowInPython.behaviour_utilities.behaviour_utilities import similarity_calc_pattern, categorize_behavior
+from StockAndFlowInPython.behaviour_utilities.behaviour_utilities import similarity_calc_pattern, categorize_behavior, \
+    pattern_distance
 from StockAndFlowInPython.graph_sd.graph_engine import STOCK, FLOW, VARIABLE, PARAMETER, CONNECTOR, ALIAS, \
     MULTIPLICATION, LINEAR, SUBTRACTION, DIVISION, ADDITION
+from StockAndFlowInPython.graph_sd.simulation_pool import SimulationPool
 from StockAndFlowInPython.sfd_canvas.sfd_canvas_qt import SFDCanvas
 from StockAndFlowInPython.sfd_canvas.interactive_sfd import InteractiveSFD
 from StockAndFlowInPython.parsing.XMILE_parsing import equation_to_text, text_to_equation
@@ -134,6 +137,9 @@ class IntegratedWindow(QMainWindow, Ui_MainWindow):
         # first time introducing a ref
         self.flag_first_ref = True
 
+        # worker processes simulating new candidate structures
+        self.simulation_pool = SimulationPool(workers=SIMULATION_WORKERS)
+
 
     def set_iteration_time(self):
         self.iteration_time = int(self.lineEdit_iteration.text())
@@ -154,87 +160,86 @@ class IntegratedWindow(QMainWindow, Ui_MainWindow):
             for j in range(GENERIC_STRUCTURE_LIKELIHOOD_UPDATE_TIMES):
                 self.update_generic_structures_likelihood()
 
-            # STEP: structural modification
-            chosen_task = random.choice(self.task_list)
-            if chosen_task == 1:
-                """Generate a new candidate structure"""
-                base = self.random_one_candidate_structure()
-                target = self.random_one_generic_structure()
-                # get all elements in base structure
-                base_structure_elements = list(base.model_structure.sfd.nodes)
-                # pick an element from base_structure to start with. Now: randomly. Future: guided by activity.
-                start_with_element_base = random.choice(base_structure_elements)
-                new = new_expand_structure(base_structure=base,
-                                           start_with_element_base=start_with_element_base,
-                                           target_structure=target)
-                # new = expand_structure(base_structure=base, target_structure=target)
-                new.simulation_handler(25)
-                self.derive_new_candidate_structure(base_structure=base, new_structure=new)
-                # self.task_list.append(random.choice([1, 2]))
-                self.task_list.append(4)
-
-            elif chosen_task == 2:
-                """Create a new causal link in an existing candidate structure"""
-                base = self.random_one_candidate_structure()
-                new = create_causal_link(base_structure=base)
-                new.simulation_handler(25)
-                self.derive_new_candidate_structure(base_structure=base, new_structure=new)
-                self.task_list.append(random.choice([1, 2]))
-
-            elif chosen_task == 3:
-                """Expand a candidate structure following a concept CLD"""
-                # categorise a reference mode into a dynamic pattern. Temporarily only consider stock's ref mode
-                stock_ref_names = list()
-                for ref_name, ref_property in self.reference_modes.items():
-                    if ref_property[0] == STOCK:
-                        stock_ref_names.append(ref_name)
-                print("    Currently we have stock ref modes:", stock_ref_names)
-                chosen_stock_ref_name = random.choice(stock_ref_names)
-                chosen_stock_uid = self.reference_mode_bindings[chosen_stock_ref_name]
-                print("    We choose {}, uid {} as the beginning stock".format(chosen_stock_ref_name,
-                                                                               chosen_stock_uid))
-                pattern_name = self.categorize(behavior=self.reference_modes[chosen_stock_ref_name][1])
-
-                # fetch concept CLD based on pattern
-                concept_cld = self.get_concept_cld_by_name(concept_cld_name=pattern_name)
-                print(concept_cld.nodes(data=True))
-
-                base = self.random_one_candidate_structure()
-                # TODO: this is not purely random
-                target = self.random_one_generic_structure()
-                new = apply_a_concept_cld(base_structure=base,
-                                          stock_uid_in_base_to_start_with=chosen_stock_uid,
-                                          concept_cld=concept_cld,
-                                          target_structure=target)
-                new.simulation_handler(25)
-                self.derive_new_candidate_structure(base_structure=base, new_structure=new)
-                # self.task_list.append(4)
-
-            elif chosen_task == 4:
-                """Optimize parameters in a candidate structure"""
-                base = self.random_one_candidate_structure()
-
-                new = optimize_parameters(base_structure=base,
-                                          reference_modes=self.reference_modes,
-                                          reference_mode_bindings=self.reference_mode_bindings)
-                new.simulation_handler(25)
-                self.derive_new_candidate_structure(base_structure=base, new_structure=new, overwrite=False)
-                # self.task_list.append(5)
-
-            elif chosen_task == 5:
-                """Import a flow"""
-                base = self.random_one_candidate_structure()
-                target = self.random_one_generic_structure()
-                # get all elements in base structure
-                base_structure_stocks = list(base.model_structure.all_certain_type(STOCK))
-                # pick a stock from base_structure to start with. Now: randomly. Future: guided by activity.
-                start_with_element_base = random.choice(base_structure_stocks)
-                new = import_flow(base_structure=base,
-                                  start_with_element_base=start_with_element_base,
-                                  target_structure=target)
-                new.simulation_handler(25)
-                self.derive_new_candidate_structure(base_structure=base, new_structure=new)
-                # self.task_list.append(4)
+            # STEP: structural modification; the new candidates are simulated side by side, then derived
+            new_candidates = list()
+            for j in range(CANDIDATES_PER_ITERATION):
+                chosen_task = random.choice(self.task_list)
+                if chosen_task == 1:
+                    """Generate a new candidate structure"""
+                    base = self.random_one_candidate_structure()
+                    target = self.random_one_generic_structure()
+                    # get all elements in base structure
+                    base_structure_elements = list(base.model_structure.sfd.nodes)
+                    # pick an element from base_structure to start with. Now: randomly. Future: guided by activity.
+                    start_with_element_base = random.choice(base_structure_elements)
+                    new = new_expand_structure(base_structure=base,
+                                               start_with_element_base=start_with_element_base,
+                                               target_structure=target)
+                    # new = expand_structure(base_structure=base, target_structure=target)
+                    new_candidates.append((base, new, False))
+                    # self.task_list.append(random.choice([1, 2]))
+                    self.task_list.append(4)
+
+                elif chosen_task == 2:
+                    """Create a new causal link in an existing candidate structure"""
+                    base = self.random_one_candidate_structure()
+                    new = create_causal_link(base_structure=base)
+                    new_candidates.append((base, new, False))
+                    self.task_list.append(random.choice([1, 2]))
+
+                elif chosen_task == 3:
+                    """Expand a candidate structure following a concept CLD"""
+                    # categorise a reference mode into a dynamic pattern. Temporarily only consider stock's ref mode
+                    stock_ref_names = list()
+                    for ref_name, ref_property in self.reference_modes.items():
+                        if ref_property[0] == STOCK:
+                            stock_ref_names.append(ref_name)
+                    print("    Currently we have stock ref modes:", stock_ref_names)
+                    chosen_stock_ref_name = random.choice(stock_ref_names)
+                    chosen_stock_uid = self.reference_mode_bindings[chosen_stock_ref_name]
+                    print("    We choose {}, uid {} as the beginning stock".format(chosen_stock_ref_name,
+                                                                                   chosen_stock_uid))
+                    pattern_name = self.categorize(behavior=self.reference_modes[chosen_stock_ref_name][1])
+
+                    # fetch concept CLD based on pattern
+                    concept_cld = self.get_concept_cld_by_name(concept_cld_name=pattern_name)
+                    print(concept_cld.nodes(data=True))
+
+                    base = self.random_one_candidate_structure()
+                    # TODO: this is not purely random
+                    target = self.random_one_generic_structure()
+                    new = apply_a_concept_cld(base_structure=base,
+                                              stock_uid_in_base_to_start_with=chosen_stock_uid,
+                                              concept_cld=concept_cld,
+                                              target_structure=target)
+                    new_candidates.append((base, new, False))
+                    # self.task_list.append(4)
+
+                elif chosen_task == 4:
+                    """Optimize parameters in a candidate structure"""
+                    base = self.random_one_candidate_structure()
+
+                    new = optimize_parameters(base_structure=base,
+                                              reference_modes=self.reference_modes,
+                                              reference_mode_bindings=self.reference_mode_bindings)
+                    new_candidates.append((base, new, False))
+                    # self.task_list.append(5)
+
+                elif chosen_task == 5:
+                    """Import a flow"""
+                    base = self.random_one_candidate_structure()
+                    target = self.random_one_generic_structure()
+                    # get all elements in base structure
+                    base_structure_stocks = list(base.model_structure.all_certain_type(STOCK))
+                    # pick a stock from base_structure to start with. Now: randomly. Future: guided by activity.
+                    start_with_element_base = random.choice(base_structure_stocks)
+                    new = import_flow(base_structure=base,
+                                      start_with_element_base=start_with_element_base,
+                                      target_structure=target)
+                    new_candidates.append((base, new, False))
+                    # self.task_list.append(4)
+
+            self.derive_new_candidate_structures(new_candidates)
 
             # STEP: adjust candidate structures' activity
             self.update_candidate_structure_activity_by_behavior()
@@ -276,22 +281,10 @@ class IntegratedWindow(QMainWindow, Ui_MainWindow):
                     #     random_two_candidates = self.structure_manager.random_pair_even()
                 print("    Two candidate structures chosen for comparison: ", random_two_candidates)
                 # Calculate their similarity to reference mode
-                candidate_0_distance = 0
-                candidate_1_distance = 0
                 s_uid_0 = random_two_candidates[0]
                 s_uid_1 = random_two_candidates[1]
-                for reference_mode_name, reference_mode_property in self.reference_modes.items():
-                    uid = self.reference_mode_bindings[reference_mode_name]
-                    candidate_0_distance += self.behavioral_distance(
-                        self.expansion_tree.nodes[s_uid_0]['structure'].model_structure.get_element_by_uid(uid)[
-                            'value'],
-                        reference_mode_property[1]
-                    )
-                    candidate_1_distance += self.behavioral_distance(
-                        self.expansion_tree.nodes[s_uid_1]['structure'].model_structure.get_element_by_uid(uid)[
-                            'value'],
-                        reference_mode_property[1]
-                    )
+                candidate_0_distance = self.candidate_structure_distance(s_uid_0)
+                candidate_1_distance = self.candidate_structure_distance(s_uid_1)
 
                 print(candidate_0_distance, candidate_1_distance)
                 # Update their activity
@@ -302,6 +295,29 @@ class IntegratedWindow(QMainWindow, Ui_MainWindow):
                         self.update_candidate_structures_activity_elo(s_uid_0, s_uid_1)
                 # print("All nodes' activity:", self.show_all_candidate_structures_activity())
 
+    def get_reference_key(self):
+        """Identify the current reference modes and their bindings, to tell if a distance is still valid"""
+        return tuple((name, self.reference_mode_bindings.get(name)) for name in self.reference_modes)
+
+    def get_references(self, structure):
+        """Get (element name, reference behavior) for all reference modes, for scoring a structure elsewhere"""
+        references = list()
+        for reference_mode_name, reference_mode_property in self.reference_modes.items():
+            uid = self.reference_mode_bindings[reference_mode_name]
+            references.append((structure.model_structure.get_element_name_by_uid(uid), reference_mode_property[1]))
+        return references
+
+    def candidate_structure_distance(self, s_uid):
+        """Distance of a candidate structure's behavior to all reference modes"""
+        # use the distance from its simulation in the pool, if the reference modes are still the same
+        if self.expansion_tree.nodes[s_uid].get('distance_key') == self.get_reference_key():
+            return self.expansion_tree.nodes[s_uid]['distance']
+        distance = 0
+        for name, reference in self.get_references(self.expansion_tree.nodes[s_uid]['structure']):
+            distance += self.behavioral_distance(
+                self.expansion_tree.nodes[s_uid]['structure'].model_structure.get_behavior(name), reference)
+        return distance
+
     def update_generic_structures_likelihood(self):
         random_two_generic_structures = [None, None]
         while random_two_generic_structures[0] == random_two_generic_structures[1]:  # The two cannot be the same
@@ -325,12 +341,12 @@ class IntegratedWindow(QMainWindow, Ui_MainWindow):
 
         random_two_generic_structures_distance = {
             generic_structure_0: self.behavioral_distance(
-                self.generic_structures[generic_structure_0].model_structure.sfd.node[
-                    chosen_element_from_generic_structure_0]['value'],
+                self.generic_structures[generic_structure_0].model_structure.get_behavior(
+                    chosen_element_from_generic_structure_0),
                 self.reference_modes[chosen_reference_mode][1]),
             generic_structure_1: self.behavioral_distance(
-                self.generic_structures[generic_structure_1].model_structure.sfd.node[
-                    chosen_element_from_generic_structure_1]['value'],
+                self.generic_structures[generic_structure_1].model_structure.get_behavior(
+                    chosen_element_from_generic_structure_1),
                 self.reference_modes[chosen_reference_mode][1])
         }
         # print(random_two_generic_structures_distance)
@@ -741,15 +757,38 @@ class IntegratedWindow(QMainWindow, Ui_MainWindow):
         print(
             '    StructureManager: Can not find uid for given structure {}.'.format(structure))
 
-    def derive_new_candidate_structure(self, base_structure, new_structure, overwrite=False):
+    def derive_new_candidate_structures(self, new_candidates):
+        """Simulate and score new candidate structures in the simulation pool, then derive them one by one"""
+        results = self.simulation_pool.simulate(
+            structures=[new.model_structure for base, new, overwrite in new_candidates],
+            simulation_time=25,
+            references=[self.get_references(new) if len(self.reference_modes) > 0 else None
+                        for base, new, overwrite in new_candidates],
+            distance_function=pattern_distance)
+        for (base, new, overwrite), result in zip(new_candidates, results):
+            new.model_structure.set_result(result)
+            self.derive_new_candidate_structure(base_structure=base, new_structure=new, overwrite=overwrite,
+                                                status=result.status, distance=result.distance)
+
+    def derive_new_candidate_structure(self, base_structure, new_structure, overwrite=False, status=None, distance=None):
         """Derive a new structure from an existing one"""
         # # this is designed for 'optimization of parameters', cuz
         if overwrite:
             base_uid = self.get_uid_by_structure(structure=base_structure)
             self.expansion_tree.nodes[base_uid]['structure'] = new_structure
+            self.expansion_tree.nodes[base_uid]['distance_key'] = None
             base_structure.simulation_handler(25)
             return
 
+        # simulate this new structure, unless it has been simulated in the pool;
+        # candidates that divide by zero or run away are discarded
+        if status is None:
+            status = new_structure.simulation_handler(25, backend='codegen', guard=True)
+            distance = None
+        if status.diverged:
+            print("    The new structure is discarded, its simulation {}".format(status))
+            return
+
         # decide if this new_structure has been generated before. if so: confirm activity. if not: confirm it.
         # 1. identical to base_structure it self
         # if nx.is_isomorphic(base_structure.model_structure.sfd, new_structure.model_structure.sfd):
@@ -797,7 +836,9 @@ class IntegratedWindow(QMainWindow, Ui_MainWindow):
         new_activity = 40
         self.expansion_tree.add_node(new_uid,
                                      structure=new_structure,
-                                     activity=new_activity
+                                     activity=new_activity,
+                                     distance=distance,
+                                     distance_key=self.get_reference_key() if distance is not None else None
                                      )
 
         # subtraction this part of activity from the base_structure
@@ -807,9 +848,6 @@ class IntegratedWindow(QMainWindow, Ui_MainWindow):
 
         # build a link from the old structure to the new structure
         self.expansion_tree.add_edge(self.get_uid_by_candidate_structure(base_structure), new_uid)
-        # simulate this new structure
-
-        new_structure.simulation_handler(25)
 
         self.refresh_expansion_tree()
 
@@ -1003,7 +1041,7 @@ class IntegratedWindow(QMainWindow, Ui_MainWindow):
         if selected_element_of_structure != '':
             print("{} is selected for displaying behavior".format(selected_element_of_structure))
 
-            self.put_time_series_to_result_panel(time_series=self.expansion_tree.nodes[self.selected_candidate_structure_uid]['structure'].model_structure.sfd.nodes[selected_element_of_structure]['value'],
+            self.put_time_series_to_result_panel(time_series=self.expansion_tree.nodes[self.selected_candidate_structure_uid]['structure'].model_structure.get_behavior(selected_element_of_structure),
                                                  time_series_name=selected_element_of_structure)
         else:
             print("No element is selected")
@@ -1142,6 +1180,9 @@ class IntegratedWindow(QMainWindow, Ui_MainWindow):
                                                                                                              new_flow_from=new_flow_from,
                                                                                                              new_flow_to=new_flow_to)
 
+        # only what the modification affects is simulated again
+        self.expansion_tree.nodes[self.selected_candidate_structure_uid]['structure'].model_structure.resimulate()
+        self.expansion_tree.nodes[self.selected_candidate_structure_uid]['distance_key'] = None
         self.display_a_candidate_structure()
 
 
@@ -1245,6 +1286,11 @@ class IntegratedWindow(QMainWindow, Ui_MainWindow):
     def reset(self):
         pass
 
+    def closeEvent(self, event):
+        # stop the worker processes of the simulation pool with the window
+        self.simulation_pool.shutdown()
+        event.accept()
+
 
 
 
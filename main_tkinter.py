@@ -297,13 +297,13 @@ class ExpansionPanel(Frame):
                 for reference_mode_name, reference_mode_property in self.reference_modes.items():
                     uid = self.reference_mode_bindings[reference_mode_name]
                     candidate_0_distance += self.behavioral_distance(
-                        self.structure_manager.tree.nodes[s_uid_0]['structure'].model_structure.get_element_by_uid(uid)[
-                            'value'],
+                        self.structure_manager.tree.nodes[s_uid_0]['structure'].model_structure.get_behavior(
+                            self.structure_manager.tree.nodes[s_uid_0]['structure'].model_structure.get_element_name_by_uid(uid)),
                         reference_mode_property[1]
                     )
                     candidate_1_distance += self.behavioral_distance(
-                        self.structure_manager.tree.nodes[s_uid_1]['structure'].model_structure.get_element_by_uid(uid)[
-                            'value'],
+                        self.structure_manager.tree.nodes[s_uid_1]['structure'].model_structure.get_behavior(
+                            self.structure_manager.tree.nodes[s_uid_1]['structure'].model_structure.get_element_name_by_uid(uid)),
                         reference_mode_property[1]
                     )
 
@@ -339,12 +339,12 @@ class ExpansionPanel(Frame):
 
         random_two_generic_structures_distance = {
             generic_structure_0: self.behavioral_distance(
-                self.generic_structure_manager.generic_structures[generic_structure_0].model_structure.sfd.node[
-                    chosen_element_from_generic_structure_0]['value'],
+                self.generic_structure_manager.generic_structures[generic_structure_0].model_structure.get_behavior(
+                    chosen_element_from_generic_structure_0),
                 self.reference_modes[chosen_reference_mode][1]),
             generic_structure_1: self.behavioral_distance(
-                self.generic_structure_manager.generic_structures[generic_structure_1].model_structure.sfd.node[
-                    chosen_element_from_generic_structure_1]['value'],
+                self.generic_structure_manager.generic_structures[generic_structure_1].model_structure.get_behavior(
+                    chosen_element_from_generic_structure_1),
                 self.reference_modes[chosen_reference_mode][1])
         }
         # print(random_two_generic_structures_distance)